@@ -0,0 +1,80 @@
+'''
+Measure frame times of drag-style align update sequences: small rotations
+and offsets at mouse event rates, applied immediately, batched per frame,
+and rate limited by the align update interval. Usage:
+
+    python benchmarks/align_update_benchmark.py model.exf points.exf [number_of_events [events_per_second [update_interval]]]
+'''
+import sys
+import time
+
+import numpy
+
+from mapclientplugins.smoothfitstep.model.smoothfitmodel import SmoothfitModel
+
+
+def dragEvent(model, event):
+    model.rotateModel([0.0, 0.0, 1.0], 0.002)
+    model.offsetModel([0.001*numpy.sin(0.1*event), 0.001*numpy.cos(0.1*event), 0.0])
+
+
+def runDrag(model, eventCount, eventsPerSecond, eventsPerBatch=1):
+    '''
+    :return: list of seconds taken by each event, and number of updates of
+    the model transformation
+    '''
+    updates = [0]
+
+    def alignSettingsChanged():
+        updates[0] += 1
+        # as the widget does on every update
+        model.getAlignErrorPreview()
+
+    model.setAlignSettingsChangeCallback(alignSettingsChanged)
+    model.resetAlignment()
+    updates[0] = 0
+    eventSeconds = []
+    nextEventTime = time.perf_counter()
+    for event in range(eventCount):
+        # simulate mouse events arriving at a fixed rate
+        delay = nextEventTime - time.perf_counter()
+        if delay > 0.0:
+            time.sleep(delay)
+        nextEventTime += 1.0/eventsPerSecond
+        startTime = time.perf_counter()
+        if (eventsPerBatch > 1) and ((event % eventsPerBatch) == 0):
+            model.beginAlignChange()
+        dragEvent(model, event)
+        if (eventsPerBatch > 1) and (((event + 1) % eventsPerBatch == 0) or (event == eventCount - 1)):
+            model.endAlignChange()
+        eventSeconds.append(time.perf_counter() - startTime)
+    model.flushAlignChanges()
+    model.setAlignSettingsChangeCallback(None)
+    return eventSeconds, updates[0]
+
+
+def main():
+    modelFileName, pointCloudFileName = sys.argv[1:3]
+    eventCount = int(sys.argv[3]) if len(sys.argv) > 3 else 600
+    eventsPerSecond = float(sys.argv[4]) if len(sys.argv) > 4 else 120.0
+    updateInterval = float(sys.argv[5]) if len(sys.argv) > 5 else 0.033
+    model = SmoothfitModel()
+    model.setZincModelFile(modelFileName)
+    model.setZincPointCloudFile(pointCloudFileName)
+    model.initialise()
+    framesPerSecond = 1.0/updateInterval
+    eventsPerFrame = max(1, int(round(eventsPerSecond/framesPerSecond)))
+    for name, interval, eventsPerBatch in [
+            ('immediate', 0.0, 1),
+            ('batched {:d} per frame'.format(eventsPerFrame), 0.0, eventsPerFrame),
+            ('rate limited {:.3g} s'.format(updateInterval), updateInterval, 1)]:
+        model.setAlignUpdateInterval(interval)
+        eventSeconds, updates = runDrag(model, eventCount, eventsPerSecond, eventsPerBatch)
+        eventMilliseconds = 1000.0*numpy.array(eventSeconds)
+        print('{:28s} events {:5d}  updates {:5d}  event ms mean {:7.3f}  p95 {:7.3f}  max {:7.3f}  total {:8.3f} s'.format(
+            name, eventCount, updates, numpy.mean(eventMilliseconds), numpy.percentile(eventMilliseconds, 95),
+            numpy.max(eventMilliseconds), numpy.sum(eventSeconds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+Time cold and warm-started batch projection of near-surface points onto a
+synthetic bicubic surface mesh, and compare warm-started results with a
+full search after the surface moves. Usage:
+
+    python benchmarks/batch_projection_benchmark.py [number_of_points [elements_per_side]]
+'''
+import sys
+import time
+
+import numpy
+
+from mapclientplugins.smoothfitstep.maths.elementpatches import ElementPatches, patchXi
+from mapclientplugins.smoothfitstep.maths.spatialindex import MeshSpatialIndex
+
+
+def surface(x, y, phase=0.0):
+    return 0.5*numpy.sin(0.7*x + phase)*numpy.cos(0.5*y) + 0.1*x
+
+
+def createPatches(elementsPerSide, phase=0.0):
+    '''
+    :return: ElementPatches for a bumpy square surface of side elementsPerSide
+    '''
+    xi = patchXi(2)
+    controlPoints = []
+    for j in range(elementsPerSide):
+        for i in range(elementsPerSide):
+            x = i + xi[:, 0]
+            y = j + xi[:, 1]
+            controlPoints.append(numpy.stack([x, y, surface(x, y, phase)], axis=1))
+    return ElementPatches(numpy.arange(1, elementsPerSide*elementsPerSide + 1), numpy.array(controlPoints), 2)
+
+
+def timeCall(function):
+    startTime = time.perf_counter()
+    result = function()
+    return time.perf_counter() - startTime, result
+
+
+def main():
+    pointCount = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    elementsPerSide = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rng = numpy.random.default_rng(0)
+    x = rng.uniform(0.0, elementsPerSide, pointCount)
+    y = rng.uniform(0.0, elementsPerSide, pointCount)
+    points = numpy.stack([x, y, surface(x, y) + rng.normal(0.0, 0.05, pointCount)], axis=1)
+    index = MeshSpatialIndex(createPatches(elementsPerSide))
+    print('{:d} points, {:d} elements'.format(pointCount, elementsPerSide*elementsPerSide))
+    seconds, (elementIndexes, xi, distances) = timeCall(lambda: index.findNearestLocations(points))
+    print('{:24s} {:8.3f} s  {:7.2f} us per point'.format('cold', seconds, 1.0E6*seconds/pointCount))
+    movedIndex = MeshSpatialIndex(createPatches(elementsPerSide, phase=0.05))
+    seconds, (fullElementIndexes, fullXi, fullDistances) = timeCall(lambda: movedIndex.findNearestLocations(points))
+    print('{:24s} {:8.3f} s  {:7.2f} us per point'.format('cold after move', seconds, 1.0E6*seconds/pointCount))
+    seconds, (warmElementIndexes, warmXi, warmDistances, outsideCount) = timeCall(
+        lambda: movedIndex.findNearestLocationsLocal(points, elementIndexes, xi, distances))
+    print('{:24s} {:8.3f} s  {:7.2f} us per point  searched outside patch {:d}'.format(
+        'warm after move', seconds, 1.0E6*seconds/pointCount, outsideCount))
+    excess = warmDistances - fullDistances
+    print('warm further than full search: {:d} points, max {:.3g}'.format(
+        int(numpy.count_nonzero(excess > 1.0E-9)), max(float(numpy.max(excess)), 0.0)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+'''
+Time clearing data projections, as on every return to the align page,
+against undefining stored mesh locations at every data point as clearing
+did before, and time the next projection which undefines stale
+locations. Usage:
+
+    python benchmarks/clear_projections_benchmark.py model.exf points.exf
+
+Use a point cloud of 1 million data points to compare with large scans.
+'''
+import sys
+import time
+
+from opencmiss.zinc.field import Field
+
+from mapclientplugins.smoothfitstep.model.smoothfitmodel import SmoothfitModel
+from mapclientplugins.smoothfitstep.utils import zinc as zincutils
+
+
+def timeCall(name, function):
+    startTime = time.perf_counter()
+    function()
+    print('{:36s} {:9.4f} s'.format(name, time.perf_counter() - startTime))
+
+
+def undefineAllStoredMeshLocations(model):
+    '''
+    Undefine stored mesh locations at every data point, as clearing
+    projections did before.
+    '''
+    fm = model._region.getFieldmodule()
+    datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+    identifiers = zincutils.getNodesetFieldValues(datapoints, model._dataCoordinateField)[0]
+    zincutils.undefineNodeField(datapoints, model._storedMeshLocationField, identifiers)
+
+
+def main():
+    modelFileName, pointCloudFileName = sys.argv[1:3]
+    model = SmoothfitModel()
+    model.setZincModelFile(modelFileName)
+    model.setZincPointCloudFile(pointCloudFileName)
+    model.initialise()
+    model.setStatePostAlign()
+    fm = model._region.getFieldmodule()
+    datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+    print('{:d} data points'.format(datapoints.getSize()))
+    timeCall('project', model.calculateDataProjections)
+    timeCall('undefine at all data points', lambda: undefineAllStoredMeshLocations(model))
+    timeCall('project', model.calculateDataProjections)
+    timeCall('clear projections', model.clearDataProjections)
+    timeCall('clear projections again', model.clearDataProjections)
+    timeCall('project after clear', model.calculateDataProjections)
+    model.filterTopError()
+    timeCall('clear projections after filter', model.clearDataProjections)
+
+
+if __name__ == '__main__':
+    main()
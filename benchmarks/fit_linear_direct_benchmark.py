@@ -0,0 +1,57 @@
+'''
+Compare the linear direct fit with the quasi-Newton fit of a model to a
+point cloud, from the same data point projections. Usage:
+
+    python benchmarks/fit_linear_direct_benchmark.py model.exf points.exf [strain_penalty [curvature_penalty [max_iterations]]]
+'''
+import sys
+
+import numpy
+
+from mapclientplugins.smoothfitstep.model.smoothfitmodel import SmoothfitModel
+from mapclientplugins.smoothfitstep.utils import zinc as zincutils
+
+
+def runFit(modelFileName, pointCloudFileName, method, strainPenalty, curvaturePenalty, maxIterations):
+    '''
+    :return: fit report, fitted nodal parameter layout and values
+    '''
+    model = SmoothfitModel()
+    model.setZincModelFile(modelFileName)
+    model.setZincPointCloudFile(pointCloudFileName)
+    model.initialise()
+    model.setStatePostAlign()
+    model.calculateDataProjections()
+    model.setFitMethod(method)
+    model.setFitStrainPenalty(strainPenalty)
+    model.setFitCurvaturePenalty(curvaturePenalty)
+    model.setFitMaxIterations(maxIterations)
+    model.fit()
+    success, layout, parameters = zincutils.getNodalParameters(model.getModelCoordinateField())
+    return model.getFitReport(), layout, parameters
+
+
+def main():
+    modelFileName, pointCloudFileName = sys.argv[1:3]
+    strainPenalty = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    curvaturePenalty = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    maxIterations = int(sys.argv[5]) if len(sys.argv) > 5 else 5
+    results = {}
+    for method in [SmoothfitModel.FIT_METHOD_QUASI_NEWTON, SmoothfitModel.FIT_METHOD_LINEAR_DIRECT]:
+        results[method] = runFit(modelFileName, pointCloudFileName, method, strainPenalty, curvaturePenalty, maxIterations)
+        report = results[method][0]
+        print('{:14s} {:10.3f} s mean error {:12.6g} max error {:12.6g}'.format(
+            method, report['seconds'], report['mean_error'], report['max_error']))
+    quasiNewtonReport, quasiNewtonLayout, quasiNewtonParameters = results[SmoothfitModel.FIT_METHOD_QUASI_NEWTON]
+    directReport, directLayout, directParameters = results[SmoothfitModel.FIT_METHOD_LINEAR_DIRECT]
+    if directReport['method'] != SmoothfitModel.FIT_METHOD_LINEAR_DIRECT:
+        print('Linear direct fit was not supported for this model')
+    elif numpy.array_equal(quasiNewtonLayout, directLayout):
+        print('objective {:.6g} -> {:.6g}, {:d} of {:d} parameters free'.format(directReport['objective_before'],
+            directReport['objective'], directReport['free_parameters'], directReport['parameters']))
+        print('maximum nodal parameter difference {:.6g}'.format(numpy.max(numpy.abs(quasiNewtonParameters - directParameters))))
+        print('speedup {:.3g}x'.format(quasiNewtonReport['seconds']/directReport['seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+'''
+Compare a quasi-Newton fit optimised in one call with the same fit
+optimised in blocks of FIT_PROGRESS_ITERATIONS iterations, between which
+progress is reported and cancel checked. Usage:
+
+    python benchmarks/fit_progress_blocks_benchmark.py model.exf points.exf [strain_penalty [curvature_penalty [max_iterations]]]
+'''
+import sys
+
+import numpy
+
+from mapclientplugins.smoothfitstep.model.smoothfitmodel import SmoothfitModel
+from mapclientplugins.smoothfitstep.utils import zinc as zincutils
+
+
+def runFit(modelFileName, pointCloudFileName, progressIterations, strainPenalty, curvaturePenalty, maxIterations):
+    '''
+    :return: fit report, number of progress reports, fitted nodal parameters
+    '''
+    model = SmoothfitModel()
+    model.FIT_PROGRESS_ITERATIONS = progressIterations
+    model.setZincModelFile(modelFileName)
+    model.setZincPointCloudFile(pointCloudFileName)
+    model.initialise()
+    model.setStatePostAlign()
+    model.calculateDataProjections()
+    model.setFitMethod(SmoothfitModel.FIT_METHOD_QUASI_NEWTON)
+    model.setFitStrainPenalty(strainPenalty)
+    model.setFitCurvaturePenalty(curvaturePenalty)
+    model.setFitMaxIterations(maxIterations)
+    model.setFitTelemetry(True)
+    progressReports = []
+    model.setProgressCallback(lambda description, done, total: progressReports.append(done))
+    model.fit()
+    success, layout, parameters = zincutils.getNodalParameters(model.getModelCoordinateField())
+    return model.getFitReport(), len(progressReports), parameters
+
+
+def main():
+    modelFileName, pointCloudFileName = sys.argv[1:3]
+    strainPenalty = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    curvaturePenalty = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    maxIterations = int(sys.argv[5]) if len(sys.argv) > 5 else 100
+    results = []
+    for progressIterations in [maxIterations, SmoothfitModel.FIT_PROGRESS_ITERATIONS]:
+        report, progressCount, parameters = runFit(modelFileName, pointCloudFileName, progressIterations,
+                                                   strainPenalty, curvaturePenalty, maxIterations)
+        objective = sum(term['value'] for term in report['objectives'].values())
+        print('{:4d} iterations per call: {:10.3f} s {:4d} iterations {:4d} progress reports objective {:.10g}'.format(
+            progressIterations, report['seconds'], report['iterations'], progressCount, objective))
+        results.append((objective, parameters))
+    print('objective relative difference {:.3g}, maximum nodal parameter difference {:.3g}'.format(
+        abs(results[1][0] - results[0][0])/max(abs(results[0][0]), 1.0E-300),
+        numpy.max(numpy.abs(results[1][1] - results[0][1]))))
+
+
+if __name__ == '__main__':
+    main()
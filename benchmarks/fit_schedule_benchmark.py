@@ -0,0 +1,51 @@
+'''
+Compare time to reach a target RMS error for single resolution fitting
+against a coarse-to-fine fit schedule, starting each from the same model
+and point cloud. Usage:
+
+    python benchmarks/fit_schedule_benchmark.py model.exf points.exf target_rms_error [coarse_spacing [strain_penalty [curvature_penalty]]]
+
+The schedule has two coarse stages: decimation spacing coarse_spacing with
+penalties scaled by 100, then coarse_spacing/2 with penalties scaled by 10.
+'''
+import sys
+
+from mapclientplugins.smoothfitstep.model.smoothfitmodel import SmoothfitModel
+
+
+def runFit(modelFileName, pointCloudFileName, targetRmsError, strainPenalty, curvaturePenalty, schedule):
+    model = SmoothfitModel()
+    model.setZincModelFile(modelFileName)
+    model.setZincPointCloudFile(pointCloudFileName)
+    model.initialise()
+    model.setStatePostAlign()
+    model.setFitStrainPenalty(strainPenalty)
+    model.setFitCurvaturePenalty(curvaturePenalty)
+    model.setFitOuterMaxIterations(50)
+    model.setFitOuterRmsErrorTolerance(targetRmsError)
+    model.setFitSchedule(schedule)
+    converged = model.fitIterate()
+    history = model.getFitHistory()
+    return converged, history[-1]['elapsed'], len(history), history[-1]['rms_error']
+
+
+def main():
+    modelFileName, pointCloudFileName = sys.argv[1:3]
+    targetRmsError = float(sys.argv[3])
+    coarseSpacing = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+    strainPenalty = float(sys.argv[5]) if len(sys.argv) > 5 else 0.01
+    curvaturePenalty = float(sys.argv[6]) if len(sys.argv) > 6 else 0.01
+    schedules = [
+        ('single resolution', []),
+        ('coarse-to-fine', [
+            dict(outer_iterations=2, decimation_spacing=coarseSpacing, penalty_scale=100.0),
+            dict(outer_iterations=2, decimation_spacing=0.5*coarseSpacing, penalty_scale=10.0)])]
+    for name, schedule in schedules:
+        converged, seconds, iterations, rmsError = runFit(modelFileName, pointCloudFileName, targetRmsError,
+                                                          strainPenalty, curvaturePenalty, schedule)
+        print('{:18s} {:10.3f} s {:4d} iterations  RMS error {:.6g}{}'.format(
+            name, seconds, iterations, rmsError, '' if converged else '  (target not reached)'))
+
+
+if __name__ == '__main__':
+    main()
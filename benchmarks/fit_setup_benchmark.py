@@ -0,0 +1,36 @@
+'''
+Measure quasi-Newton fit setup time and number of fields in the field
+module over repeated fits, as in an iterated project and fit. Usage:
+
+    python benchmarks/fit_setup_benchmark.py model.exf points.exf [number_of_fits [strain_penalty [curvature_penalty]]]
+'''
+import sys
+
+from mapclientplugins.smoothfitstep.model.smoothfitmodel import SmoothfitModel
+
+
+def main():
+    modelFileName, pointCloudFileName = sys.argv[1:3]
+    fitCount = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    strainPenalty = float(sys.argv[4]) if len(sys.argv) > 4 else 0.01
+    curvaturePenalty = float(sys.argv[5]) if len(sys.argv) > 5 else 0.01
+    model = SmoothfitModel()
+    model.setZincModelFile(modelFileName)
+    model.setZincPointCloudFile(pointCloudFileName)
+    model.initialise()
+    model.setStatePostAlign()
+    model.setFitMethod(SmoothfitModel.FIT_METHOD_QUASI_NEWTON)
+    model.setFitMaxIterations(1)
+    model.setFitCurvaturePenalty(curvaturePenalty)
+    for fit in range(fitCount):
+        # vary a weight to exercise in-place weight updates
+        model.setFitStrainPenalty(strainPenalty*(1.0 + 0.1*(fit % 2)))
+        model.calculateDataProjections()
+        model.fit()
+        report = model.getFitReport()
+        print('fit {:3d} setup {:8.4f} s  fit {:8.3f} s  fields {:5d} -> {:5d}'.format(
+            fit + 1, report['setup_seconds'], report['seconds'], report['fields_before'], report['fields_after']))
+
+
+if __name__ == '__main__':
+    main()
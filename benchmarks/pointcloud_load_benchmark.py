@@ -0,0 +1,81 @@
+'''
+Compare point cloud load time and peak memory for EX, .npy and .ptcl files.
+
+Each load runs in a fresh python process so peak resident set size is
+measured for that load alone. Usage:
+
+    python benchmarks/pointcloud_load_benchmark.py [number_of_points]
+'''
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy
+from opencmiss.zinc.context import Context
+from opencmiss.zinc.field import Field
+
+from mapclientplugins.smoothfitstep.utils import pointcloud
+from mapclientplugins.smoothfitstep.utils import zinc as zincutils
+
+LOAD_SCRIPT = '''
+import resource, sys, time
+from opencmiss.zinc.context import Context
+from opencmiss.zinc.field import Field
+from mapclientplugins.smoothfitstep.utils import pointcloud
+from mapclientplugins.smoothfitstep.utils import zinc as zincutils
+fileName = sys.argv[1]
+region = Context('benchmark').getDefaultRegion()
+fm = region.getFieldmodule()
+startTime = time.perf_counter()
+if pointcloud.isBinaryPointCloudFile(fileName):
+    field = fm.createFieldFiniteElement(3)
+    field.setName('data_coordinates')
+    field.setTypeCoordinate(True)
+    datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+    zincutils.createNodesWithFieldValues(datapoints, field, pointcloud.openBinaryPointCloud(fileName))
+else:
+    sir = region.createStreaminformationRegion()
+    resource_ = sir.createStreamresourceFile(fileName)
+    sir.setResourceDomainTypes(resource_, Field.DOMAIN_TYPE_DATAPOINTS)
+    region.read(sir)
+seconds = time.perf_counter() - startTime
+print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def writeExPointCloud(fileName, coordinates):
+    region = Context('benchmark').getDefaultRegion()
+    fm = region.getFieldmodule()
+    field = fm.createFieldFiniteElement(3)
+    field.setName('data_coordinates')
+    field.setTypeCoordinate(True)
+    datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+    zincutils.createNodesWithFieldValues(datapoints, field, coordinates)
+    sir = region.createStreaminformationRegion()
+    resource_ = sir.createStreamresourceFile(fileName)
+    sir.setResourceDomainTypes(resource_, Field.DOMAIN_TYPE_DATAPOINTS)
+    region.write(sir)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    coordinates = numpy.random.default_rng(0).random((count, 3))
+    with tempfile.TemporaryDirectory() as directory:
+        files = [
+            ('EX', os.path.join(directory, 'points.exdata')),
+            ('npy float64', os.path.join(directory, 'points.npy')),
+            ('ptcl float32', os.path.join(directory, 'points.ptcl'))]
+        writeExPointCloud(files[0][1], coordinates)
+        pointcloud.writeBinaryPointCloud(files[1][1], coordinates, numpy.float64)
+        pointcloud.writeBinaryPointCloud(files[2][1], coordinates, numpy.float32)
+        print('{:d} points'.format(count))
+        for name, fileName in files:
+            output = subprocess.check_output([sys.executable, '-c', LOAD_SCRIPT, fileName])
+            seconds, maxrss = output.split()
+            print('{:14s} {:10.3f} s {:10.1f} MB peak RSS {:10.1f} MB file'.format(
+                name, float(seconds), int(maxrss)/1024.0, os.path.getsize(fileName)/1048576.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''
+Time setting, getting and clearing projections in the data projection
+store, and report its memory per million data points. Usage:
+
+    python benchmarks/projection_store_benchmark.py [number_of_points [dimension]]
+'''
+import sys
+import time
+
+import numpy
+
+from mapclientplugins.smoothfitstep.model.projectionstore import DataProjectionStore
+
+
+def timeCall(function):
+    startTime = time.perf_counter()
+    result = function()
+    return time.perf_counter() - startTime, result
+
+
+def main():
+    pointCount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    dimension = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    rng = numpy.random.default_rng(0)
+    identifiers = numpy.arange(1, pointCount + 1, dtype=numpy.int32)
+    elementIdentifiers = rng.integers(1, 1000, pointCount, dtype=numpy.int32)
+    xi = rng.random((pointCount, dimension))
+    store = DataProjectionStore(dimension)
+    # a warm-started update re-projects a subset of points
+    subset = numpy.sort(rng.choice(identifiers, pointCount//10, replace=False))
+    for name, function in [
+            ('set all', lambda: store.setProjections(identifiers, elementIdentifiers, xi)),
+            ('get all', lambda: store.getProjections(identifiers)),
+            ('get unsynced', store.getUnsyncedProjections),
+            ('set synced', store.setSynced),
+            ('set 10%', lambda: store.setProjections(subset, elementIdentifiers[subset - 1], xi[subset - 1])),
+            ('get unsynced 10%', store.getUnsyncedProjections)]:
+        seconds = timeCall(function)[0]
+        print('{:20s} {:9.4f} s'.format(name, seconds))
+    report = store.getMemoryReport()
+    print('{:d} points, {:d} projections, {:.1f} MB, {:.2f} MB per million points'.format(
+        report['data_points'], report['projections'], 1.0E-6*report['bytes'],
+        1.0E-6*report['bytes_per_million_points']))
+    seconds = timeCall(store.clear)[0]
+    print('{:20s} {:9.6f} s'.format('clear', seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+Compare batched numpy vectorops functions with per-point loops over the
+python list functions, and time scalar functions on single vectors.
+Usage:
+
+    python benchmarks/vectorops_benchmark.py [number_of_points]
+'''
+import sys
+import time
+
+import numpy
+
+from mapclientplugins.smoothfitstep.maths import vectorops
+
+
+def listMatrixmult(a, b):
+    '''
+    Pure python matrixmult, as before it used numpy.
+    '''
+    return [vectorops.vectormatrixmult(row_a, b) for row_a in a]
+
+
+def timeCall(function, repeats=1):
+    startTime = time.perf_counter()
+    for repeat in range(repeats):
+        result = function()
+    return (time.perf_counter() - startTime)/repeats, result
+
+
+def main():
+    pointCount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = numpy.random.default_rng(0)
+    points = rng.normal(size=(pointCount, 3))
+    eulerAngles = numpy.stack([rng.uniform(-numpy.pi, numpy.pi, pointCount),
+                               rng.uniform(-0.5*numpy.pi, 0.5*numpy.pi, pointCount),
+                               rng.uniform(-numpy.pi, numpy.pi, pointCount)], axis=1)
+    matrix = vectorops.matrixconstantmult(vectorops.eulerToRotationMatrix3([0.1, 0.2, 0.3]), 2.0)
+    offset = [1.0, 2.0, 3.0]
+    pointsList = points.tolist()
+    eulerAnglesList = eulerAngles.tolist()
+    matrices = vectorops.eulerToRotationMatrices3(eulerAngles)
+    matricesList = matrices.tolist()
+    cases = [
+        ('magnitude',
+         lambda: [vectorops.magnitude(point) for point in pointsList],
+         lambda: vectorops.magnitudes(points)),
+        ('eulerToRotationMatrix3',
+         lambda: [vectorops.eulerToRotationMatrix3(angles) for angles in eulerAnglesList],
+         lambda: vectorops.eulerToRotationMatrices3(eulerAngles)),
+        ('rotationMatrix3ToEuler',
+         lambda: [vectorops.rotationMatrix3ToEuler(rotation) for rotation in matricesList],
+         lambda: vectorops.rotationMatrices3ToEuler(matrices)),
+        ('transform by matrix',
+         lambda: [vectorops.add(vectorops.matrixvectormult(matrix, point), offset) for point in pointsList],
+         lambda: vectorops.transformPoints(points, matrix, offset)),
+        ('transform by matrix stack',
+         lambda: [vectorops.add(vectorops.matrixvectormult(rotation, point), offset)
+                  for rotation, point in zip(matricesList, pointsList)],
+         lambda: vectorops.transformPoints(points, matrices, offset)),
+    ]
+    print('{:d} points'.format(pointCount))
+    for name, listFunction, batchFunction in cases:
+        listSeconds, listResult = timeCall(listFunction)
+        batchSeconds, batchResult = timeCall(batchFunction, 5)
+        difference = numpy.max(numpy.abs(numpy.array(listResult) - batchResult))
+        print('{:28s} list {:9.4f} s  batched {:9.5f} s  speedup {:8.1f}  max difference {:.2e}'.format(
+            name, listSeconds, batchSeconds, listSeconds/batchSeconds, difference))
+    repeats = 100000
+    u = [1.0, 2.0, 3.0]
+    v = [4.0, 5.0, 6.0]
+    scalarCases = [
+        ('add', lambda: vectorops.add(u, v)),
+        ('magnitude', lambda: vectorops.magnitude(u)),
+        ('eulerToRotationMatrix3', lambda: vectorops.eulerToRotationMatrix3(u)),
+        ('matrixmult (list)', lambda: listMatrixmult(matrix, matrix)),
+        ('matrixmult (numpy)', lambda: vectorops.matrixmult(matrix, matrix)),
+    ]
+    for name, function in scalarCases:
+        seconds = timeCall(function, repeats)[0]
+        print('{:28s} scalar {:8.3f} us'.format(name, 1.0E6*seconds))
+
+
+if __name__ == '__main__':
+    main()
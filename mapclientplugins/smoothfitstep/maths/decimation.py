@@ -0,0 +1,84 @@
+'''
+Vectorised point cloud decimation, returning the indexes of points to keep
+so that decimated points can be restored later.
+'''
+import numpy
+from scipy.spatial import cKDTree
+
+
+def _gridCells(coordinates, cellSize):
+    '''
+    :return: integer cell indexes (N, components), and cell number (N,) unique to each cell
+    '''
+    cells = numpy.floor((coordinates - coordinates.min(axis=0))/cellSize).astype(numpy.int64)
+    cellNumbers = numpy.unique(cells, axis=0, return_inverse=True)[1].ravel()
+    return cells, cellNumbers
+
+
+def voxelGridDecimate(coordinates, spacing):
+    '''
+    Keep one point per cubic voxel of side spacing: the point closest to
+    the mean of the points in the voxel.
+    :param coordinates: (N, components) point coordinates
+    :param spacing: voxel size
+    :return: sorted indexes of points to keep
+    '''
+    coordinates = numpy.asarray(coordinates, dtype=numpy.float64)
+    if coordinates.shape[0] == 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    cells, cellNumbers = _gridCells(coordinates, spacing)
+    counts = numpy.bincount(cellNumbers)
+    means = numpy.stack([numpy.bincount(cellNumbers, weights=coordinates[:, c])
+                         for c in range(coordinates.shape[1])], axis=1)/counts[:, numpy.newaxis]
+    delta = coordinates - means[cellNumbers]
+    distanceSquared = numpy.sum(delta*delta, axis=1)
+    order = numpy.lexsort((distanceSquared, cellNumbers))
+    first = numpy.ones(order.size, dtype=bool)
+    first[1:] = cellNumbers[order[1:]] != cellNumbers[order[:-1]]
+    return numpy.sort(order[first])
+
+
+def poissonDiskDecimate(coordinates, spacing, seed=0):
+    '''
+    Keep a random subset of points no closer than spacing to each other,
+    with every removed point within spacing of a kept point.
+    Candidates are chosen one per grid cell of size spacing/sqrt(dimension),
+    and cells are processed in interleaved classes whose candidates are
+    all further than spacing apart, so each class is accepted in one step.
+    :param coordinates: (N, components) point coordinates
+    :param spacing: minimum distance between kept points
+    :param seed: random seed, for reproducible results
+    :return: sorted indexes of points to keep
+    '''
+    coordinates = numpy.asarray(coordinates, dtype=numpy.float64)
+    count, dimension = coordinates.shape
+    if count == 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    cellSize = spacing/numpy.sqrt(dimension)
+    cells, cellNumbers = _gridCells(coordinates, cellSize)
+    interleaveClasses = numpy.sum((cells % 3)*(3**numpy.arange(dimension)), axis=1)
+    randomOrder = numpy.random.default_rng(seed).permutation(count)
+    kept = []
+    keptTree = None
+    remaining = numpy.ones(count, dtype=bool)
+    while numpy.any(remaining):
+        candidateOrder = randomOrder[remaining[randomOrder]]
+        # one random candidate per cell
+        cellCandidates = numpy.unique(cellNumbers[candidateOrder], return_index=True)[1]
+        candidates = candidateOrder[cellCandidates]
+        for interleaveClass in range(3**dimension):
+            classCandidates = candidates[interleaveClasses[candidates] == interleaveClass]
+            if classCandidates.size == 0:
+                continue
+            if keptTree is not None:
+                distances = keptTree.query(coordinates[classCandidates], distance_upper_bound=spacing)[0]
+                classCandidates = classCandidates[distances >= spacing]
+            if classCandidates.size > 0:
+                kept.append(classCandidates)
+                keptTree = cKDTree(coordinates[numpy.concatenate(kept)])
+        # remove all points covered by kept points
+        remainingIndexes = numpy.flatnonzero(remaining)
+        distances = keptTree.query(coordinates[remainingIndexes], distance_upper_bound=spacing)[0]
+        remaining[remainingIndexes[distances < spacing]] = False
+        remaining[kept[-1]] = False
+    return numpy.sort(numpy.concatenate(kept))
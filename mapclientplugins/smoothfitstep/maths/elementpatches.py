@@ -0,0 +1,368 @@
+'''
+Vectorised representation of a mesh's coordinate field for bulk
+evaluation and nearest location queries with numpy.
+
+Each element is stored as a tensor product cubic Lagrange patch
+interpolating coordinates at 4 evenly spaced xi in each direction.
+This is exact for linear, quadratic and cubic Lagrange and for cubic
+Hermite elements, since all are polynomials of at most cubic degree
+in each xi direction.
+'''
+from math import comb
+import numpy
+from scipy.spatial import cKDTree
+
+PATCH_NODES = numpy.array([0.0, 1.0/3.0, 2.0/3.0, 1.0])
+
+
+def _lagrangeMonomialCoefficients():
+    '''
+    :return: 4x4 matrix M with basis values L(t) = [1, t, t^2, t^3] . M
+    '''
+    vandermonde = numpy.vander(PATCH_NODES, 4, increasing=True)
+    return numpy.linalg.inv(vandermonde)
+
+_LAGRANGE_COEFFICIENTS = _lagrangeMonomialCoefficients()
+
+
+def _lagrangeToBernsteinMatrix():
+    '''
+    :return: 4x4 matrix converting cubic Lagrange control values to Bernstein
+    (Bezier) control values, whose convex hull contains the curve.
+    '''
+    monomialToBernstein = numpy.zeros((4, 4))
+    for j in range(4):
+        for i in range(j + 1):
+            monomialToBernstein[j, i] = comb(j, i)/comb(3, i)
+    return monomialToBernstein.dot(_LAGRANGE_COEFFICIENTS)
+
+_LAGRANGE_TO_BERNSTEIN = _lagrangeToBernsteinMatrix()
+
+
+def lagrangeBasis(t, derivatives=0):
+    '''
+    Evaluate cubic Lagrange basis functions and derivatives at parameters t.
+    :param t: array of N parameter values
+    :param derivatives: highest derivative to evaluate, 0 to 2
+    :return: list of (N, 4) arrays: values, then first and second derivatives
+    '''
+    t = numpy.asarray(t, dtype=numpy.float64)
+    one = numpy.ones_like(t)
+    zero = numpy.zeros_like(t)
+    result = [numpy.stack([one, t, t*t, t*t*t], axis=-1).dot(_LAGRANGE_COEFFICIENTS)]
+    if derivatives > 0:
+        result.append(numpy.stack([zero, one, 2.0*t, 3.0*t*t], axis=-1).dot(_LAGRANGE_COEFFICIENTS))
+    if derivatives > 1:
+        result.append(numpy.stack([zero, zero, 2.0*one, 6.0*t], axis=-1).dot(_LAGRANGE_COEFFICIENTS))
+    return result
+
+
+def patchXi(dimension, pointsPerDirection=4):
+    '''
+    :return: (pointsPerDirection**dimension, dimension) array of xi on a regular
+    grid including element boundaries, varying fastest in xi1.
+    '''
+    t = numpy.linspace(0.0, 1.0, pointsPerDirection)
+    grids = numpy.meshgrid(*([t]*dimension), indexing='ij')
+    return numpy.stack([grid.ravel() for grid in reversed(grids)], axis=-1)
+
+
+def tensorBasisWeights(xi, derivatives=0):
+    '''
+    Evaluate tensor product cubic Lagrange patch basis functions, ordered
+    as control points at patchXi, for any element dimension.
+    :param xi: (N, dimension) element chart locations
+    :param derivatives: highest derivative to evaluate, 0 to 2
+    :return: list of weight arrays for values (N, K), first derivatives
+    (N, dim, K) and second derivatives (N, dim, dim, K) where K = 4**dim.
+    '''
+    n, dimension = xi.shape
+    bases = [lagrangeBasis(xi[:, d], derivatives) for d in range(dimension)]
+
+    def tensor(orders):
+        weights = bases[dimension - 1][orders[dimension - 1]]
+        for d in range(dimension - 2, -1, -1):
+            weights = numpy.einsum('ni,nj->nij', weights, bases[d][orders[d]]).reshape(n, -1)
+        return weights
+
+    result = [tensor([0]*dimension)]
+    if derivatives > 0:
+        first = numpy.empty((n, dimension, 4**dimension))
+        for i in range(dimension):
+            orders = [0]*dimension
+            orders[i] = 1
+            first[:, i, :] = tensor(orders)
+        result.append(first)
+    if derivatives > 1:
+        second = numpy.empty((n, dimension, dimension, 4**dimension))
+        for i in range(dimension):
+            for j in range(i, dimension):
+                orders = [0]*dimension
+                orders[i] += 1
+                orders[j] += 1
+                second[:, i, j, :] = second[:, j, i, :] = tensor(orders)
+        result.append(second)
+    return result
+
+
+def _isPositiveDefinite(matrices):
+    '''
+    Sylvester's criterion for a stack of symmetric matrices up to 3x3.
+    :return: boolean array, True where matrix is positive definite
+    '''
+    size = matrices.shape[1]
+    result = matrices[:, 0, 0] > 0.0
+    if size > 1:
+        result &= (matrices[:, 0, 0]*matrices[:, 1, 1] - matrices[:, 0, 1]*matrices[:, 1, 0]) > 0.0
+    if size > 2:
+        result &= numpy.linalg.det(matrices) > 0.0
+    return result
+
+
+class ElementPatches(object):
+    '''
+    Cubic Lagrange control points for all elements of a mesh.
+    '''
+
+    def __init__(self, elementIdentifiers, controlPoints, dimension):
+        '''
+        :param elementIdentifiers: E element identifiers
+        :param controlPoints: (E, 4**dimension, components) coordinates at patchXi(dimension)
+        :param dimension: element dimension 1, 2 or 3
+        '''
+        self._elementIdentifiers = numpy.asarray(elementIdentifiers, dtype=numpy.int32)
+        self._controlPoints = numpy.asarray(controlPoints, dtype=numpy.float64)
+        self._dimension = dimension
+
+    def getDimension(self):
+        return self._dimension
+
+    def getElementIdentifiers(self):
+        return self._elementIdentifiers
+
+    def getControlPoints(self):
+        return self._controlPoints
+
+    def getNumberOfElements(self):
+        return self._elementIdentifiers.shape[0]
+
+    def getNumberOfComponents(self):
+        return self._controlPoints.shape[2]
+
+    def getElementDisplacements(self, previousPatches):
+        '''
+        Get how far each element has moved relative to earlier patches of the same mesh.
+        :param previousPatches: ElementPatches for same elements at an earlier time
+        :return: maximum control point displacement for each element (E,),
+        or None if elements differ
+        '''
+        if not numpy.array_equal(self._elementIdentifiers, previousPatches.getElementIdentifiers()):
+            return None
+        delta = self._controlPoints - previousPatches.getControlPoints()
+        return numpy.sqrt(numpy.max(numpy.sum(delta*delta, axis=2), axis=1))
+
+    def getElementIndexes(self, elementIdentifiers):
+        '''
+        :param elementIdentifiers: array of element identifiers
+        :return: array of indexes of elements, -1 where not found
+        '''
+        elementIdentifiers = numpy.asarray(elementIdentifiers)
+        order = numpy.argsort(self._elementIdentifiers)
+        sortedIdentifiers = self._elementIdentifiers[order]
+        positions = numpy.minimum(numpy.searchsorted(sortedIdentifiers, elementIdentifiers), sortedIdentifiers.size - 1)
+        return numpy.where(sortedIdentifiers[positions] == elementIdentifiers, order[positions], -1)
+
+    def getAdjacency(self, tolerance):
+        '''
+        Find elements sharing a corner with each element, including itself.
+        :param tolerance: distance within which corners are considered coincident
+        :return: offsets (E + 1,), adjacentElementIndexes: the elements adjacent
+        to element e are adjacentElementIndexes[offsets[e]:offsets[e + 1]]
+        '''
+        dimension = self._dimension
+        elementCount = self.getNumberOfElements()
+        corners = [sum(c*3*4**d for d, c in enumerate(reversed(bits)))
+                   for bits in numpy.ndindex(*((2,)*dimension))]
+        cornerCoordinates = self._controlPoints[:, corners, :].reshape(-1, self.getNumberOfComponents())
+        cornerElements = numpy.repeat(numpy.arange(elementCount), len(corners))
+        cornerPairs = cKDTree(cornerCoordinates).query_pairs(tolerance, output_type='ndarray')
+        elementPairs = numpy.concatenate([
+            numpy.stack([numpy.arange(elementCount)]*2, axis=1),
+            cornerElements[cornerPairs], cornerElements[cornerPairs[:, ::-1]]])
+        pairs = numpy.unique(elementPairs, axis=0)
+        adjacencyOffsets = numpy.searchsorted(pairs[:, 0], numpy.arange(elementCount + 1))
+        return adjacencyOffsets, pairs[:, 1]
+
+    def _getBernsteinBoundingBoxes(self, controlPoints):
+        '''
+        :param controlPoints: (E, 4**dimension, components) Lagrange control points
+        :return: minimums (E, components), maximums (E, components) of the
+        equivalent Bezier control points
+        '''
+        dimension = self._dimension
+        elementCount, pointCount, componentCount = controlPoints.shape
+        points = controlPoints.reshape((elementCount,) + (4,)*dimension + (componentCount,))
+        for axis in range(1, dimension + 1):
+            points = numpy.moveaxis(numpy.tensordot(_LAGRANGE_TO_BERNSTEIN, points, axes=([1], [axis])), 0, axis)
+        points = points.reshape(elementCount, pointCount, componentCount)
+        return points.min(axis=1), points.max(axis=1)
+
+    def getBoundingBoxes(self):
+        '''
+        Get boxes guaranteed to contain each element from the convex hull
+        property of the equivalent Bezier control points.
+        :return: minimums (E, components), maximums (E, components)
+        '''
+        return self._getBernsteinBoundingBoxes(self._controlPoints)
+
+    def getSubdividedBoundingBoxes(self, subdivisions):
+        '''
+        Get boxes guaranteed to contain each of the subdivisions**dimension
+        equal parts of every element, which are much tighter than the element
+        bounding box on curved elements.
+        :param subdivisions: number of parts in each xi direction
+        :return: minimums (E, S, components), maximums (E, S, components)
+        where S = subdivisions**dimension
+        '''
+        dimension = self._dimension
+        controlXi = patchXi(dimension)
+        minimums = []
+        maximums = []
+        for cell in numpy.ndindex(*((subdivisions,)*dimension)):
+            # cell indexes are in xi order reversed, as for patchXi
+            weights = tensorBasisWeights((controlXi + numpy.array(cell[::-1]))/subdivisions, 0)[0]
+            cellMinimums, cellMaximums = self._getBernsteinBoundingBoxes(
+                numpy.einsum('sk,ekc->esc', weights, self._controlPoints))
+            minimums.append(cellMinimums)
+            maximums.append(cellMaximums)
+        return numpy.stack(minimums, axis=1), numpy.stack(maximums, axis=1)
+
+    def evaluate(self, elementIndexes, xi, derivatives=0):
+        '''
+        Evaluate coordinates and optionally derivatives w.r.t. xi.
+        :param elementIndexes: N indexes into element arrays (not identifiers)
+        :param xi: (N, dimension) element chart locations
+        :param derivatives: highest derivative to evaluate, 0 to 2
+        :return: list of arrays: coordinates (N, components), first derivatives
+        (N, components, dimension), second derivatives (N, components, dimension, dimension)
+        '''
+        xi = numpy.asarray(xi, dtype=numpy.float64).reshape(-1, self._dimension)
+        controlPoints = self._controlPoints[elementIndexes]
+        weights = tensorBasisWeights(xi, derivatives)
+        n = xi.shape[0]
+        dimension = self._dimension
+        result = [numpy.matmul(weights[0][:, numpy.newaxis, :], controlPoints)[:, 0, :]]
+        if derivatives > 0:
+            result.append(numpy.matmul(weights[1], controlPoints).transpose(0, 2, 1))
+        if derivatives > 1:
+            second = numpy.matmul(weights[2].reshape(n, dimension*dimension, -1), controlPoints)
+            result.append(second.transpose(0, 2, 1).reshape(n, -1, dimension, dimension))
+        return result
+
+    def sample(self, pointsPerDirection):
+        '''
+        Evaluate coordinates on a regular xi grid in every element.
+        :return: elementIndexes (M,), xi (M, dimension), coordinates (M, components)
+        '''
+        sampleXi = patchXi(self._dimension, pointsPerDirection)
+        weights = tensorBasisWeights(sampleXi, 0)[0]
+        coordinates = numpy.einsum('sk,ekc->esc', weights, self._controlPoints)
+        elementCount = self.getNumberOfElements()
+        sampleCount = sampleXi.shape[0]
+        elementIndexes = numpy.repeat(numpy.arange(elementCount, dtype=numpy.int32), sampleCount)
+        xi = numpy.tile(sampleXi, (elementCount, 1))
+        return elementIndexes, xi, coordinates.reshape(-1, coordinates.shape[2])
+
+    def projectLocal(self, points, elementIndexes, xi, maximumIterations=20, tolerance=1.0E-10):
+        '''
+        Find the nearest location to each point within its given element by
+        bound-constrained Newton iteration starting from xi.
+        :param points: (N, components) coordinates to project
+        :param elementIndexes: N indexes of elements to search in
+        :param xi: (N, dimension) initial xi
+        :return: xi (N, dimension), distances (N,)
+        '''
+        dimension = self._dimension
+        xi = numpy.clip(numpy.array(xi, dtype=numpy.float64).reshape(-1, dimension), 0.0, 1.0)
+        active = numpy.arange(xi.shape[0])
+        x, dx_dxi, d2x_dxi2 = self.evaluate(elementIndexes, xi, derivatives=2)
+        delta = x - points
+        distanceSquared = numpy.sum(delta*delta, axis=1)
+        for iteration in range(maximumIterations):
+            if active.size == 0:
+                break
+            delta_a = delta[active]
+            jacobian = dx_dxi[active]
+            gradient = numpy.einsum('nci,nc->ni', jacobian, delta_a)
+            hessian = numpy.einsum('nci,ncj->nij', jacobian, jacobian) + numpy.einsum('ncij,nc->nij', d2x_dxi2[active], delta_a)
+            # Fall back to Gauss-Newton where the full Hessian is not positive definite
+            gaussNewton = numpy.einsum('nci,ncj->nij', jacobian, jacobian)
+            indefinite = ~_isPositiveDefinite(hessian)
+            hessian[indefinite] = gaussNewton[indefinite]
+            # fix xi on bounds where the gradient points outward
+            xi_a = xi[active]
+            fixed = ((xi_a <= 0.0) & (gradient > 0.0)) | ((xi_a >= 1.0) & (gradient < 0.0))
+            gradient[fixed] = 0.0
+            fixedPair = fixed[:, :, numpy.newaxis] | fixed[:, numpy.newaxis, :]
+            hessian[fixedPair] = 0.0
+            diagonal = numpy.arange(dimension)
+            scale = numpy.maximum(numpy.abs(hessian[:, diagonal, diagonal]).max(axis=1), 1.0E-300)
+            hessian[:, diagonal, diagonal] += numpy.where(fixed, 1.0, 1.0E-12)*scale[:, numpy.newaxis]
+            step = -numpy.linalg.solve(hessian, gradient[:, :, numpy.newaxis])[:, :, 0]
+            # converged where the step is within tolerance, as backtracking
+            # from rounding error in distance would only waste evaluations
+            moving = numpy.max(numpy.abs(step), axis=1) > tolerance
+            active = active[moving]
+            if active.size == 0:
+                break
+            step = step[moving]
+            xi_a = xi_a[moving]
+            # backtrack until distance does not increase
+            stepScale = numpy.ones(active.size)
+            accepted = numpy.zeros(active.size, dtype=bool)
+            newXi = xi_a.copy()
+            newValues = [x[active], dx_dxi[active], d2x_dxi2[active]]
+            newDistanceSquared = distanceSquared[active].copy()
+            for halving in range(6):
+                trial = ~accepted
+                if not numpy.any(trial):
+                    break
+                trialXi = numpy.clip(xi_a[trial] + step[trial]*stepScale[trial, numpy.newaxis], 0.0, 1.0)
+                trialValues = self.evaluate(elementIndexes[active[trial]], trialXi, derivatives=2)
+                trialDelta = trialValues[0] - points[active[trial]]
+                trialDistanceSquared = numpy.sum(trialDelta*trialDelta, axis=1)
+                better = trialDistanceSquared <= distanceSquared[active[trial]]
+                update = numpy.flatnonzero(trial)[better]
+                newXi[update] = trialXi[better]
+                for values, trialValue in zip(newValues, trialValues):
+                    values[update] = trialValue[better]
+                newDistanceSquared[update] = trialDistanceSquared[better]
+                accepted[update] = True
+                stepScale[trial] *= 0.5
+            xiChange = numpy.max(numpy.abs(newXi - xi_a), axis=1)
+            xi[active] = newXi
+            x[active], dx_dxi[active], d2x_dxi2[active] = newValues
+            distanceSquared[active] = newDistanceSquared
+            delta[active] = newValues[0] - points[active]
+            active = active[accepted & (xiChange > tolerance)]
+        return xi, numpy.sqrt(distanceSquared)
+
+    def findNearestLocations(self, points, seedElementIndexes, seedXi, candidatesPerPoint):
+        '''
+        Refine candidate seeds to nearest locations, keeping the closest per point.
+        :param points: (N, components) coordinates to project
+        :param seedElementIndexes: (N, candidatesPerPoint) candidate element indexes
+        :param seedXi: (N, candidatesPerPoint, dimension) candidate xi
+        :return: elementIndexes (N,), xi (N, dimension), distances (N,)
+        '''
+        n = points.shape[0]
+        candidatePoints = numpy.repeat(points, candidatesPerPoint, axis=0)
+        xi, distances = self.projectLocal(candidatePoints, seedElementIndexes.reshape(-1),
+                                          seedXi.reshape(-1, self._dimension))
+        distances = distances.reshape(n, candidatesPerPoint)
+        best = numpy.argmin(distances, axis=1)
+        rows = numpy.arange(n)
+        elementIndexes = seedElementIndexes[rows, best]
+        xi = xi.reshape(n, candidatesPerPoint, self._dimension)[rows, best]
+        return elementIndexes, xi, distances[rows, best]
+
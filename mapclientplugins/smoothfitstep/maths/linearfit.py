@@ -0,0 +1,219 @@
+'''
+Direct sparse least squares fitting of nodal parameters.
+
+With data point projections held fixed, the fit objective is quadratic in
+the nodal parameters: every term is a linear function of the parameters
+evaluated at a data point or quadrature point, squared. Each element's
+cubic Lagrange patch control points are a linear map of the element's
+nodal parameters, so all terms are assembled as rows of one sparse matrix
+and the normal equations are solved directly instead of iterating.
+'''
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+from mapclientplugins.smoothfitstep.maths.elementpatches import ElementPatches, tensorBasisWeights
+
+
+def gaussLegendreXi(dimension, pointsPerDirection):
+    '''
+    :return: tensor product Gauss-Legendre points on the unit element (G, dimension)
+    and weights (G,)
+    '''
+    t, w = numpy.polynomial.legendre.leggauss(pointsPerDirection)
+    t = 0.5*(t + 1.0)
+    w = 0.5*w
+    grids = numpy.meshgrid(*([t]*dimension), indexing='ij')
+    weightGrids = numpy.meshgrid(*([w]*dimension), indexing='ij')
+    xi = numpy.stack([grid.ravel() for grid in reversed(grids)], axis=-1)
+    weights = numpy.prod(numpy.stack([grid.ravel() for grid in weightGrids], axis=-1), axis=1)
+    return xi, weights
+
+
+class ElementParameterMaps(object):
+    '''
+    Linear maps from nodal parameters to the cubic Lagrange patch control
+    points of each element, shared by all field components.
+    '''
+
+    def __init__(self, elementIdentifiers, parameterIndexes, maps, dimension, parameterCount):
+        '''
+        :param elementIdentifiers: E element identifiers
+        :param parameterIndexes: (E, M) indexes of parameters used by each
+        element, padded with -1
+        :param maps: (E, 4**dimension, M) control point weights for each
+        element parameter, zero for padding
+        :param dimension: element dimension 1, 2 or 3
+        :param parameterCount: total number of parameters D
+        '''
+        self._elementIdentifiers = numpy.asarray(elementIdentifiers, dtype=numpy.int32)
+        self._parameterIndexes = numpy.asarray(parameterIndexes, dtype=numpy.int64)
+        self._maps = numpy.asarray(maps, dtype=numpy.float64)
+        self._dimension = dimension
+        self._parameterCount = parameterCount
+
+    def getDimension(self):
+        return self._dimension
+
+    def getElementIdentifiers(self):
+        return self._elementIdentifiers
+
+    def getNumberOfElements(self):
+        return self._elementIdentifiers.shape[0]
+
+    def getNumberOfParameters(self):
+        return self._parameterCount
+
+    def getUsedParameters(self):
+        '''
+        :return: boolean array (D,), True for parameters used by any element
+        '''
+        used = numpy.zeros(self._parameterCount, dtype=bool)
+        used[self._parameterIndexes[self._parameterIndexes >= 0]] = True
+        return used
+
+    def getPatches(self, parameters):
+        '''
+        :param parameters: (D, components) nodal parameters
+        :return: ElementPatches interpolating the field with these parameters
+        '''
+        elementParameters = numpy.asarray(parameters, dtype=numpy.float64)[numpy.maximum(self._parameterIndexes, 0)]
+        return ElementPatches(self._elementIdentifiers, numpy.matmul(self._maps, elementParameters), self._dimension)
+
+    def assembleRows(self, elementIndexes, coefficients):
+        '''
+        Convert rows of coefficients of element control points to rows of
+        coefficients of nodal parameters.
+        :param elementIndexes: R element indexes, one per row
+        :param coefficients: (R, 4**dimension) control point coefficients
+        :return: sparse (R, D) matrix
+        '''
+        rowCount = elementIndexes.shape[0]
+        values = numpy.matmul(coefficients[:, numpy.newaxis, :], self._maps[elementIndexes])[:, 0, :]
+        columns = self._parameterIndexes[elementIndexes]
+        rows = numpy.broadcast_to(numpy.arange(rowCount)[:, numpy.newaxis], columns.shape)
+        used = columns >= 0
+        return scipy.sparse.csr_matrix((values[used], (rows[used], columns[used])),
+                                       shape=(rowCount, self._parameterCount))
+
+
+def assembleDataRows(parameterMaps, elementIndexes, xi):
+    '''
+    :param elementIndexes: N element indexes of data point projections
+    :param xi: (N, dimension) xi of data point projections
+    :return: sparse (N, D) matrix interpolating the field at the projections
+    '''
+    weights = tensorBasisWeights(numpy.asarray(xi, dtype=numpy.float64).reshape(-1, parameterMaps.getDimension()))[0]
+    return parameterMaps.assembleRows(elementIndexes, weights)
+
+
+def _penaltyCoefficients(referencePatches, elementIndexes, quadratureXi, strainPenalty, curvaturePenalty):
+    '''
+    Get control point coefficients of strain and curvature penalty integrand
+    components at quadrature points of elements, matching the penalty fields
+    of SmoothfitModel: displacement gradients w.r.t. arc length along xi for
+    2-D elements, and w.r.t. reference coordinates for 3-D elements.
+    :return: coefficients (E, G, R, K) already multiplied by penalty weights,
+    and reference volume/area element (E, G)
+    '''
+    dimension = referencePatches.getDimension()
+    elementCount = elementIndexes.shape[0]
+    pointCount = quadratureXi.shape[0]
+    w1, w2 = tensorBasisWeights(quadratureXi, 2)[1:]
+    controlPoints = referencePatches.getControlPoints()[elementIndexes]
+    # dX_dxi[e, g, c, i], d2X_dxi2[e, g, c, i, j]
+    dX_dxi = numpy.einsum('gik,ekc->egci', w1, controlPoints)
+    d2X_dxi2 = numpy.einsum('gijk,ekc->egcij', w2, controlPoints)
+    metric = numpy.matmul(dX_dxi.transpose(0, 1, 3, 2), dX_dxi)
+    volume = numpy.sqrt(numpy.abs(numpy.linalg.det(metric)))
+    terms = []
+    if dimension == 2:
+        dS_dxi = numpy.sqrt(numpy.sum(dX_dxi*dX_dxi, axis=2))
+        if strainPenalty > 0.0:
+            # du/dS_i = du/dxi_i / dS_i/dxi_i
+            terms.append(strainPenalty*w1[numpy.newaxis]/dS_dxi[:, :, :, numpy.newaxis])
+        if curvaturePenalty > 0.0:
+            # d(du/dS_i)/dxi_j / dS_j/dxi_j, differentiating the arc length scaling too
+            d2S_dxi2 = numpy.einsum('egci,egcij->egij', dX_dxi, d2X_dxi2)/dS_dxi[:, :, :, numpy.newaxis]
+            s_i = dS_dxi[:, :, :, numpy.newaxis, numpy.newaxis]
+            s_j = dS_dxi[:, :, numpy.newaxis, :, numpy.newaxis]
+            coefficients = (w2[numpy.newaxis]/s_i -
+                w1[numpy.newaxis, :, :, numpy.newaxis, :]*d2S_dxi2[..., numpy.newaxis]/(s_i*s_i))/s_j
+            terms.append(curvaturePenalty*coefficients.reshape(elementCount, pointCount, dimension*dimension, -1))
+    elif dimension == 3:
+        dxi_dX = numpy.linalg.inv(dX_dxi)
+        if strainPenalty > 0.0:
+            # du/dX_j = sum_i du/dxi_i dxi_i/dX_j
+            terms.append(strainPenalty*numpy.einsum('gik,egij->egjk', w1, dxi_dX))
+        if curvaturePenalty > 0.0:
+            # d(du/dX_j)/dX_k = sum_l d(du/dX_j)/dxi_l dxi_l/dX_k
+            d_dxi_dX_dxi = -numpy.einsum('egia,egabl,egbj->egijl', dxi_dX, d2X_dxi2, dxi_dX)
+            d_du_dX_dxi = (numpy.einsum('gilk,egij->egjlk', w2, dxi_dX) +
+                           numpy.einsum('gik,egijl->egjlk', w1, d_dxi_dX_dxi))
+            coefficients = numpy.einsum('egjlk,eglm->egjmk', d_du_dX_dxi, dxi_dX)
+            terms.append(curvaturePenalty*coefficients.reshape(elementCount, pointCount, dimension*dimension, -1))
+    if not terms:
+        return numpy.empty((elementCount, pointCount, 0, w1.shape[-1])), volume
+    return numpy.concatenate(terms, axis=2), volume
+
+
+def assemblePenaltyRows(parameterMaps, referencePatches, strainPenalty, curvaturePenalty,
+                        pointsPerDirection=3, chunkSize=2000):
+    '''
+    Assemble rows whose sum of squares, applied to the displacement from
+    the reference parameters, integrates the weighted squared strain and
+    curvature penalties over the reference mesh by Gauss quadrature.
+    :param referencePatches: ElementPatches of the reference coordinates,
+    with elements in the same order as parameterMaps
+    :param pointsPerDirection: number of Gauss points in each xi direction
+    :param chunkSize: number of elements to assemble at once, to limit memory
+    :return: sparse (R, D) matrix
+    '''
+    dimension = parameterMaps.getDimension()
+    quadratureXi, quadratureWeights = gaussLegendreXi(dimension, pointsPerDirection)
+    blocks = []
+    for start in range(0, parameterMaps.getNumberOfElements(), chunkSize):
+        elementIndexes = numpy.arange(start, min(start + chunkSize, parameterMaps.getNumberOfElements()))
+        coefficients, volume = _penaltyCoefficients(referencePatches, elementIndexes, quadratureXi,
+                                                    strainPenalty, curvaturePenalty)
+        if coefficients.shape[2] == 0:
+            break
+        coefficients = coefficients*numpy.sqrt(quadratureWeights*volume)[:, :, numpy.newaxis, numpy.newaxis]
+        rowElementIndexes = numpy.repeat(elementIndexes, coefficients.shape[1]*coefficients.shape[2])
+        blocks.append(parameterMaps.assembleRows(rowElementIndexes, coefficients.reshape(rowElementIndexes.shape[0], -1)))
+    if not blocks:
+        return scipy.sparse.csr_matrix((0, parameterMaps.getNumberOfParameters()))
+    return scipy.sparse.vstack(blocks, format='csr')
+
+
+def solveLinearLeastSquares(matrix, targets, parameters, free, regularisation=1.0E-10):
+    '''
+    Minimise the sum of squares of matrix.parameters - targets over the free
+    parameters, keeping the others fixed. Solves the sparse normal equations
+    with a direct LU factorisation shared by all components. A small
+    regularisation toward the current parameters keeps parameters not
+    constrained by any row at their current values.
+    :param matrix: sparse (R, D) matrix
+    :param targets: (R, components) target values
+    :param parameters: (D, components) current parameters
+    :param free: boolean array (D,), True for parameters to solve for
+    :param regularisation: weight relative to mean normal matrix diagonal
+    :return: new parameters (D, components), sum of squares before and after
+    '''
+    matrix = scipy.sparse.csc_matrix(matrix)
+    freeIndexes = numpy.flatnonzero(free)
+    fixedIndexes = numpy.flatnonzero(~free)
+    objectiveBefore = float(numpy.sum((matrix.dot(parameters) - targets)**2))
+    freeMatrix = matrix[:, freeIndexes]
+    rhsTargets = targets - matrix[:, fixedIndexes].dot(parameters[fixedIndexes])
+    normalMatrix = (freeMatrix.T.dot(freeMatrix)).tocsc()
+    rhs = freeMatrix.T.dot(rhsTargets)
+    diagonal = normalMatrix.diagonal()
+    meanDiagonal = numpy.mean(diagonal) if diagonal.size > 0 else 0.0
+    weight = regularisation*(meanDiagonal if meanDiagonal > 0.0 else 1.0)
+    normalMatrix = normalMatrix + weight*scipy.sparse.identity(freeIndexes.size, format='csc')
+    rhs = rhs + weight*parameters[freeIndexes]
+    solution = numpy.array(parameters, dtype=numpy.float64)
+    if freeIndexes.size > 0:
+        solution[freeIndexes] = scipy.sparse.linalg.splu(normalMatrix, permc_spec='MMD_AT_PLUS_A').solve(rhs)
+    objectiveAfter = float(numpy.sum((matrix.dot(solution) - targets)**2))
+    return solution, objectiveBefore, objectiveAfter
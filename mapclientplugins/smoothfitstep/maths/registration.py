@@ -0,0 +1,155 @@
+'''
+Automatic registration of model surface samples to a data point cloud by
+vectorised iterative closest point, started from principal axes.
+
+Transforms map model coordinates x to data coordinates as:
+    y = scale*mirror*rotation*x + translation
+where rotation is a proper rotation matrix and mirror is diag(-1, 1, 1)
+if mirrored, else identity, matching the model align settings.
+'''
+import itertools
+import numpy
+from scipy.spatial import cKDTree
+
+MIRROR_MATRIX = numpy.diag([-1.0, 1.0, 1.0])
+
+
+def similarityTransform(source, target, estimateScale=True, scale=1.0, reflection=False):
+    '''
+    Least squares similarity transform from source to target points by the
+    method of Umeyama.
+    :param source: (N, 3) points
+    :param target: (N, 3) corresponding points
+    :param estimateScale: True to fit scale, False to use scale
+    :param reflection: True for orthogonal matrix with determinant -1
+    :return: scale, orthogonal matrix (3, 3), translation (3,)
+    '''
+    sourceCentre = source.mean(axis=0)
+    targetCentre = target.mean(axis=0)
+    sourceCentred = source - sourceCentre
+    targetCentred = target - targetCentre
+    covariance = numpy.matmul(targetCentred.T, sourceCentred)/source.shape[0]
+    u, singularValues, vt = numpy.linalg.svd(covariance)
+    signs = numpy.ones(3)
+    signs[2] = (-1.0 if reflection else 1.0)*numpy.sign(numpy.linalg.det(u)*numpy.linalg.det(vt))
+    if signs[2] == 0.0:
+        signs[2] = -1.0 if reflection else 1.0
+    matrix = numpy.matmul(u*signs, vt)
+    if estimateScale:
+        sourceVariance = numpy.sum(sourceCentred*sourceCentred)/source.shape[0]
+        scale = numpy.sum(singularValues*signs)/sourceVariance if sourceVariance > 0.0 else 1.0
+    translation = targetCentre - scale*numpy.matmul(matrix, sourceCentre)
+    return scale, matrix, translation
+
+
+def principalAxes(points):
+    '''
+    :return: centroid (3,), axes as columns of (3, 3) in decreasing order of
+    variance, variances (3,)
+    '''
+    centroid = points.mean(axis=0)
+    centred = points - centroid
+    variances, axes = numpy.linalg.eigh(numpy.matmul(centred.T, centred)/points.shape[0])
+    order = numpy.argsort(variances)[::-1]
+    return centroid, axes[:, order], variances[order]
+
+
+def iterateClosestPoint(modelTree, modelPoints, dataPoints, scale, matrix, translation, estimateScale,
+                        reflection, maxIterations, trimFraction, tolerance):
+    '''
+    Refine transform by alternating closest model points to data points
+    with least squares similarity transform of trimmed correspondences.
+    :param modelTree: cKDTree of modelPoints
+    :param matrix: orthogonal matrix, with determinant -1 if reflection
+    :return: scale, matrix, translation, trimmed RMS error, iterations
+    '''
+    keepCount = max(3, int(round((1.0 - trimFraction)*dataPoints.shape[0])))
+    rmsError = numpy.inf
+    for iteration in range(1, maxIterations + 1):
+        # closest model point to each data point, found in model coordinates
+        modelSpacePoints = numpy.matmul(dataPoints - translation, matrix)/scale
+        distances, modelIndexes = modelTree.query(modelSpacePoints)
+        keep = numpy.argpartition(distances, keepCount - 1)[:keepCount] if keepCount < distances.size else \
+            numpy.arange(distances.size)
+        scale, matrix, translation = similarityTransform(modelPoints[modelIndexes[keep]], dataPoints[keep],
+                                                         estimateScale, scale, reflection)
+        residuals = dataPoints[keep] - (scale*numpy.matmul(modelPoints[modelIndexes[keep]], matrix.T) + translation)
+        newRmsError = float(numpy.sqrt(numpy.mean(numpy.sum(residuals*residuals, axis=1))))
+        converged = (rmsError - newRmsError) <= tolerance*newRmsError
+        rmsError = newRmsError
+        if converged:
+            break
+    return scale, matrix, translation, rmsError, iteration
+
+
+def registerPoints(modelPoints, dataPoints, estimateScale=True, scale=1.0, mirrors=(False,), initialTransform=None,
+                   sampleCount=20000, guessSampleCount=2000, maxIterations=50, trimFraction=0.1,
+                   tolerance=1.0E-6, seed=0):
+    '''
+    Find the transform of model points best registering them with the data
+    points. Initial guesses align principal axes of the model points with
+    those of the data points for each choice of axis signs, plus any initial
+    transform, which is needed where a partial scan has different principal
+    axes to the model. Each guess is refined by trimmed iterative closest
+    point on a small subsample of the data points, then the best is refined
+    on a larger subsample.
+    :param modelPoints: (M, 3) points sampled over the model surface
+    :param dataPoints: (N, 3) data point cloud
+    :param estimateScale: True to fit scale, False to use scale
+    :param mirrors: mirror states to try: (False,), (True,) or (False, True)
+    :param initialTransform: optional (scale, rotation, mirror, translation)
+    to also start from, e.g. the current alignment
+    :param sampleCount: maximum number of data points used in final refinement
+    :param guessSampleCount: maximum number of data points used to refine
+    initial guesses
+    :param trimFraction: proportion of furthest correspondences ignored in
+    each iteration, for partial scans and outliers
+    :param tolerance: stop when RMS error reduces by less than this
+    proportion in an iteration
+    :return: dict with scale, rotation (3, 3) proper rotation matrix,
+    mirror, translation (3,), rms_error of trimmed correspondences, and
+    iterations summed over all refinements
+    '''
+    modelPoints = numpy.asarray(modelPoints, dtype=numpy.float64)
+    dataPoints = numpy.asarray(dataPoints, dtype=numpy.float64)
+    rng = numpy.random.default_rng(seed)
+    if dataPoints.shape[0] > sampleCount:
+        dataPoints = dataPoints[rng.choice(dataPoints.shape[0], sampleCount, replace=False)]
+    guessDataPoints = dataPoints
+    if dataPoints.shape[0] > guessSampleCount:
+        guessDataPoints = dataPoints[rng.choice(dataPoints.shape[0], guessSampleCount, replace=False)]
+    modelTree = cKDTree(modelPoints)
+    modelCentroid, modelAxes, modelVariances = principalAxes(modelPoints)
+    dataCentroid, dataAxes, dataVariances = principalAxes(dataPoints)
+    if estimateScale and (numpy.sum(modelVariances) > 0.0):
+        scale = float(numpy.sqrt(numpy.sum(dataVariances)/numpy.sum(modelVariances)))
+    best = None
+    totalIterations = 0
+    guesses = []
+    for mirror in mirrors:
+        for signs in itertools.product([1.0, -1.0], repeat=3):
+            matrix = numpy.matmul(dataAxes*numpy.array(signs), modelAxes.T)
+            if (numpy.linalg.det(matrix) < 0.0) != mirror:
+                continue
+            guesses.append((scale, matrix, dataCentroid - scale*numpy.matmul(matrix, modelCentroid), mirror))
+    if initialTransform is not None:
+        initialScale, initialRotation, initialMirror, initialTranslation = initialTransform
+        if initialMirror in mirrors:
+            initialMatrix = numpy.asarray(initialRotation, dtype=numpy.float64)
+            if initialMirror:
+                initialMatrix = numpy.matmul(MIRROR_MATRIX, initialMatrix)
+            guesses.append((initialScale, initialMatrix, numpy.asarray(initialTranslation, dtype=numpy.float64),
+                            initialMirror))
+    for guessScale, matrix, translation, mirror in guesses:
+        result = iterateClosestPoint(modelTree, modelPoints, guessDataPoints, guessScale, matrix, translation,
+                                     estimateScale, mirror, maxIterations, trimFraction, 1.0E-3)
+        totalIterations += result[4]
+        if (best is None) or (result[3] < best[3]):
+            best = result + (mirror,)
+    guessScale, guessMatrix, guessTranslation, guessRmsError, guessIterations, mirror = best
+    bestScale, matrix, translation, rmsError, iterations = iterateClosestPoint(modelTree, modelPoints, dataPoints,
+        guessScale, guessMatrix, guessTranslation, estimateScale, mirror, maxIterations, trimFraction, tolerance)
+    totalIterations += iterations
+    rotation = numpy.matmul(MIRROR_MATRIX, matrix) if mirror else matrix
+    return dict(scale=float(bestScale), rotation=rotation, mirror=mirror, translation=translation,
+                rms_error=rmsError, iterations=totalIterations)
@@ -0,0 +1,297 @@
+'''
+Spatial index over mesh elements for nearest location queries, built
+from ElementPatches: a bounding volume hierarchy of element bounding
+boxes plus a KD-tree of coordinates sampled over the elements.
+'''
+import numpy
+from scipy.spatial import cKDTree
+
+
+class ElementBVH(object):
+    '''
+    Bounding volume hierarchy of element boxes stored in flat arrays,
+    queried for many points at once.
+    '''
+
+    def __init__(self, minimums, maximums, leafSize=4):
+        '''
+        :param minimums: (E, components) element box minimums
+        :param maximums: (E, components) element box maximums
+        :param leafSize: maximum number of elements in a leaf
+        '''
+        elementCount = minimums.shape[0]
+        centres = 0.5*(minimums + maximums)
+        order = numpy.arange(elementCount)
+        nodeMinimums = []
+        nodeMaximums = []
+        nodeChildren = []
+        nodeStart = []
+        nodeStop = []
+        stack = [(0, elementCount, -1, 0)]
+        while stack:
+            start, stop, parent, side = stack.pop()
+            node = len(nodeStart)
+            if parent >= 0:
+                nodeChildren[parent][side] = node
+            elements = order[start:stop]
+            nodeMinimums.append(minimums[elements].min(axis=0))
+            nodeMaximums.append(maximums[elements].max(axis=0))
+            nodeChildren.append([-1, -1])
+            nodeStart.append(start)
+            nodeStop.append(stop)
+            if (stop - start) > leafSize:
+                extent = centres[elements].max(axis=0) - centres[elements].min(axis=0)
+                axis = numpy.argmax(extent)
+                middle = (stop - start)//2
+                partition = numpy.argpartition(centres[elements, axis], middle)
+                order[start:stop] = elements[partition]
+                stack.append((start + middle, stop, node, 1))
+                stack.append((start, start + middle, node, 0))
+        self._order = order
+        self._minimums = numpy.array(nodeMinimums)
+        self._maximums = numpy.array(nodeMaximums)
+        self._children = numpy.array(nodeChildren, dtype=numpy.int64)
+        self._start = numpy.array(nodeStart, dtype=numpy.int64)
+        self._stop = numpy.array(nodeStop, dtype=numpy.int64)
+
+    def _boxDistanceSquared(self, nodes, points):
+        below = numpy.maximum(self._minimums[nodes] - points, 0.0)
+        above = numpy.maximum(points - self._maximums[nodes], 0.0)
+        gap = below + above
+        return numpy.sum(gap*gap, axis=1)
+
+    def findElementsWithinDistance(self, points, distances):
+        '''
+        Find all elements whose boxes are closer than distance to each point.
+        :param points: (N, components) coordinates
+        :param distances: N query distances
+        :return: pointIndexes, elementIndexes arrays of matching pairs
+        '''
+        distancesSquared = numpy.asarray(distances)**2
+        pointIndexes = numpy.arange(points.shape[0])
+        nodes = numpy.zeros(points.shape[0], dtype=numpy.int64)
+        resultPoints = []
+        resultElements = []
+        while pointIndexes.size > 0:
+            inside = self._boxDistanceSquared(nodes, points[pointIndexes]) < distancesSquared[pointIndexes]
+            pointIndexes = pointIndexes[inside]
+            nodes = nodes[inside]
+            leaf = self._children[nodes, 0] < 0
+            if numpy.any(leaf):
+                leafPoints = pointIndexes[leaf]
+                leafNodes = nodes[leaf]
+                counts = self._stop[leafNodes] - self._start[leafNodes]
+                offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                resultPoints.append(numpy.repeat(leafPoints, counts))
+                resultElements.append(self._order[numpy.repeat(self._start[leafNodes], counts) + offsets])
+            branch = ~leaf
+            pointIndexes = numpy.repeat(pointIndexes[branch], 2)
+            nodes = self._children[nodes[branch]].ravel()
+        if not resultPoints:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+        return numpy.concatenate(resultPoints), numpy.concatenate(resultElements)
+
+
+class MeshSpatialIndex(object):
+    '''
+    Nearest location queries over ElementPatches, reusable until the mesh
+    coordinates change.
+    '''
+
+    def __init__(self, patches, samplesPerDirection=5):
+        '''
+        :param patches: ElementPatches for the mesh
+        :param samplesPerDirection: number of xi samples across each element
+        used to seed searches
+        '''
+        self._patches = patches
+        self._sampleElementIndexes, self._sampleXi, self._sampleCoordinates = patches.sample(samplesPerDirection)
+        self._samplesPerElement = samplesPerDirection**patches.getDimension()
+        self._sampleTree = cKDTree(self._sampleCoordinates)
+        self._bvh = ElementBVH(*patches.getBoundingBoxes())
+        self._subdividedMinimums, self._subdividedMaximums = patches.getSubdividedBoundingBoxes(2)
+        self._adjacency = None
+
+    def getPatches(self):
+        return self._patches
+
+    def getBVH(self):
+        return self._bvh
+
+    def getAdjacency(self):
+        '''
+        :return: offsets, adjacentElementIndexes as from ElementPatches.getAdjacency,
+        with a corner tolerance relative to the size of the mesh.
+        '''
+        if self._adjacency is None:
+            size = numpy.linalg.norm(self._sampleCoordinates.max(axis=0) - self._sampleCoordinates.min(axis=0))
+            self._adjacency = self._patches.getAdjacency(1.0E-6*size)
+        return self._adjacency
+
+    def findNearestSamples(self, points, k=1):
+        '''
+        :return: distances, elementIndexes, xi of the k closest samples to each point
+        '''
+        distances, samples = self._sampleTree.query(points, k=k)
+        return distances, self._sampleElementIndexes[samples], self._sampleXi[samples]
+
+    def _nearestSampleInElements(self, points, elementIndexes):
+        '''
+        :return: xi of the sample closest to each point in the matching element.
+        '''
+        sampleCoordinates = self._sampleCoordinates.reshape(-1, self._samplesPerElement, self._sampleCoordinates.shape[1])
+        delta = sampleCoordinates[elementIndexes] - points[:, numpy.newaxis, :]
+        nearest = numpy.argmin(numpy.sum(delta*delta, axis=2), axis=1)
+        return self._sampleXi[elementIndexes*self._samplesPerElement + nearest]
+
+    def _refineInElements(self, points, pointIndexes, elementIndexes, xi, bestElementIndexes, bestXi, bestDistances):
+        '''
+        Project points[pointIndexes] in the matching elementIndexes from xi, or from
+        the closest sample if xi is None, and update best locations in place where
+        closer. Points may appear many times.
+        '''
+        if pointIndexes.size == 0:
+            return
+        pairPoints = points[pointIndexes]
+        if xi is None:
+            xi = self._nearestSampleInElements(pairPoints, elementIndexes)
+        xi, pairDistances = self._patches.projectLocal(pairPoints, elementIndexes, xi)
+        order = numpy.lexsort((pairDistances, pointIndexes))
+        sortedPoints = pointIndexes[order]
+        first = numpy.ones(order.size, dtype=bool)
+        first[1:] = sortedPoints[1:] != sortedPoints[:-1]
+        best = order[first]
+        closer = pairDistances[best] < bestDistances[pointIndexes[best]]
+        best = best[closer]
+        update = pointIndexes[best]
+        bestElementIndexes[update] = elementIndexes[best]
+        bestXi[update] = xi[best]
+        bestDistances[update] = pairDistances[best]
+
+    def _getDistanceLowerBounds(self, points, elementIndexes):
+        '''
+        :return: distance from each point to the closest box of the
+        subdivided matching element, which no location in it is closer than
+        '''
+        delta = numpy.maximum(self._subdividedMinimums[elementIndexes] - points[:, numpy.newaxis, :], 0.0) + \
+            numpy.maximum(points[:, numpy.newaxis, :] - self._subdividedMaximums[elementIndexes], 0.0)
+        return numpy.sqrt(numpy.min(numpy.sum(delta*delta, axis=2), axis=1))
+
+    def _refineInCloserElements(self, points, searchedPoints, searchedElementIndexes, bestElementIndexes, bestXi, bestDistances):
+        '''
+        Refine in all elements whose subdivided bounding boxes are closer than
+        the best distances, except the given searched point-element pairs.
+        :return: pointIndexes, elementIndexes of additional pairs searched
+        '''
+        elementCount = self._patches.getNumberOfElements()
+        pointIndexes, elementIndexes = self._bvh.findElementsWithinDistance(points, bestDistances)
+        searched = numpy.isin(pointIndexes.astype(numpy.int64)*elementCount + elementIndexes,
+                              searchedPoints.astype(numpy.int64)*elementCount + searchedElementIndexes)
+        pointIndexes = pointIndexes[~searched]
+        elementIndexes = elementIndexes[~searched]
+        closer = self._getDistanceLowerBounds(points[pointIndexes], elementIndexes) < bestDistances[pointIndexes]
+        pointIndexes = pointIndexes[closer]
+        elementIndexes = elementIndexes[closer]
+        self._refineInElements(points, pointIndexes, elementIndexes, None, bestElementIndexes, bestXi, bestDistances)
+        return pointIndexes, elementIndexes
+
+    def findNearestLocations(self, points, candidatesPerPoint=2, chunkSize=50000):
+        '''
+        Find nearest mesh locations to all points. Seeds from the closest
+        samples are refined by Newton iteration, once per element, then any
+        other elements with subdivided bounding boxes closer than the best
+        distance found are also searched.
+        :param points: (N, components) coordinates to project
+        :return: elementIndexes (N,), xi (N, dimension), distances (N,)
+        '''
+        points = numpy.asarray(points, dtype=numpy.float64)
+        candidatesPerPoint = min(candidatesPerPoint, self._sampleElementIndexes.shape[0])
+        n = points.shape[0]
+        elementIndexes = numpy.full(n, -1, dtype=numpy.int32)
+        xi = numpy.zeros((n, self._patches.getDimension()))
+        distances = numpy.full(n, numpy.inf)
+        for start in range(0, n, chunkSize):
+            stop = min(start + chunkSize, n)
+            chunk = points[start:stop]
+            sampleDistances, seedElementIndexes, seedXi = self.findNearestSamples(chunk, k=candidatesPerPoint)
+            # only refine from the closest seed in each element
+            firstSeed = numpy.ones(seedElementIndexes.shape, dtype=bool)
+            for candidate in range(1, candidatesPerPoint):
+                firstSeed[:, candidate] = numpy.all(
+                    seedElementIndexes[:, candidate:candidate + 1] != seedElementIndexes[:, :candidate], axis=1)
+            seedPoints = numpy.repeat(numpy.arange(stop - start), candidatesPerPoint)[firstSeed.ravel()]
+            seedXi = seedXi[firstSeed]
+            seedElementIndexes = seedElementIndexes[firstSeed]
+            chunkElementIndexes = elementIndexes[start:stop]
+            chunkXi = xi[start:stop]
+            chunkDistances = distances[start:stop]
+            self._refineInElements(chunk, seedPoints, seedElementIndexes, seedXi,
+                                   chunkElementIndexes, chunkXi, chunkDistances)
+            self._refineInCloserElements(chunk, seedPoints, seedElementIndexes, chunkElementIndexes, chunkXi, chunkDistances)
+        return elementIndexes, xi, distances
+
+    def findNearestLocationsLocal(self, points, elementIndexes, xi, previousDistances=None):
+        '''
+        Find nearest mesh locations starting from previous locations. Each point
+        is refined in its previous element from its previous xi, and if it ends
+        on the element boundary, in the adjacent elements too. Other elements
+        are only searched for points whose location then lies on the boundary
+        of an adjacent element, so may continue beyond it, or is further than
+        its previous distance, and points with no previous location are
+        searched globally. Results are local: a point may stay in a local
+        minimum of distance in its previous element where a full search would
+        find a closer location elsewhere.
+        :param points: (N, components) coordinates to project
+        :param elementIndexes: N previous element indexes, -1 if none
+        :param xi: (N, dimension) previous xi
+        :param previousDistances: optional N distances of previous locations
+        :return: elementIndexes (N,), xi (N, dimension), distances (N,),
+        number of points searched outside their patch
+        '''
+        points = numpy.asarray(points, dtype=numpy.float64)
+        n = points.shape[0]
+        newElementIndexes = numpy.full(n, -1, dtype=numpy.int32)
+        newXi = numpy.zeros((n, self._patches.getDimension()))
+        distances = numpy.full(n, numpy.inf)
+        seeded = numpy.flatnonzero(elementIndexes >= 0)
+        unseeded = numpy.flatnonzero(elementIndexes < 0)
+        outsideCount = unseeded.size
+        if seeded.size > 0:
+            hosts = elementIndexes[seeded]
+            self._refineInElements(points, seeded, hosts, xi[seeded], newElementIndexes, newXi, distances)
+            # try adjacent elements where location is on host boundary
+            onBoundary = numpy.any((newXi[seeded] <= 0.0) | (newXi[seeded] >= 1.0), axis=1)
+            boundaryPoints = seeded[onBoundary]
+            offsets, adjacentElementIndexes = self.getAdjacency()
+            boundaryHosts = elementIndexes[boundaryPoints]
+            counts = offsets[boundaryHosts + 1] - offsets[boundaryHosts]
+            pairOffsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            patchPoints = numpy.repeat(boundaryPoints, counts)
+            patchElements = adjacentElementIndexes[numpy.repeat(offsets[boundaryHosts], counts) + pairOffsets]
+            notHost = patchElements != elementIndexes[patchPoints]
+            patchPoints = patchPoints[notHost]
+            patchElements = patchElements[notHost]
+            self._refineInElements(points, patchPoints, patchElements, None, newElementIndexes, newXi, distances)
+            # search other elements only where the local search may be leaving its patch or got worse
+            escalate = (newElementIndexes[seeded] != hosts) & \
+                numpy.any((newXi[seeded] <= 0.0) | (newXi[seeded] >= 1.0), axis=1)
+            if previousDistances is not None:
+                escalate |= distances[seeded] > previousDistances[seeded]*(1.0 + 1.0E-9)
+            escalated = seeded[escalate]
+            if escalated.size > 0:
+                inEscalated = numpy.isin(patchPoints, escalated)
+                searchedPoints = numpy.concatenate([numpy.arange(escalated.size),
+                                                    numpy.searchsorted(escalated, patchPoints[inEscalated])])
+                searchedElements = numpy.concatenate([elementIndexes[escalated], patchElements[inEscalated]])
+                escalatedElementIndexes = newElementIndexes[escalated]
+                escalatedXi = newXi[escalated]
+                escalatedDistances = distances[escalated]
+                self._refineInCloserElements(points[escalated], searchedPoints, searchedElements,
+                    escalatedElementIndexes, escalatedXi, escalatedDistances)
+                newElementIndexes[escalated] = escalatedElementIndexes
+                newXi[escalated] = escalatedXi
+                distances[escalated] = escalatedDistances
+            outsideCount += escalated.size
+        if unseeded.size > 0:
+            newElementIndexes[unseeded], newXi[unseeded], distances[unseeded] = self.findNearestLocations(points[unseeded])
+        return newElementIndexes, newXi, distances, outsideCount
@@ -19,10 +19,14 @@ This file is part of MAP Client. (http://launchpad.net/mapclient)
 '''
 
 from math import sqrt, cos, sin, fabs, atan2
+import numpy
 
 '''
 A collection of functions that operate on python lists as if
-they were vectors.
+they were vectors, plus batched variants operating on numpy arrays of
+many vectors or matrices. Scalar functions on single small vectors stay
+in pure python, which is faster than numpy at this size, except where
+noted.
 '''
 
 def magnitude(v):
@@ -104,9 +108,10 @@ def vectormatrixmult(v, m):
 def matrixmult(a, b):
     '''
     Multiply 2 matrices: first index is down row, second is across column.
-    Assumes sizes are compatible (
+    Uses numpy, which is faster than python for 3x3 matrices.
+    :return: product matrix as list of lists
     '''
-    return [vectormatrixmult(row_a, b) for row_a in a]
+    return numpy.matmul(numpy.asarray(a, dtype=numpy.float64), numpy.asarray(b, dtype=numpy.float64)).tolist()
 
 def eulerToRotationMatrix3(euler_angles):
     '''
@@ -152,4 +157,105 @@ def axisAngleToQuaternion(axis, angle):
     return [cos(angle/2), axis[0]*sin(angle/2), axis[1]*sin(angle/2), axis[2]*sin(angle/2)]
 
 def axisAngleToRotationMatrix(axis, angle):
-    pass
\ No newline at end of file
+    pass
+
+def magnitudes(vectors):
+    '''
+    :param vectors: (N, components) array
+    :return: (N,) magnitudes
+    '''
+    vectors = numpy.asarray(vectors, dtype=numpy.float64)
+    return numpy.sqrt(numpy.sum(vectors*vectors, axis=-1))
+
+def normalizeVectors(vectors):
+    '''
+    :param vectors: (N, components) array
+    :return: (N, components) unit vectors
+    '''
+    vectors = numpy.asarray(vectors, dtype=numpy.float64)
+    return vectors/magnitudes(vectors)[..., numpy.newaxis]
+
+def quaternionsToRotationMatrices3(quaternions):
+    '''
+    Batched rotmx.
+    :param quaternions: (N, 4) array of w, x, y, z, need not be normalised
+    :return: (N, 3, 3) rotation matrices
+    '''
+    qw, qx, qy, qz = normalizeVectors(quaternions).T
+    return numpy.stack([
+        numpy.stack([qw*qw + qx*qx - qy*qy - qz*qz, 2*qx*qy - 2*qw*qz, 2*qx*qz + 2*qw*qy], axis=-1),
+        numpy.stack([2*qx*qy + 2*qw*qz, qw*qw - qx*qx + qy*qy - qz*qz, 2*qy*qz - 2*qw*qx], axis=-1),
+        numpy.stack([2*qx*qz - 2*qw*qy, 2*qy*qz + 2*qw*qx, qw*qw - qx*qx - qy*qy + qz*qz], axis=-1)], axis=-2)
+
+def eulerToRotationMatrices3(euler_angles):
+    '''
+    Batched eulerToRotationMatrix3.
+    :param euler_angles: (N, 3) array of azimuth, elevation, roll
+    :return: (N, 3, 3) rotation matrices
+    '''
+    euler_angles = numpy.asarray(euler_angles, dtype=numpy.float64)
+    cos_azimuth, cos_elevation, cos_roll = numpy.cos(euler_angles).T
+    sin_azimuth, sin_elevation, sin_roll = numpy.sin(euler_angles).T
+    return numpy.stack([
+        numpy.stack([cos_azimuth*cos_elevation, sin_azimuth*cos_elevation, -sin_elevation], axis=-1),
+        numpy.stack([cos_azimuth*sin_elevation*sin_roll - sin_azimuth*cos_roll,
+                     sin_azimuth*sin_elevation*sin_roll + cos_azimuth*cos_roll, cos_elevation*sin_roll], axis=-1),
+        numpy.stack([cos_azimuth*sin_elevation*cos_roll + sin_azimuth*sin_roll,
+                     sin_azimuth*sin_elevation*cos_roll - cos_azimuth*sin_roll, cos_elevation*cos_roll], axis=-1)],
+        axis=-2)
+
+def rotationMatrices3ToEuler(matrices):
+    '''
+    Batched rotationMatrix3ToEuler, with the same handling of singular cases.
+    :param matrices: (N, 3, 3) rotation matrices
+    :return: (N, 3) array of azimuth, elevation, roll
+    '''
+    MATRIX_TO_EULER_TOLERANCE = 1.0E-12
+    matrices = numpy.asarray(matrices, dtype=numpy.float64)
+    m00, m01, m02 = matrices[:, 0, 0], matrices[:, 0, 1], matrices[:, 0, 2]
+    useM00 = numpy.abs(m00) > MATRIX_TO_EULER_TOLERANCE
+    useM01 = ~useM00 & (numpy.abs(m01) > MATRIX_TO_EULER_TOLERANCE)
+    singular = ~(useM00 | useM01)
+    azimuth = numpy.where(singular, 0.0, numpy.arctan2(m01, m00))
+    roll = numpy.where(singular, numpy.arctan2(-matrices[:, 2, 1], -matrices[:, 2, 0]*m02),
+                       numpy.arctan2(matrices[:, 1, 2], matrices[:, 2, 2]))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        elevation = numpy.where(useM00, numpy.arctan2(-m02, m00/numpy.cos(azimuth)),
+            numpy.where(useM01, numpy.arctan2(-m02, m01/numpy.sin(azimuth)), numpy.arctan2(-m02, 0.0)))
+    return numpy.stack([azimuth, elevation, roll], axis=-1)
+
+def transformPoints(points, matrix, offset=None):
+    '''
+    Affine transform points: matrix.x + offset.
+    :param points: (N, components) array
+    :param matrix: (components, components) matrix, or (N, components, components)
+    stack with one matrix per point
+    :param offset: optional (components,) offset, or (N, components) per point
+    :return: (N, components) transformed points
+    '''
+    points = numpy.asarray(points, dtype=numpy.float64)
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    if matrix.ndim == 2:
+        result = numpy.matmul(points, matrix.T)
+    else:
+        result = numpy.matmul(matrix, points[..., numpy.newaxis])[..., 0]
+    if offset is not None:
+        result += offset
+    return result
+
+def inverseTransformPoints(points, matrix, offset=None):
+    '''
+    Inverse of transformPoints: x where matrix.x + offset = points.
+    :param points: (N, components) array
+    :param matrix: invertible (components, components) matrix, or
+    (N, components, components) stack with one matrix per point
+    :param offset: optional (components,) offset, or (N, components) per point
+    :return: (N, components) points
+    '''
+    points = numpy.asarray(points, dtype=numpy.float64)
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    if offset is not None:
+        points = points - offset
+    if matrix.ndim == 2:
+        return numpy.linalg.solve(matrix, points.T).T
+    return numpy.linalg.solve(matrix, points[..., numpy.newaxis])[..., 0]
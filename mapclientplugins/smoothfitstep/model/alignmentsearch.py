@@ -0,0 +1,175 @@
+'''
+Multi-start alignment search: register the model surface with the data
+points from many initial rotations, optionally mirrored, in parallel
+worker processes, to escape local minima of iterative closest point on
+near-symmetric shapes.
+
+Every start is scored by a few closest point iterations between small
+subsamples of the model and data points, then the best few are refined to
+convergence on larger subsamples and ranked by trimmed RMS error.
+Closest point iteration converges slowly along near-symmetries, so
+refinement needs many more iterations than scoring.
+'''
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+from scipy.spatial import cKDTree
+from mapclientplugins.smoothfitstep.maths import registration
+from mapclientplugins.smoothfitstep.maths import vectorops
+
+_workerState = {}
+
+
+def _initialiseSearchWorker(modelPoints, scoreModelPoints, estimateScale, trimFraction):
+    _workerState.update(modelPoints=modelPoints, modelTree=cKDTree(modelPoints), scoreModelPoints=scoreModelPoints,
+                        scoreModelTree=cKDTree(scoreModelPoints), estimateScale=estimateScale,
+                        trimFraction=trimFraction)
+
+
+def _registerStarts(score, dataPoints, starts, maxIterations, tolerance):
+    '''
+    Refine each start by iterative closest point.
+    :param score: True to use the model points subsample for scoring
+    :param starts: list of (scale, matrix, translation, mirror)
+    :return: list of (scale, matrix, translation, mirror, rms_error, iterations)
+    '''
+    prefix = 'scoreModel' if score else 'model'
+    modelTree = _workerState[prefix + 'Tree']
+    modelPoints = _workerState[prefix + 'Points']
+    results = []
+    for scale, matrix, translation, mirror in starts:
+        scale, matrix, translation, rmsError, iterations = registration.iterateClosestPoint(
+            modelTree, modelPoints, dataPoints, scale, matrix, translation,
+            _workerState['estimateScale'], mirror, maxIterations, _workerState['trimFraction'], tolerance)
+        results.append((scale, matrix, translation, mirror, rmsError, iterations))
+    return results
+
+
+def _registerStartsTask(task):
+    return _registerStarts(*task)
+
+
+def sampleEulerAngles(count, seed=0):
+    '''
+    Sample Euler angles of rotations uniformly distributed over rotation
+    space, for vectorops.eulerToRotationMatrix3. The first is no rotation.
+    :return: (count, 3) azimuth, elevation, roll
+    '''
+    rng = numpy.random.default_rng(seed)
+    eulerAngles = numpy.stack([rng.uniform(-numpy.pi, numpy.pi, count),
+                               numpy.arcsin(rng.uniform(-1.0, 1.0, count)),
+                               rng.uniform(-numpy.pi, numpy.pi, count)], axis=1)
+    if count > 0:
+        eulerAngles[0] = 0.0
+    return eulerAngles
+
+
+def searchAlignments(modelPoints, dataPoints, estimateScale=True, scale=1.0, mirrors=(False,), rotationCount=200,
+                     refineCount=5, scoreModelSampleCount=3000, scoreSampleCount=300, scoreIterations=10,
+                     sampleCount=2000, maxIterations=200, trimFraction=0.1, tolerance=1.0E-6, seed=0, workerCount=1,
+                     progressCallback=None, cancelCallback=None):
+    '''
+    Register model points with data points from sampled initial rotations.
+    Each start places the scaled, rotated model centroid on the data
+    centroid, with scale from the ratio of point spreads if estimated.
+    :param modelPoints: (M, 3) points sampled over the model surface
+    :param dataPoints: (N, 3) data point cloud
+    :param estimateScale: True to fit scale, False to use scale
+    :param mirrors: mirror states to try: (False,), (True,) or (False, True)
+    :param rotationCount: number of initial rotations for each mirror state
+    :param refineCount: number of best scored starts to refine
+    :param scoreModelSampleCount: maximum number of model points used in scoring
+    :param scoreSampleCount: maximum number of data points used in scoring
+    :param scoreIterations: closest point iterations used in scoring
+    :param sampleCount: maximum number of data points used in refinement
+    :param workerCount: number of worker processes, 1 to search in this process
+    :param progressCallback: optional function(description, done, total)
+    :param cancelCallback: optional function returning True to stop early
+    :return: list of distinct result dicts in increasing order of rms_error
+    of refinement: euler_angles, scale, offset, mirror as for model align
+    settings, rms_error, iterations, start_euler_angles. Empty if cancelled.
+    '''
+    modelPoints = numpy.asarray(modelPoints, dtype=numpy.float64)
+    dataPoints = numpy.asarray(dataPoints, dtype=numpy.float64)
+    rng = numpy.random.default_rng(seed)
+    if dataPoints.shape[0] > sampleCount:
+        dataPoints = dataPoints[rng.choice(dataPoints.shape[0], sampleCount, replace=False)]
+    scoreDataPoints = dataPoints
+    if dataPoints.shape[0] > scoreSampleCount:
+        scoreDataPoints = dataPoints[rng.choice(dataPoints.shape[0], scoreSampleCount, replace=False)]
+    scoreModelPoints = modelPoints
+    if modelPoints.shape[0] > scoreModelSampleCount:
+        scoreModelPoints = modelPoints[rng.choice(modelPoints.shape[0], scoreModelSampleCount, replace=False)]
+    modelCentroid, modelAxes, modelVariances = registration.principalAxes(modelPoints)
+    dataCentroid, dataAxes, dataVariances = registration.principalAxes(dataPoints)
+    if estimateScale and (numpy.sum(modelVariances) > 0.0):
+        scale = float(numpy.sqrt(numpy.sum(dataVariances)/numpy.sum(modelVariances)))
+    eulerAngles = sampleEulerAngles(rotationCount, seed)
+    rotations = vectorops.eulerToRotationMatrices3(eulerAngles)
+    startEulerAngles = []
+    starts = []
+    for mirror in mirrors:
+        matrices = numpy.matmul(registration.MIRROR_MATRIX, rotations) if mirror else rotations
+        translations = dataCentroid - scale*vectorops.transformPoints(modelCentroid[numpy.newaxis], matrices)
+        for matrix, translation in zip(matrices, translations):
+            starts.append((scale, matrix, translation, mirror))
+        startEulerAngles += eulerAngles.tolist()
+    chunkCount = max(1, min(len(starts), 4*workerCount))
+    chunks = [list(range(len(starts)))[i::chunkCount] for i in range(chunkCount)]
+    scoreTasks = [(True, scoreDataPoints, [starts[i] for i in chunk], scoreIterations, 1.0E-3) for chunk in chunks]
+    initargs = (modelPoints, scoreModelPoints, estimateScale, trimFraction)
+    total = len(scoreTasks) + refineCount
+    scored = [None]*len(starts)
+    refined = []
+    executor = None
+    if workerCount > 1:
+        context = multiprocessing.get_context('spawn')
+        executor = ProcessPoolExecutor(max_workers=workerCount, mp_context=context,
+                                       initializer=_initialiseSearchWorker, initargs=initargs)
+        mapTasks = executor.map
+    else:
+        _initialiseSearchWorker(*initargs)
+        mapTasks = map
+    try:
+        done = 0
+        cancelled = False
+        for chunk, chunkResults in zip(chunks, mapTasks(_registerStartsTask, scoreTasks)):
+            for i, result in zip(chunk, chunkResults):
+                scored[i] = result
+            done += 1
+            if progressCallback is not None:
+                progressCallback('Scoring alignments', done, total)
+            if (cancelCallback is not None) and cancelCallback():
+                cancelled = True
+                break
+        if not cancelled:
+            best = numpy.argsort([result[4] for result in scored], kind='stable')[:refineCount]
+            refineTasks = [(False, dataPoints, [scored[i][:4]], maxIterations, tolerance) for i in best]
+            for index, taskResults in zip(best, mapTasks(_registerStartsTask, refineTasks)):
+                refined.append((index,) + taskResults[0])
+                done += 1
+                if progressCallback is not None:
+                    progressCallback('Refining alignments', done, total)
+                if (cancelCallback is not None) and cancelCallback():
+                    cancelled = True
+                    break
+        if cancelled:
+            refined = []
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            _workerState.clear()
+    # starts refined to the same alignment are ranked once
+    refined.sort(key=lambda result: result[5])
+    results = []
+    rankedMatrices = []
+    for index, resultScale, matrix, translation, mirror, rmsError, iterations in refined:
+        if any(numpy.allclose(matrix, rankedMatrix, atol=1.0E-3) for rankedMatrix in rankedMatrices):
+            continue
+        rankedMatrices.append(matrix)
+        rotation = numpy.matmul(registration.MIRROR_MATRIX, matrix) if mirror else matrix
+        results.append(dict(euler_angles=vectorops.rotationMatrix3ToEuler(rotation.tolist()), scale=float(resultScale),
+            offset=translation.tolist(), mirror=mirror, rms_error=rmsError, iterations=iterations,
+            start_euler_angles=startEulerAngles[index]))
+    return results
@@ -0,0 +1,134 @@
+'''
+Penalty weight sweep: fit with every combination of a grid of strain and
+curvature penalties, in parallel worker processes, to choose penalties
+from the L-curve of data error against penalty energy.
+
+Every fit starts from the same model and data projections and solves the
+linear direct least squares problem. Penalty rows are linear in the
+penalty weights, so rows for unit weights are assembled once and each
+worker only scales them and solves.
+'''
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import scipy.sparse
+from mapclientplugins.smoothfitstep.maths import linearfit
+
+_workerState = {}
+
+
+def _initialiseSweepWorker(dataRows, dataTargets, strainRows, curvatureRows, referenceParameters, parameters, free):
+    _workerState.update(dataRows=dataRows, dataTargets=dataTargets, strainRows=strainRows,
+        curvatureRows=curvatureRows, referenceParameters=referenceParameters, parameters=parameters, free=free)
+
+
+def _sweepFit(penalties):
+    '''
+    :param penalties: (strainPenalty, curvaturePenalty)
+    :return: result dict for fit with these penalties
+    '''
+    strainPenalty, curvaturePenalty = penalties
+    dataRows = _workerState['dataRows']
+    dataTargets = _workerState['dataTargets']
+    strainRows = _workerState['strainRows']
+    curvatureRows = _workerState['curvatureRows']
+    referenceParameters = _workerState['referenceParameters']
+    matrix = scipy.sparse.vstack([dataRows, strainPenalty*strainRows, curvaturePenalty*curvatureRows], format='csr')
+    targets = numpy.concatenate([dataTargets, strainPenalty*strainRows.dot(referenceParameters),
+                                 curvaturePenalty*curvatureRows.dot(referenceParameters)])
+    solution, objectiveBefore, objectiveAfter = linearfit.solveLinearLeastSquares(
+        matrix, targets, _workerState['parameters'], _workerState['free'])
+    dataResidual = dataRows.dot(solution) - dataTargets
+    dataError = float(numpy.sum(dataResidual*dataResidual))
+    displacement = solution - referenceParameters
+    strainEnergy = float(numpy.sum(strainRows.dot(displacement)**2))
+    curvatureEnergy = float(numpy.sum(curvatureRows.dot(displacement)**2))
+    pointCount = dataTargets.shape[0]
+    return dict(strain_penalty=strainPenalty, curvature_penalty=curvaturePenalty, data_error=dataError,
+        rms_error=float(numpy.sqrt(dataError/pointCount)) if pointCount else 0.0,
+        strain_energy=strainEnergy, curvature_energy=curvatureEnergy,
+        penalty_energy=strainEnergy + curvatureEnergy, objective=objectiveAfter)
+
+
+def sweepPenalties(dataRows, dataTargets, strainRows, curvatureRows, referenceParameters, parameters, free,
+                   strainPenalties, curvaturePenalties, workerCount=1, progressCallback=None, cancelCallback=None):
+    '''
+    Fit with every combination of strain and curvature penalties.
+    :param dataRows: sparse (N, D) matrix interpolating the model at data projections
+    :param dataTargets: (N, components) data point coordinates
+    :param strainRows, curvatureRows: sparse penalty rows for unit penalty weights
+    :param referenceParameters: (D, components) reference nodal parameters
+    :param parameters: (D, components) starting nodal parameters
+    :param free: boolean array (D,), True for parameters to fit
+    :param workerCount: number of worker processes, 1 to fit in this process
+    :param progressCallback: optional function(description, done, total)
+    :param cancelCallback: optional function returning True to stop early
+    :return: list of result dicts in grid order, strain penalty slowest varying:
+    strain_penalty, curvature_penalty, data_error (sum of squares), rms_error,
+    strain_energy, curvature_energy, penalty_energy (sums of squares of
+    penalties with unit weights), objective. Shorter if cancelled.
+    '''
+    grid = [(float(strainPenalty), float(curvaturePenalty))
+            for strainPenalty in strainPenalties for curvaturePenalty in curvaturePenalties]
+    initargs = (dataRows, dataTargets, strainRows, curvatureRows, referenceParameters, parameters, free)
+    results = []
+    if workerCount > 1:
+        context = multiprocessing.get_context('spawn')
+        executor = ProcessPoolExecutor(max_workers=workerCount, mp_context=context,
+                                       initializer=_initialiseSweepWorker, initargs=initargs)
+        try:
+            for result in executor.map(_sweepFit, grid):
+                results.append(result)
+                if progressCallback is not None:
+                    progressCallback('Sweeping penalties', len(results), len(grid))
+                if (cancelCallback is not None) and cancelCallback():
+                    break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    else:
+        _initialiseSweepWorker(*initargs)
+        try:
+            for penalties in grid:
+                if (cancelCallback is not None) and cancelCallback():
+                    break
+                results.append(_sweepFit(penalties))
+                if progressCallback is not None:
+                    progressCallback('Sweeping penalties', len(results), len(grid))
+        finally:
+            _workerState.clear()
+    return results
+
+
+def getLCurve(results):
+    '''
+    Get the L-curve of sweep results: those not bettered in both data error
+    and penalty energy by any other, in increasing order of data error, and
+    the corner of greatest curvature of log penalty energy against log data
+    error, which balances fitting the data against smoothness.
+    :param results: list of result dicts from sweepPenalties
+    :return: indexes of L-curve results, index of corner result or None if
+    fewer than 3 L-curve results have positive errors and energies
+    '''
+    if not results:
+        return [], None
+    dataErrors = numpy.array([result['data_error'] for result in results])
+    penaltyEnergies = numpy.array([result['penalty_energy'] for result in results])
+    order = numpy.lexsort((penaltyEnergies, dataErrors))
+    curve = []
+    lowestPenaltyEnergy = numpy.inf
+    for index in order:
+        if penaltyEnergies[index] < lowestPenaltyEnergy:
+            curve.append(int(index))
+            lowestPenaltyEnergy = penaltyEnergies[index]
+    positive = [index for index in curve if (dataErrors[index] > 0.0) and (penaltyEnergies[index] > 0.0)]
+    if len(positive) < 3:
+        return curve, None
+    x = numpy.log10(dataErrors[positive])
+    y = numpy.log10(penaltyEnergies[positive])
+    # Menger curvature through each point and its neighbours
+    ax, ay = x[:-2] - x[1:-1], y[:-2] - y[1:-1]
+    bx, by = x[2:] - x[1:-1], y[2:] - y[1:-1]
+    cx, cy = x[2:] - x[:-2], y[2:] - y[:-2]
+    denominator = numpy.sqrt((ax*ax + ay*ay)*(bx*bx + by*by)*(cx*cx + cy*cy))
+    curvature = numpy.abs(ax*by - ay*bx)/numpy.where(denominator > 0.0, denominator, numpy.inf)
+    return curve, positive[int(numpy.argmax(curvature)) + 1]
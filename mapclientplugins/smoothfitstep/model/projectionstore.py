@@ -0,0 +1,179 @@
+'''
+Compact array store of data point projections, the source of truth for
+projections found in batch, with zinc stored mesh locations synchronised
+from it in bulk only when zinc fields need them.
+'''
+import numpy
+
+
+def _bitsToMask(bits, count):
+    return numpy.unpackbits(bits, count=count).view(bool)
+
+
+class DataProjectionStore(object):
+    '''
+    Element identifiers (int32) and xi (float64) of projections of data
+    points, indexed by position of data point identifiers in a sorted int32
+    array. Bitsets mark points with a current projection and points changed
+    since last synchronised with zinc.
+    '''
+
+    def __init__(self, dimension):
+        '''
+        :param dimension: dimension of mesh projected onto
+        '''
+        self._dimension = dimension
+        self._identifiers = numpy.empty(0, dtype=numpy.int32)
+        self.clear()
+
+    def clear(self):
+        '''
+        Remove all projections in constant time, keeping data point
+        identifiers. Arrays are reallocated when next set.
+        '''
+        self._elementIdentifiers = None
+        self._xi = None
+        self._projectedBits = None
+        self._unsyncedBits = None
+        self._projectedCount = 0
+
+    def getDimension(self):
+        return self._dimension
+
+    def getNumberOfDataPoints(self):
+        return self._identifiers.size
+
+    def getNumberOfProjections(self):
+        return self._projectedCount
+
+    def _allocate(self):
+        count = self._identifiers.size
+        if self._elementIdentifiers is None:
+            self._elementIdentifiers = numpy.full(count, -1, dtype=numpy.int32)
+            self._xi = numpy.zeros((count, self._dimension))
+            self._projectedBits = numpy.zeros((count + 7)//8, dtype=numpy.uint8)
+            self._unsyncedBits = numpy.zeros((count + 7)//8, dtype=numpy.uint8)
+
+    def _addIdentifiers(self, identifiers):
+        '''
+        Add data point identifiers not already stored, keeping order.
+        :return: positions of identifiers in store
+        '''
+        positions, found = self._getPositions(identifiers)
+        if found.all():
+            return positions
+        newIdentifiers = numpy.sort(identifiers[~found])
+        newIdentifiers = newIdentifiers[numpy.concatenate([[True], newIdentifiers[1:] != newIdentifiers[:-1]])]
+        if self._identifiers.size == 0:
+            self._identifiers = newIdentifiers
+            return numpy.searchsorted(self._identifiers, identifiers)
+        allIdentifiers = numpy.sort(numpy.concatenate([self._identifiers, newIdentifiers]))
+        if self._elementIdentifiers is not None:
+            count = self._identifiers.size
+            positions = numpy.searchsorted(allIdentifiers, self._identifiers)
+            elementIdentifiers = numpy.full(allIdentifiers.size, -1, dtype=numpy.int32)
+            elementIdentifiers[positions] = self._elementIdentifiers
+            xi = numpy.zeros((allIdentifiers.size, self._dimension))
+            xi[positions] = self._xi
+            projected = numpy.zeros(allIdentifiers.size, dtype=bool)
+            projected[positions] = _bitsToMask(self._projectedBits, count)
+            unsynced = numpy.zeros(allIdentifiers.size, dtype=bool)
+            unsynced[positions] = _bitsToMask(self._unsyncedBits, count)
+            self._elementIdentifiers = elementIdentifiers
+            self._xi = xi
+            self._projectedBits = numpy.packbits(projected)
+            self._unsyncedBits = numpy.packbits(unsynced)
+        self._identifiers = allIdentifiers
+        return numpy.searchsorted(self._identifiers, identifiers)
+
+    def _getPositions(self, identifiers):
+        '''
+        :return: positions of identifiers in store, and mask of those found
+        '''
+        positions = numpy.minimum(numpy.searchsorted(self._identifiers, identifiers),
+                                  max(self._identifiers.size - 1, 0))
+        if self._identifiers.size == 0:
+            return positions, numpy.zeros(identifiers.size, dtype=bool)
+        found = self._identifiers[positions] == identifiers
+        return positions, found
+
+    def setProjections(self, identifiers, elementIdentifiers, xi):
+        '''
+        Set projections of data points, marking them as changed.
+        :param identifiers: N data point identifiers
+        :param elementIdentifiers: N element identifiers
+        :param xi: (N, dimension) element xi
+        '''
+        identifiers = numpy.asarray(identifiers, dtype=numpy.int32)
+        if identifiers.size == 0:
+            return
+        positions = self._addIdentifiers(identifiers)
+        self._allocate()
+        count = self._identifiers.size
+        self._elementIdentifiers[positions] = elementIdentifiers
+        self._xi[positions] = numpy.asarray(xi, dtype=numpy.float64).reshape(-1, self._dimension)
+        projected = _bitsToMask(self._projectedBits, count)
+        projected[positions] = True
+        self._projectedBits = numpy.packbits(projected)
+        self._projectedCount = int(numpy.count_nonzero(projected))
+        unsynced = _bitsToMask(self._unsyncedBits, count)
+        unsynced[positions] = True
+        self._unsyncedBits = numpy.packbits(unsynced)
+
+    def getProjections(self, identifiers):
+        '''
+        :param identifiers: N data point identifiers
+        :return: element identifiers (N,) with -1 where not projected, xi (N, dimension)
+        '''
+        identifiers = numpy.asarray(identifiers, dtype=numpy.int32)
+        elementIdentifiers = numpy.full(identifiers.size, -1, dtype=numpy.int32)
+        xi = numpy.zeros((identifiers.size, self._dimension))
+        if self._elementIdentifiers is not None:
+            positions, found = self._getPositions(identifiers)
+            elementIdentifiers[found] = self._elementIdentifiers[positions[found]]
+            xi[found] = self._xi[positions[found]]
+        return elementIdentifiers, xi
+
+    def getUnsyncedProjections(self):
+        '''
+        :return: identifiers, element identifiers and xi of projections
+        changed since setSynced
+        '''
+        if self._elementIdentifiers is None:
+            return numpy.empty(0, dtype=numpy.int32), numpy.empty(0, dtype=numpy.int32), \
+                numpy.empty((0, self._dimension))
+        count = self._identifiers.size
+        positions = numpy.flatnonzero(_bitsToMask(self._unsyncedBits, count) & _bitsToMask(self._projectedBits, count))
+        return self._identifiers[positions], self._elementIdentifiers[positions], self._xi[positions]
+
+    def getProjectedIdentifiers(self):
+        '''
+        :return: sorted identifiers of data points with projections
+        '''
+        if self._projectedBits is None:
+            return numpy.empty(0, dtype=numpy.int32)
+        return self._identifiers[_bitsToMask(self._projectedBits, self._identifiers.size)]
+
+    def isSynced(self):
+        return (self._unsyncedBits is None) or not numpy.any(self._unsyncedBits)
+
+    def setSynced(self):
+        if self._unsyncedBits is not None:
+            self._unsyncedBits[:] = 0
+
+    def getMemoryBytes(self):
+        '''
+        :return: total bytes of identifier, projection and bitset arrays
+        '''
+        arrays = [self._identifiers, self._elementIdentifiers, self._xi, self._projectedBits, self._unsyncedBits]
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def getMemoryReport(self):
+        '''
+        :return: dict with data_points, projections, bytes and
+        bytes_per_million_points
+        '''
+        count = self._identifiers.size
+        memoryBytes = self.getMemoryBytes()
+        return dict(data_points=count, projections=self._projectedCount, bytes=memoryBytes,
+                    bytes_per_million_points=(1.0E6*memoryBytes/count) if count else 0.0)
@@ -0,0 +1,272 @@
+'''
+Datapoint projection sharded across a pool of worker processes.
+
+Worker processes are started with the spawn method so they begin from a
+fresh interpreter instead of a fork of the MAP Client process and its Qt
+and Zinc state. Unpickling the worker functions still imports this
+package, whose __init__ imports the step and with it PySide2 and MAP
+Client, so starting workers is slow. A ProjectionWorkerPool is therefore
+kept for the lifetime of the model. Each call writes what the workers need
+to a temporary file: either the spatial index for batch projection, or a
+serialised copy of the model from which each worker builds its own Zinc
+context and region for reference projection. Workers reload it only when
+it changes.
+'''
+import math
+import multiprocessing
+import os
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+
+_workerState = {}
+
+
+def _shardRanges(count, shardCount):
+    bounds = numpy.linspace(0, count, shardCount + 1).astype(int)
+    return [(bounds[i], bounds[i + 1]) for i in range(shardCount) if bounds[i + 1] > bounds[i]]
+
+
+def _runTask(task):
+    '''
+    Load worker state from file if not already loaded, then call function.
+    :param task: (state file name, initialiser, function, arguments)
+    '''
+    stateFileName, initialiser, function, arguments = task
+    if _workerState.get('stateFileName') != stateFileName:
+        _workerState.clear()
+        with open(stateFileName, 'rb') as f:
+            initialiser(*pickle.load(f))
+        _workerState['stateFileName'] = stateFileName
+    return function(*arguments)
+
+
+def _initialiseSpatialIndexWorker(spatialIndex):
+    _workerState['spatialIndex'] = spatialIndex
+
+
+def _findNearestLocationsShard(points):
+    return _workerState['spatialIndex'].findNearestLocations(points) + (points.shape[0],)
+
+
+def _findNearestLocationsLocalShard(points, elementIndexes, xi, previousDistances):
+    return _workerState['spatialIndex'].findNearestLocationsLocal(points, elementIndexes, xi, previousDistances)
+
+
+def serialiseModel(region, coordinateField):
+    '''
+    Write nodes and elements with coordinateField to a memory buffer.
+    :return: buffer readable by region read from a memory buffer resource
+    '''
+    from opencmiss.zinc.field import Field
+    from opencmiss.zinc.status import OK as ZINC_OK
+    streamInfo = region.createStreaminformationRegion()
+    memoryResource = streamInfo.createStreamresourceMemory()
+    streamInfo.setFieldNames([coordinateField.getName()])
+    streamInfo.setResourceDomainTypes(memoryResource,
+        Field.DOMAIN_TYPE_NODES | Field.DOMAIN_TYPE_MESH1D | Field.DOMAIN_TYPE_MESH2D | Field.DOMAIN_TYPE_MESH3D)
+    result = region.write(streamInfo)
+    if result != ZINC_OK:
+        raise ValueError('Failed to serialise model')
+    result, buffer = memoryResource.getBuffer()
+    if result != ZINC_OK:
+        raise ValueError('Failed to serialise model')
+    return buffer
+
+
+def _initialiseZincWorker(modelBuffer, coordinateFieldName, dimension, elementIdentifiers):
+    from opencmiss.zinc.context import Context
+    from opencmiss.zinc.field import Field, FieldFindMeshLocation
+    from opencmiss.zinc.status import OK as ZINC_OK
+    context = Context('projectionworker')
+    region = context.getDefaultRegion()
+    streamInfo = region.createStreaminformationRegion()
+    streamInfo.createStreamresourceMemoryBuffer(modelBuffer)
+    if region.read(streamInfo) != ZINC_OK:
+        raise ValueError('Projection worker failed to read model')
+    fm = region.getFieldmodule()
+    fm.beginChange()
+    mesh = fm.findMeshByDimension(dimension)
+    if elementIdentifiers is not None:
+        elementGroup = fm.createFieldElementGroup(mesh)
+        meshGroup = elementGroup.getMeshGroup()
+        for elementIdentifier in elementIdentifiers:
+            meshGroup.addElement(mesh.findElementByIdentifier(int(elementIdentifier)))
+        mesh = meshGroup
+        _workerState['elementGroup'] = elementGroup
+    dataCoordinateField = fm.createFieldFiniteElement(3)
+    dataCoordinateField.setName('data_coordinates')
+    dataCoordinateField.setTypeCoordinate(True)
+    modelCoordinateField = fm.findFieldByName(coordinateFieldName)
+    findMeshLocationField = fm.createFieldFindMeshLocation(dataCoordinateField, modelCoordinateField, mesh)
+    findMeshLocationField.setSearchMode(FieldFindMeshLocation.SEARCH_MODE_NEAREST)
+    fm.endChange()
+    _workerState.update(context=context, region=region, dimension=dimension,
+        dataCoordinateField=dataCoordinateField, findMeshLocationField=findMeshLocationField,
+        datapoints=fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS))
+
+
+def _findMeshLocationsShard(dataCoordinates):
+    dimension = _workerState['dimension']
+    dataCoordinateField = _workerState['dataCoordinateField']
+    findMeshLocationField = _workerState['findMeshLocationField']
+    datapoints = _workerState['datapoints']
+    fm = dataCoordinateField.getFieldmodule()
+    count = dataCoordinates.shape[0]
+    elementIdentifiers = numpy.full(count, -1, dtype=numpy.int32)
+    xi = numpy.zeros((count, dimension))
+    fm.beginChange()
+    nodetemplate = datapoints.createNodetemplate()
+    nodetemplate.defineField(dataCoordinateField)
+    cache = fm.createFieldcache()
+    for i, location in enumerate(dataCoordinates.tolist()):
+        datapoint = datapoints.createNode(-1, nodetemplate)
+        cache.setNode(datapoint)
+        dataCoordinateField.assignReal(cache, location)
+        element, elementXi = findMeshLocationField.evaluateMeshLocation(cache, dimension)
+        if element.isValid():
+            elementIdentifiers[i] = element.getIdentifier()
+            xi[i] = elementXi
+    datapoints.destroyAllNodes()
+    fm.endChange()
+    return elementIdentifiers, xi
+
+
+class ProjectionWorkerPool(object):
+    '''
+    Spawned worker processes for sharding projections, started on first use
+    and kept until shutdown. Points are split into chunks of at most
+    chunkSize, and at least one per worker, with progress reported and
+    cancel checked as each chunk completes.
+    '''
+
+    def __init__(self, workerCount, chunkSize):
+        '''
+        :param workerCount: number of worker processes
+        :param chunkSize: maximum number of points per task
+        '''
+        self._workerCount = workerCount
+        self._chunkSize = chunkSize
+        self._executor = None
+        self._stateFileName = None
+        self._initialiser = None
+
+    def getWorkerCount(self):
+        return self._workerCount
+
+    def shutdown(self):
+        '''
+        Stop worker processes and remove worker state file.
+        '''
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self._removeStateFile()
+
+    def _removeStateFile(self):
+        if self._stateFileName is not None:
+            try:
+                os.remove(self._stateFileName)
+            except OSError:
+                pass
+            self._stateFileName = None
+
+    def _setWorkerState(self, initialiser, initargs):
+        '''
+        Write arguments for initialiser to a new state file, loaded by each
+        worker before its next task.
+        '''
+        self._removeStateFile()
+        fileDescriptor, self._stateFileName = tempfile.mkstemp(prefix='smoothfit-projection-', suffix='.pickle')
+        with os.fdopen(fileDescriptor, 'wb') as f:
+            pickle.dump(initargs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._initialiser = initialiser
+
+    def _mapChunks(self, function, count, getArguments, progressCallback, cancelCallback):
+        '''
+        :param getArguments: function(start, stop) returning arguments for chunk
+        :return: list of chunk results in order, or None if cancelled
+        '''
+        if self._executor is None:
+            context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self._workerCount, mp_context=context)
+        ranges = _shardRanges(count, max(self._workerCount, math.ceil(count/self._chunkSize)))
+        futures = [self._executor.submit(_runTask, (self._stateFileName, self._initialiser, function,
+                                                    getArguments(start, stop))) for start, stop in ranges]
+        results = []
+        for (start, stop), future in zip(ranges, futures):
+            results.append(future.result())
+            if progressCallback is not None:
+                progressCallback('Projecting points', stop, count)
+            if (cancelCallback is not None) and cancelCallback():
+                for pendingFuture in futures:
+                    pendingFuture.cancel()
+                return None
+        return results
+
+    def findNearestLocations(self, spatialIndex, points, elementIndexes=None, xi=None, previousDistances=None,
+                             progressCallback=None, cancelCallback=None):
+        '''
+        Shard MeshSpatialIndex.findNearestLocations, or findNearestLocationsLocal
+        if previous elementIndexes and xi, and optionally previousDistances, are
+        supplied, across worker processes.
+        Results are identical to calling the spatial index directly.
+        :param progressCallback: optional function(description, done, total)
+        :param cancelCallback: optional function returning True to stop early
+        :return: elementIndexes, xi, distances, number of points searched outside
+        their local patch (all points if not warm started), or None if cancelled
+        '''
+        self._setWorkerState(_initialiseSpatialIndexWorker, (spatialIndex,))
+        if elementIndexes is None:
+            results = self._mapChunks(_findNearestLocationsShard, points.shape[0],
+                lambda start, stop: (points[start:stop],), progressCallback, cancelCallback)
+        else:
+            results = self._mapChunks(_findNearestLocationsLocalShard, points.shape[0],
+                lambda start, stop: (points[start:stop], elementIndexes[start:stop], xi[start:stop],
+                                     None if previousDistances is None else previousDistances[start:stop]),
+                progressCallback, cancelCallback)
+        if results is None:
+            return None
+        if not results:
+            dimension = spatialIndex.getPatches().getDimension()
+            return numpy.empty(0, dtype=numpy.int32), numpy.empty((0, dimension)), numpy.empty(0), 0
+        return (numpy.concatenate([result[0] for result in results]),
+                numpy.concatenate([result[1] for result in results]),
+                numpy.concatenate([result[2] for result in results]),
+                sum(result[3] for result in results))
+
+    def findMeshLocations(self, region, coordinateField, mesh, dataCoordinates,
+                          progressCallback=None, cancelCallback=None):
+        '''
+        Shard zinc nearest find mesh location over worker processes, each with
+        its own context and region read from a serialised copy of the model.
+        :param region: region containing the model
+        :param coordinateField: model coordinate field
+        :param mesh: mesh or mesh group to find locations in
+        :param dataCoordinates: (N, 3) coordinates to find nearest locations to
+        :param progressCallback: optional function(description, done, total)
+        :param cancelCallback: optional function returning True to stop early
+        :return: element identifiers (N,) with -1 where not found, xi (N, dimension),
+        or None if cancelled
+        '''
+        modelBuffer = serialiseModel(region, coordinateField)
+        dimension = mesh.getDimension()
+        fm = region.getFieldmodule()
+        elementIdentifiers = None
+        if mesh.getSize() != fm.findMeshByDimension(dimension).getSize():
+            elementIdentifiers = []
+            elementIter = mesh.createElementiterator()
+            element = elementIter.next()
+            while element.isValid():
+                elementIdentifiers.append(element.getIdentifier())
+                element = elementIter.next()
+        self._setWorkerState(_initialiseZincWorker,
+                             (modelBuffer, coordinateField.getName(), dimension, elementIdentifiers))
+        results = self._mapChunks(_findMeshLocationsShard, dataCoordinates.shape[0],
+            lambda start, stop: (dataCoordinates[start:stop],), progressCallback, cancelCallback)
+        if results is None:
+            return None
+        if not results:
+            return numpy.empty(0, dtype=numpy.int32), numpy.empty((0, dimension))
+        return numpy.concatenate([result[0] for result in results]), numpy.concatenate([result[1] for result in results])
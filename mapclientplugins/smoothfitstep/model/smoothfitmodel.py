@@ -4,6 +4,11 @@ Created on Jul 16, 2015
 @author: Richard Christie
 '''
 import json
+import os
+import time
+import numpy
+import scipy.sparse
+from scipy.spatial import cKDTree
 from opencmiss.zinc.context import Context
 from opencmiss.zinc.field import Field, FieldFindMeshLocation
 from opencmiss.zinc.glyph import Glyph
@@ -13,7 +18,18 @@ from opencmiss.zinc.optimisation import Optimisation
 from opencmiss.zinc.scenefilter import Scenefilter
 from opencmiss.zinc.scenecoordinatesystem import SCENECOORDINATESYSTEM_NORMALISED_WINDOW_FIT_LEFT
 from opencmiss.zinc.status import OK as ZINC_OK
+from opencmiss.zinc.streamregion import StreaminformationRegion
+from mapclientplugins.smoothfitstep.maths import decimation
+from mapclientplugins.smoothfitstep.maths import linearfit
+from mapclientplugins.smoothfitstep.maths import registration
 from mapclientplugins.smoothfitstep.maths import vectorops
+from mapclientplugins.smoothfitstep.maths.elementpatches import ElementPatches
+from mapclientplugins.smoothfitstep.maths.spatialindex import MeshSpatialIndex
+from mapclientplugins.smoothfitstep.model import alignmentsearch
+from mapclientplugins.smoothfitstep.model import penaltysweep
+from mapclientplugins.smoothfitstep.model import projectionworkers
+from mapclientplugins.smoothfitstep.model.projectionstore import DataProjectionStore
+from mapclientplugins.smoothfitstep.utils import pointcloud
 from mapclientplugins.smoothfitstep.utils import zinc as zincutils
 
 class SmoothfitModel(object):
@@ -21,6 +37,17 @@ class SmoothfitModel(object):
     classdocs
     '''
 
+    PROJECTION_MODE_BATCH = 'batch' # vectorised nearest location search
+    PROJECTION_MODE_REFERENCE = 'reference' # per-datapoint zinc find mesh location
+    DECIMATION_METHOD_VOXEL_GRID = 'voxel_grid' # keep point closest to mean in each voxel
+    DECIMATION_METHOD_POISSON_DISK = 'poisson_disk' # keep random points no closer than spacing
+    FIT_METHOD_QUASI_NEWTON = 'quasi_newton' # zinc least squares optimisation
+    FIT_METHOD_LINEAR_DIRECT = 'linear_direct' # sparse normal equations for fixed projections
+    FIT_PENALTIES = ['strain', 'curvature', 'edge_discontinuity']
+    MAXIMUM_QUADRATURE_POINTS = 4 # maximum Gauss points per xi direction in zinc mesh integrals
+    PROGRESS_CHUNK_SIZE = 100000 # points projected between progress reports and cancel checks
+    FIT_PROGRESS_ITERATIONS = 5 # quasi-Newton iterations between progress reports and cancel checks
+
     def __init__(self):
         '''
         Constructor
@@ -44,10 +71,26 @@ class SmoothfitModel(object):
         defaultTessellation.setRefinementFactors([12])
         self._location = None
         self._zincModelFile = None
+        self._zincModelFileCache = None # (fileName, modification time, size, contents)
         self._zincPointCloudFile = None
         self._pointCloudData = None
+        self._pointCloudLoadReport = {}
         self._filterTopErrorProportion = 0.9
         self._filterNonNormalProjectionLimit = 0.99
+        self._decimationMethod = self.DECIMATION_METHOD_VOXEL_GRID
+        self._decimationSpacing = 0.0
+        self._decimateOnLoad = False
+        self._projectionMode = self.PROJECTION_MODE_BATCH
+        self._projectionWarmStart = True
+        self._projectionMovedTolerance = None
+        self._projectionWorkerCount = 1
+        self._projectionWorkerPool = None
+        self._autoRegisterScale = True
+        self._autoRegisterMirrorSearch = False
+        self._alignPreviewSampleCount = 1000
+        self._alignSettingsChangeCallback = None
+        self._alignChangeDeferredCallback = None
+        self._alignUpdateInterval = 0.0
         self._enableLoadPreviousSolution = False
         self.clear()
 
@@ -65,13 +108,41 @@ class SmoothfitModel(object):
         self._dataCoordinateField = None
         self._findMeshLocationField = None
         self._storedMeshLocationField = None
+        self._dataProjectionStore = None
+        self._dataProjectionMesh = None
+        self._dataProjectionZincIdentifiers = None
         self._activeDataPointGroupField = None
+        self._decimatedDataPointGroupField = None
+        self._scheduleDecimatedDataPointGroupField = None
         self._dataProjectionCoordinateField = None
         self._dataProjectionDeltaCoordinateField = None
         self._dataProjectionErrorField = None
         self._dataProjectionMeanErrorField = None
         self._dataProjectionMaximumErrorField = None
         self._projectSurfaceElementGroup = None
+        self._fieldmodulenotifier = None
+        self._spatialIndex = None
+        self._spatialIndexMesh = None
+        self._dataProjectionReport = {}
+        self._dataProjectionPatches = None
+        self._fitReport = {}
+        self._fitHistory = []
+        self._penaltySweepResults = []
+        self._alignSearchResults = []
+        self._alignPreview = None
+        self._alignChangeLevel = 0
+        self._alignChangePending = False
+        self._alignUpdateTime = None
+        self._fitTelemetry = False
+        self._fitOptimisation = None
+        self._fitDataObjectiveField = None
+        self._fitOptimisationKey = None
+        self._fitPenaltyWeightFields = {}
+        self._fitPenaltyObjectiveFields = {}
+        self._fitPenaltyObjectivesAdded = set()
+        self._adaptiveQuadraturePoints = {}
+        self._progressCallback = None
+        self._cancelRequested = False
         self._resetAlignSettings()
         self._resetFitSettings()
         self._isStateAlign = True
@@ -85,6 +156,9 @@ class SmoothfitModel(object):
     def getRegion(self):
         return self._region
 
+    def getModelCoordinateField(self):
+        return self._modelCoordinateField
+
     def setZincModelFile(self, zincModelFile):
         self._zincModelFile = zincModelFile
 
@@ -92,10 +166,22 @@ class SmoothfitModel(object):
         self._zincPointCloudFile = zincPointCloudFile
 
     def setPointCloudData(self, pointCloudData):
+        '''
+        :param pointCloudData: list of [x, y, z], (N, 3) array or buffer of float64 x, y, z.
+        '''
         self._pointCloudData = pointCloudData
 
+    def getPointCloudLoadReport(self):
+        '''
+        :return: dict with number of points, seconds and points_per_second
+        for the last point cloud data loaded.
+        '''
+        return self._pointCloudLoadReport
+
     def initialise(self):
         self._region = self._context.createRegion()
+        self._fieldmodulenotifier = self._region.getFieldmodule().createFieldmodulenotifier()
+        self._fieldmodulenotifier.setCallback(self._fieldmoduleCallback)
         self.load()
         if self._enableLoadPreviousSolution and self.loadPreviousSolution():
             # can't do this yet as haven't stored transformation!
@@ -103,6 +189,16 @@ class SmoothfitModel(object):
         else:
             self.setStateAlign()
 
+    def _fieldmoduleCallback(self, fieldmoduleevent):
+        '''
+        Invalidate spatial index when model coordinates change. Called on the
+        thread making the change, which may be an operation's worker thread,
+        so only model state is changed here.
+        '''
+        if (self._spatialIndex is not None) and (fieldmoduleevent.getFieldChangeFlags(self._modelCoordinateField) &
+                (Field.CHANGE_FLAG_DEFINITION | Field.CHANGE_FLAG_FULL_RESULT | Field.CHANGE_FLAG_PARTIAL_RESULT)):
+            self._spatialIndex = None
+
 # ----- Align Settings -----
 
     def _resetAlignSettings(self):
@@ -111,6 +207,60 @@ class SmoothfitModel(object):
     def setAlignSettingsChangeCallback(self, alignSettingsChangeCallback):
         self._alignSettingsChangeCallback = alignSettingsChangeCallback
 
+    def setAlignChangeDeferredCallback(self, alignChangeDeferredCallback):
+        '''
+        :param alignChangeDeferredCallback: function(seconds) called when an
+        align change is deferred by the align update interval, with the time
+        after which flushAlignChanges should be called, or None.
+        '''
+        self._alignChangeDeferredCallback = alignChangeDeferredCallback
+
+    def getAlignUpdateInterval(self):
+        return self._alignUpdateInterval
+
+    def setAlignUpdateInterval(self, alignUpdateInterval):
+        '''
+        Rate limit interactive align changes, e.g. from mouse drags.
+        :param alignUpdateInterval: minimum seconds between applying align
+        changes to the model transformation. Changes within it are deferred
+        until flushAlignChanges is called. 0.0 to apply immediately.
+        '''
+        if alignUpdateInterval < 0.0:
+            print("Invalid align update interval " + str(alignUpdateInterval))
+            return
+        self._alignUpdateInterval = alignUpdateInterval
+
+    def beginAlignChange(self):
+        '''
+        Begin a batch of align setting changes, deferring applying them to
+        the model transformation and calling the align settings change
+        callback until the matching endAlignChange. Batches may be nested.
+        '''
+        self._alignChangeLevel += 1
+
+    def endAlignChange(self):
+        '''
+        End a batch of align setting changes, applying any changes when the
+        outermost batch ends.
+        '''
+        if self._alignChangeLevel == 0:
+            print('endAlignChange called without beginAlignChange')
+            return
+        self._alignChangeLevel -= 1
+        if (self._alignChangeLevel == 0) and self._alignChangePending:
+            self._updateAlignTransformation()
+
+    def isAlignChangePending(self):
+        return self._alignChangePending
+
+    def flushAlignChanges(self):
+        '''
+        Apply align changes deferred by the align update interval, unless in
+        a batch of align changes.
+        '''
+        if (self._alignChangeLevel == 0) and self._alignChangePending:
+            self._updateAlignTransformation()
+
     def getAlignEulerAngles(self):
         return self._alignSettings['euler_angles']
 
@@ -142,6 +292,25 @@ class SmoothfitModel(object):
         self._applyAlignSettings()
 
     def _applyAlignSettings(self):
+        '''
+        Apply align settings to the model transformation, unless deferred by
+        a batch of align changes or the align update interval.
+        '''
+        self._alignChangePending = True
+        if self._alignChangeLevel > 0:
+            return
+        if (self._alignUpdateInterval > 0.0) and (self._modelTransformedCoordinateField is not None) and \
+                (self._alignUpdateTime is not None):
+            delay = self._alignUpdateTime + self._alignUpdateInterval - time.perf_counter()
+            if delay > 0.0:
+                if self._alignChangeDeferredCallback is not None:
+                    self._alignChangeDeferredCallback(delay)
+                return
+        self._updateAlignTransformation()
+
+    def _updateAlignTransformation(self):
+        self._alignChangePending = False
+        self._alignUpdateTime = time.perf_counter()
         rot = vectorops.eulerToRotationMatrix3(self._alignSettings['euler_angles'])
         scale = self._alignSettings['scale']
         xScale = scale
@@ -166,7 +335,8 @@ class SmoothfitModel(object):
         fm.endChange()
         if not self._modelTransformedCoordinateField.isValid():
             print("Can't create transformed model coordinate field. Is problem 2-D?")
-        self._alignSettingsChangeCallback()
+        if self._alignSettingsChangeCallback is not None:
+            self._alignSettingsChangeCallback()
 
     def loadAlignSettings(self):
         with open(self._location + '-align-settings.json', 'r') as f:
@@ -207,16 +377,207 @@ class SmoothfitModel(object):
         dataCentre = vectorops.mult(vectorops.add(minimums, maximums), 0.5)
         self.setAlignOffset(vectorops.sub(dataCentre, self._modelCentre))
 
+    def isAutoRegisterScale(self):
+        return self._autoRegisterScale
+
+    def setAutoRegisterScale(self, autoRegisterScale):
+        '''
+        :param autoRegisterScale: True to fit scale in automatic registration,
+        False to keep the current align scale.
+        '''
+        self._autoRegisterScale = autoRegisterScale
+
+    def isAutoRegisterMirrorSearch(self):
+        return self._autoRegisterMirrorSearch
+
+    def setAutoRegisterMirrorSearch(self, autoRegisterMirrorSearch):
+        '''
+        :param autoRegisterMirrorSearch: True to try both mirrored and
+        unmirrored model in automatic registration, False to keep the current
+        align mirror.
+        '''
+        self._autoRegisterMirrorSearch = autoRegisterMirrorSearch
+
+    def _getRegistrationPoints(self, sampleCount=None):
+        '''
+        Get untransformed model surface sample points and active data points
+        for automatic registration.
+        :param sampleCount: optional number of active data points to choose at
+        random and evaluate, instead of evaluating all of them.
+        :return: modelCoordinates (M, 3), dataCoordinates (N, 3), or None if
+        not possible.
+        '''
+        if not self._isStateAlign:
+            print('Automatic registration is only possible while aligning')
+            return None
+        mesh = self._mesh
+        if self._projectSurfaceElementGroup is not None:
+            mesh = self._projectSurfaceElementGroup.getMeshGroup()
+        patches = zincutils.evaluateElementPatches(mesh, self._modelCoordinateField)
+        if (patches is None) or (patches.getNumberOfComponents() != 3):
+            print('Automatic registration not supported for this model')
+            return None
+        activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+        if sampleCount is None:
+            identifiers, dataCoordinates = zincutils.getNodesetFieldValues(activeDatapointsGroup, self._dataCoordinateField)
+        else:
+            identifiers, dataCoordinates = zincutils.getNodeFieldValues(activeDatapointsGroup, self._dataCoordinateField,
+                zincutils.getRandomNodeIdentifiers(activeDatapointsGroup, sampleCount, seed=0))
+        if identifiers.size < 3:
+            print('Automatic registration needs at least 3 active data points')
+            return None
+        # sample about as many model surface points as data points used in registration
+        pointsPerDirection = int(numpy.ceil((20000.0/patches.getNumberOfElements())**(1.0/patches.getDimension())))
+        modelCoordinates = patches.sample(min(max(pointsPerDirection, 2), 20))[2]
+        return modelCoordinates, dataCoordinates
+
+    def _getAutoRegisterMirrors(self):
+        return (False, True) if self._autoRegisterMirrorSearch else (self.isAlignMirror(),)
+
+    def autoRegisterModelToData(self):
+        '''
+        Set align settings to best register the model surface with the active
+        data points by iterative closest point, from principal axes and the
+        current alignment. Start from a rough manual alignment for partial scans.
+        :return: dict with scale, rotation, mirror, translation, rms_error and
+        iterations of registration, or None if not possible.
+        '''
+        points = self._getRegistrationPoints()
+        if points is None:
+            return None
+        modelCoordinates, dataCoordinates = points
+        mirror = self.isAlignMirror()
+        rotation = numpy.array(vectorops.eulerToRotationMatrix3(self._alignSettings['euler_angles']))
+        startTime = time.perf_counter()
+        result = registration.registerPoints(modelCoordinates, dataCoordinates,
+            estimateScale=self._autoRegisterScale, scale=self._alignSettings['scale'],
+            mirrors=self._getAutoRegisterMirrors(),
+            initialTransform=(self._alignSettings['scale'], rotation, mirror, self._alignSettings['offset']))
+        self._alignSettings['euler_angles'] = vectorops.rotationMatrix3ToEuler(result['rotation'].tolist())
+        self._alignSettings['scale'] = result['scale']
+        self._alignSettings['offset'] = result['translation'].tolist()
+        self._alignSettings['mirror'] = result['mirror']
+        self._applyAlignSettings()
+        print('Registered model to {:d} data points in {:.3g} s: RMS error {:.6g}'.format(
+            dataCoordinates.shape[0], time.perf_counter() - startTime, result['rms_error']))
+        return result
+
+    def searchAlignments(self, rotationCount=200, refineCount=5, workerCount=1, applyBest=True):
+        '''
+        Register the model surface with the active data points from many
+        initial rotations, in parallel worker processes. Uses auto register
+        scale and mirror search settings. Stops early without results if
+        cancel is requested. Alignments are applied with applyAlignSearchResult.
+        :param rotationCount: number of initial rotations for each mirror state
+        :param refineCount: number of best starts to refine and rank
+        :param workerCount: number of worker processes
+        :param applyBest: True to apply the best alignment found
+        :return: list of result dicts, see alignmentsearch.searchAlignments
+        '''
+        self._alignSearchResults = []
+        points = self._getRegistrationPoints()
+        if points is None:
+            return self._alignSearchResults
+        modelCoordinates, dataCoordinates = points
+        startTime = time.perf_counter()
+        self._alignSearchResults = alignmentsearch.searchAlignments(modelCoordinates, dataCoordinates,
+            estimateScale=self._autoRegisterScale, scale=self._alignSettings['scale'],
+            mirrors=self._getAutoRegisterMirrors(), rotationCount=rotationCount, refineCount=refineCount,
+            workerCount=workerCount, progressCallback=self._progressCallback, cancelCallback=self.isCancelRequested)
+        if self._alignSearchResults:
+            if applyBest:
+                self.applyAlignSearchResult(0)
+            print('Searched {:d} alignments in {:.3g} s: RMS error {:.6g}'.format(
+                rotationCount*len(self._getAutoRegisterMirrors()), time.perf_counter() - startTime,
+                self._alignSearchResults[0]['rms_error']))
+        return self._alignSearchResults
+
+    def getAlignSearchResults(self):
+        '''
+        :return: list of alignment search result dicts, best first.
+        '''
+        return self._alignSearchResults
+
+    def applyAlignSearchResult(self, index):
+        '''
+        Set align settings to those of an alignment search result.
+        :param index: index in alignment search results, 0 for best
+        '''
+        result = self._alignSearchResults[index]
+        for key in ['euler_angles', 'scale', 'offset', 'mirror']:
+            self._alignSettings[key] = result[key]
+        self._applyAlignSettings()
+
+    def getAlignPreviewSampleCount(self):
+        return self._alignPreviewSampleCount
+
+    def setAlignPreviewSampleCount(self, sampleCount):
+        '''
+        :param sampleCount: number of active data points sampled for the align
+        error preview. Fewer gives faster updates while dragging.
+        '''
+        if sampleCount < 1:
+            print("Invalid align preview sample count " + str(sampleCount))
+            return
+        self._alignPreviewSampleCount = sampleCount
+        self._alignPreview = None
+
+    def _getAlignPreview(self):
+        '''
+        Get fixed random subsample of active data points and closest point
+        index of the untransformed model surface for align error preview,
+        building them if needed.
+        :return: dict with data_coordinates and model_tree, or None if not
+        supported.
+        '''
+        if self._alignPreview is None:
+            self._alignPreview = {}
+            points = self._getRegistrationPoints(self._alignPreviewSampleCount)
+            if points is not None:
+                modelCoordinates, dataCoordinates = points
+                self._alignPreview = dict(data_coordinates=dataCoordinates, model_tree=cKDTree(modelCoordinates))
+        return self._alignPreview if self._alignPreview else None
+
+    def getAlignErrorPreview(self):
+        '''
+        Quickly estimate alignment error while aligning, from distances of a
+        subsample of active data points to points sampled over the model
+        surface, found by transforming data points by the inverse of the
+        align transform. Distances to surface samples, found approximately,
+        slightly overestimate projection errors.
+        :return: dict with rms_error, max_error, points, seconds, or None if
+        not aligning or not supported.
+        '''
+        if not self._isStateAlign:
+            return None
+        preview = self._getAlignPreview()
+        scale = self._alignSettings['scale']
+        if (preview is None) or (scale <= 0.0):
+            return None
+        startTime = time.perf_counter()
+        rotation = numpy.array(vectorops.eulerToRotationMatrix3(self._alignSettings['euler_angles']))
+        if self.isAlignMirror():
+            rotation[0] = -rotation[0]
+        modelSpaceCoordinates = vectorops.inverseTransformPoints(preview['data_coordinates'], scale*rotation,
+                                                                 self._alignSettings['offset'])
+        # approximate nearest neighbours keep queries fast when far from aligned
+        distances = preview['model_tree'].query(modelSpaceCoordinates, eps=0.25)[0]*scale
+        return dict(rms_error=float(numpy.sqrt(numpy.mean(distances*distances))), max_error=float(numpy.max(distances)),
+                    points=distances.size, seconds=time.perf_counter() - startTime)
+
     def isStateAlign(self):
         return self._isStateAlign
 
     def setStateAlign(self):
         self._isStateAlign = True
         self.clearDataProjections()
+        self._alignPreview = None
 
     def setStatePostAlign(self):
         if not self._isStateAlign:
             return
+        if self._alignChangePending:
+            self._updateAlignTransformation()
         self._isStateAlign = False
         rotationScale = vectorops.matrixconstantmult(vectorops.eulerToRotationMatrix3(self._alignSettings['euler_angles']), self._alignSettings['scale'])
         if self.isAlignMirror():
@@ -228,7 +589,14 @@ class SmoothfitModel(object):
 # ----- Fit Settings -----
 
     def _resetFitSettings(self):
-        self._fitSettings = dict(strain_penalty = 0.0, curvature_penalty = 0.0, edge_discontinuity_penalty = 0.0, max_iterations = 1)
+        self._fitSettings = dict(strain_penalty = 0.0, curvature_penalty = 0.0, edge_discontinuity_penalty = 0.0, max_iterations = 1,
+                                 method = self.FIT_METHOD_QUASI_NEWTON,
+                                 outer_max_iterations = 10, outer_rms_error_tolerance = 0.0,
+                                 outer_max_update_tolerance = 0.0, outer_time_limit = 0.0,
+                                 strain_quadrature_points = 3, curvature_quadrature_points = 3,
+                                 edge_discontinuity_quadrature_points = 3,
+                                 adaptive_quadrature = False, adaptive_quadrature_tolerance = 0.01,
+                                 schedule = [])
 
     def getFilterTopErrorProportion(self):
         return self._filterTopErrorProportion
@@ -242,9 +610,137 @@ class SmoothfitModel(object):
     def setFilterNonNormalProjectionLimit(self, value):
         self._filterNonNormalProjectionLimit = value
 
+    def getProjectionMode(self):
+        return self._projectionMode
+
+    def setProjectionMode(self, projectionMode):
+        if projectionMode not in [self.PROJECTION_MODE_BATCH, self.PROJECTION_MODE_REFERENCE]:
+            print("Invalid projection mode " + str(projectionMode))
+            return
+        self._projectionMode = projectionMode
+
+    def isProjectionWarmStart(self):
+        return self._projectionWarmStart
+
+    def setProjectionWarmStart(self, warmStart):
+        '''
+        :param warmStart: True to re-project points starting from their current
+        projections in batch mode, searching globally only where needed.
+        '''
+        self._projectionWarmStart = warmStart
+
+    def getProjectionMovedTolerance(self):
+        return self._projectionMovedTolerance
+
+    def setProjectionMovedTolerance(self, tolerance):
+        '''
+        :param tolerance: None to re-project all points, otherwise warm-started
+        batch re-projection only re-projects points whose elements have moved
+        by more than this distance since they were last projected.
+        '''
+        if (tolerance is not None) and (tolerance < 0.0):
+            print("moved tolerance must be non-negative")
+            return
+        self._projectionMovedTolerance = tolerance
+
+    def getProjectionWorkerCount(self):
+        return self._projectionWorkerCount
+
+    def setProjectionWorkerCount(self, workerCount):
+        '''
+        :param workerCount: number of processes to shard projections over; 1 for serial.
+        '''
+        if workerCount < 1:
+            print("projection worker count must be positive")
+            return
+        self._projectionWorkerCount = workerCount
+
+    def _getProjectionWorkerPool(self):
+        '''
+        Get pool of projection worker processes, kept between projections and
+        only restarted if the projection worker count changes.
+        '''
+        if (self._projectionWorkerPool is not None) and \
+                (self._projectionWorkerPool.getWorkerCount() != self._projectionWorkerCount):
+            self.shutdownProjectionWorkers()
+        if self._projectionWorkerPool is None:
+            self._projectionWorkerPool = projectionworkers.ProjectionWorkerPool(
+                self._projectionWorkerCount, self.PROGRESS_CHUNK_SIZE)
+        return self._projectionWorkerPool
+
+    def shutdownProjectionWorkers(self):
+        '''
+        Stop projection worker processes, if any. They are started again when
+        next needed.
+        '''
+        if self._projectionWorkerPool is not None:
+            self._projectionWorkerPool.shutdown()
+            self._projectionWorkerPool = None
+
+    def getDataProjectionReport(self):
+        '''
+        :return: dict describing the last calculateDataProjections, including
+        numbers of points projected and skipped, and skipped_identifiers array
+        of datapoints left with their previous projections.
+        '''
+        return self._dataProjectionReport
+
+    def getDecimationMethod(self):
+        return self._decimationMethod
+
+    def setDecimationMethod(self, method):
+        if method not in [self.DECIMATION_METHOD_VOXEL_GRID, self.DECIMATION_METHOD_POISSON_DISK]:
+            print("Invalid decimation method " + str(method))
+            return
+        self._decimationMethod = method
+
+    def getDecimationSpacing(self):
+        return self._decimationSpacing
+
+    def setDecimationSpacing(self, spacing):
+        self._decimationSpacing = spacing
+
+    def isDecimateOnLoad(self):
+        return self._decimateOnLoad
+
+    def setDecimateOnLoad(self, decimateOnLoad):
+        '''
+        :param decimateOnLoad: True to decimate data points when first loaded,
+        if decimation spacing is positive.
+        '''
+        self._decimateOnLoad = decimateOnLoad
+
     def setFitSettingsChangeCallback(self, fitSettingsChangeCallback):
         self._fitSettingsChangeCallback = fitSettingsChangeCallback
 
+    def setProgressCallback(self, progressCallback):
+        '''
+        :param progressCallback: function(description, done, total) called as
+        projection and fitting progress, from the thread running them. None
+        to clear.
+        '''
+        self._progressCallback = progressCallback
+
+    def _reportProgress(self, description, done, total):
+        if self._progressCallback is not None:
+            self._progressCallback(description, done, total)
+
+    def requestCancel(self):
+        '''
+        Request running projection or fitting stops at the next point where
+        the model is consistent: between projection chunks, leaving previous
+        projections in place, between blocks of fit iterations, or between
+        project and fit iterations. May be called from another thread.
+        Cleared by clearCancelRequest.
+        '''
+        self._cancelRequested = True
+
+    def clearCancelRequest(self):
+        self._cancelRequested = False
+
+    def isCancelRequested(self):
+        return self._cancelRequested
+
     def getFitStrainPenalty(self):
         return self._fitSettings['strain_penalty']
 
@@ -272,6 +768,201 @@ class SmoothfitModel(object):
             return
         self._fitSettings['max_iterations'] = number
 
+    def getFitMethod(self):
+        return self._fitSettings['method']
+
+    def setFitMethod(self, method):
+        if method not in [self.FIT_METHOD_QUASI_NEWTON, self.FIT_METHOD_LINEAR_DIRECT]:
+            print("Invalid fit method " + str(method))
+            return
+        self._fitSettings['method'] = method
+
+    def getFitOuterMaxIterations(self):
+        return self._fitSettings['outer_max_iterations']
+
+    def setFitOuterMaxIterations(self, number):
+        if number < 1:
+            print("outer max iterations must be positive")
+            return
+        self._fitSettings['outer_max_iterations'] = number
+
+    def getFitOuterRmsErrorTolerance(self):
+        return self._fitSettings['outer_rms_error_tolerance']
+
+    def setFitOuterRmsErrorTolerance(self, tolerance):
+        '''
+        :param tolerance: stop iterating when RMS data projection error is
+        at or below this value. 0.0 to disable.
+        '''
+        if tolerance < 0.0:
+            print("outer RMS error tolerance must be non-negative")
+            return
+        self._fitSettings['outer_rms_error_tolerance'] = tolerance
+
+    def getFitOuterMaxUpdateTolerance(self):
+        return self._fitSettings['outer_max_update_tolerance']
+
+    def setFitOuterMaxUpdateTolerance(self, tolerance):
+        '''
+        :param tolerance: stop iterating when no node moves further than this
+        in a fit. 0.0 to disable.
+        '''
+        if tolerance < 0.0:
+            print("outer max update tolerance must be non-negative")
+            return
+        self._fitSettings['outer_max_update_tolerance'] = tolerance
+
+    def getFitOuterTimeLimit(self):
+        return self._fitSettings['outer_time_limit']
+
+    def setFitOuterTimeLimit(self, seconds):
+        '''
+        :param seconds: stop iterating after this many seconds. 0.0 for no limit.
+        '''
+        if seconds < 0.0:
+            print("outer time limit must be non-negative")
+            return
+        self._fitSettings['outer_time_limit'] = seconds
+
+    def getFitSchedule(self):
+        return self._fitSettings['schedule']
+
+    def setFitSchedule(self, schedule):
+        '''
+        Set coarse-to-fine stages run by fitIterate before the final stage at
+        full resolution and the set penalties. Example:
+            [ { "outer_iterations": 2, "decimation_spacing": 4.0, "penalty_scale": 100.0 },
+              { "outer_iterations": 2, "decimation_spacing": 2.0, "penalty_scale": 10.0 } ]
+        :param schedule: list of stage dicts with outer_iterations, the
+        decimation_spacing of active data points (0.0 for all), and
+        penalty_scale multiplying the strain and curvature penalties.
+        Empty list for single resolution fitting.
+        '''
+        for stage in schedule:
+            if (stage.get('outer_iterations', 0) < 1) or (stage.get('decimation_spacing', -1.0) < 0.0) or \
+                    (stage.get('penalty_scale', -1.0) < 0.0):
+                print("Invalid fit schedule stage " + str(stage))
+                return
+        self._fitSettings['schedule'] = [dict(stage) for stage in schedule]
+
+    def getPenaltySweepResults(self):
+        '''
+        :return: list of result dicts from the last sweepFitPenalties
+        '''
+        return self._penaltySweepResults
+
+    def getPenaltySweepLCurve(self):
+        '''
+        :return: indexes of penalty sweep results on the L-curve in increasing
+        order of data error, index of result at the corner or None
+        '''
+        return penaltysweep.getLCurve(self._penaltySweepResults)
+
+    def applyPenaltySweepResult(self, index):
+        '''
+        Set strain and curvature fit penalties to those of a penalty sweep
+        result. Other fit settings are not changed.
+        :param index: index of result, e.g. corner of L-curve
+        '''
+        result = self._penaltySweepResults[index]
+        self.setFitStrainPenalty(result['strain_penalty'])
+        self.setFitCurvaturePenalty(result['curvature_penalty'])
+        self._fitSettingsChangeCallback()
+
+    def savePenaltySweepResults(self):
+        curve, corner = self.getPenaltySweepLCurve()
+        with open(self._location + '-penalty-sweep.json', 'w') as f:
+            f.write(json.dumps(dict(results=self._penaltySweepResults, l_curve=curve, corner=corner),
+                sort_keys=True, indent=4))
+
+    def getFitQuadraturePoints(self, penalty):
+        '''
+        :param penalty: one of FIT_PENALTIES
+        :return: number of Gauss points per xi direction for integrating penalty
+        '''
+        return self._fitSettings[penalty + '_quadrature_points']
+
+    def setFitQuadraturePoints(self, penalty, number):
+        if penalty not in self.FIT_PENALTIES:
+            print("Invalid fit penalty " + str(penalty))
+            return
+        if (number < 1) or (number > self.MAXIMUM_QUADRATURE_POINTS):
+            print("quadrature points must be from 1 to " + str(self.MAXIMUM_QUADRATURE_POINTS))
+            return
+        self._fitSettings[penalty + '_quadrature_points'] = number
+
+    def isFitAdaptiveQuadrature(self):
+        return self._fitSettings['adaptive_quadrature']
+
+    def setFitAdaptiveQuadrature(self, adaptiveQuadrature):
+        '''
+        :param adaptiveQuadrature: True to integrate each penalty with the
+        fewest Gauss points giving the same value as one more point, to
+        within the adaptive quadrature tolerance. Chosen before each fit.
+        '''
+        self._fitSettings['adaptive_quadrature'] = adaptiveQuadrature
+
+    def getFitAdaptiveQuadratureTolerance(self):
+        return self._fitSettings['adaptive_quadrature_tolerance']
+
+    def setFitAdaptiveQuadratureTolerance(self, tolerance):
+        '''
+        :param tolerance: relative change in penalty value
+        '''
+        if tolerance < 0.0:
+            print("adaptive quadrature tolerance must be non-negative")
+            return
+        self._fitSettings['adaptive_quadrature_tolerance'] = tolerance
+
+    def _getPenaltyQuadraturePoints(self, penalty):
+        '''
+        :return: number of Gauss points to integrate penalty with in fit,
+        as chosen adaptively if enabled, otherwise as set.
+        '''
+        if self.isFitAdaptiveQuadrature() and (penalty in self._adaptiveQuadraturePoints):
+            return self._adaptiveQuadraturePoints[penalty]
+        return self.getFitQuadraturePoints(penalty)
+
+    def getFitHistory(self):
+        '''
+        :return: list of dicts for each iteration of the last fitIterate: stage, iteration,
+        rms_error, max_error, max_update, seconds, elapsed, active, projected, skipped
+        '''
+        return self._fitHistory
+
+    def getFitReport(self):
+        '''
+        :return: dict describing the last fit: method, seconds, mean_error
+        and max_error, plus objective values and numbers of parameters and
+        data points for linear direct fits, and iterations and
+        function_evaluations for quasi-Newton fits. With fit telemetry,
+        objectives gives the value and evaluation seconds of each objective
+        term after the fit, and for quasi-Newton fits objectives_before gives
+        them before the fit.
+        '''
+        return self._fitReport
+
+    def isFitTelemetry(self):
+        return self._fitTelemetry
+
+    def setFitTelemetry(self, fitTelemetry):
+        '''
+        :param fitTelemetry: True to evaluate and time each objective term in
+        fits, and write fit telemetry with the output model.
+        '''
+        self._fitTelemetry = fitTelemetry
+
+    def getFitTelemetryFileName(self):
+        return os.path.splitext(self.getOutputModelFileName())[0] + '-fit-telemetry.json'
+
+    def writeFitTelemetry(self):
+        '''
+        Write last fit report and fit history to JSON file next to output model.
+        '''
+        with open(self.getFitTelemetryFileName(), 'w') as f:
+            f.write(json.dumps(dict(fit_report=self._fitReport, fit_history=self._fitHistory),
+                default=lambda o: o.tolist() if isinstance(o, numpy.ndarray) else str(o), sort_keys=True, indent=4))
+
     def loadFitSettings(self):
         with open(self._location + '-fit-settings.json', 'r') as f:
             self._fitSettings.update(json.loads(f.read()))
@@ -293,6 +984,8 @@ class SmoothfitModel(object):
         streamInfo.setResourceDomainTypes(file,
             Field.DOMAIN_TYPE_NODES | Field.DOMAIN_TYPE_MESH1D | Field.DOMAIN_TYPE_MESH2D | Field.DOMAIN_TYPE_MESH3D)
         result = self._region.write(streamInfo)
+        if self._fitTelemetry:
+            self.writeFitTelemetry()
 
     def loadPreviousSolution(self):
         """
@@ -367,9 +1060,10 @@ class SmoothfitModel(object):
         return None, None
 
     def load(self):
-        if self._modelReferenceCoordinateField is None:
+        firstLoad = self._modelReferenceCoordinateField is None
+        if firstLoad:
             # read and rename coordinates to reference_coordinates, for calculating strains
-            result = self._region.readFile(self._zincModelFile)
+            result = self._readModel()
             if result != ZINC_OK:
                 raise ValueError('Failed to read reference model')
             self._modelReferenceCoordinateField = self._getModelCoordinateField()
@@ -384,7 +1078,10 @@ class SmoothfitModel(object):
                 number = number + 1
                 numberString = str(number)
             # read data cloud
-            if self._zincPointCloudFile:
+            if self._zincPointCloudFile and pointcloud.isBinaryPointCloudFile(self._zincPointCloudFile):
+                self._dataCoordinateField = createFiniteElementField(self._region, field_name='data_coordinates')
+                self._createDataPoints(pointcloud.openBinaryPointCloud(self._zincPointCloudFile))
+            elif self._zincPointCloudFile:
                 sir = self._region.createStreaminformationRegion()
                 pointCloudResource = sir.createStreamresourceFile(self._zincPointCloudFile)
                 sir.setResourceDomainTypes(pointCloudResource, Field.DOMAIN_TYPE_DATAPOINTS)
@@ -392,13 +1089,15 @@ class SmoothfitModel(object):
                 if result != ZINC_OK:
                     raise ValueError('Failed to read point cloud')
                 self._dataCoordinateField = self._getDataCoordinateField()
-            elif self._pointCloudData:
+            elif self._pointCloudData is not None:
                 self._dataCoordinateField = createFiniteElementField(self._region, field_name='data_coordinates')
                 self._createDataPoints(self._pointCloudData)
 
-        result = self._region.readFile(self._zincModelFile)
+        result = self._readModel()
         if result != ZINC_OK:
             raise ValueError('Failed to read model')
+        self._spatialIndex = None
+        self._alignPreview = None
         self._mesh = self._getMesh()
         self._modelCoordinateField = self._getModelCoordinateField()
         minimums, maximums = self._getModelRange()
@@ -410,31 +1109,72 @@ class SmoothfitModel(object):
         tmpTrue = fm.createFieldConstant([1])
         activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
         activeDatapointsGroup.addNodesConditional(tmpTrue)
+        if self._decimatedDataPointGroupField is not None:
+            activeDatapointsGroup.removeNodesConditional(self._decimatedDataPointGroupField)
+        elif firstLoad and self._decimateOnLoad and (self._decimationSpacing > 0.0):
+            self.decimateDataPoints()
         self._applyAlignSettings()
         self._showModelGraphics()
 
-    def _createDataPoints(self, data_points):
-        for location in data_points:
-            self._createNodeAtLocation(location)
-
-    def _createNodeAtLocation(self, location, domain_type=Field.DOMAIN_TYPE_DATAPOINTS, node_id=-1):
+    def _getZincModelFileContents(self):
         '''
-        Creates a node at the given location without
-        adding it to the current selection.
+        Get contents of the zinc model file, only reading it from disk if it
+        has not been read before or has since been modified.
+        :return: bytes
         '''
-        fieldmodule = self._region.getFieldmodule()
-        fieldmodule.beginChange()
-
-        nodeset = fieldmodule.findNodesetByFieldDomainType(domain_type)
-        template = nodeset.createNodetemplate()
-        template.defineField(self._dataCoordinateField)
-        node = nodeset.createNode(node_id, template)
-        fieldcache = fieldmodule.createFieldcache()
-        fieldcache.setNode(node)
-        self._dataCoordinateField.assignReal(fieldcache, location)
-        fieldmodule.endChange()
+        fileStat = os.stat(self._zincModelFile)
+        key = (self._zincModelFile, fileStat.st_mtime_ns, fileStat.st_size)
+        if (self._zincModelFileCache is None) or (self._zincModelFileCache[:3] != key):
+            with open(self._zincModelFile, 'rb') as f:
+                self._zincModelFileCache = key + (f.read(),)
+        return self._zincModelFileCache[3]
+
+    def _readModel(self):
+        '''
+        Read the model into the region from the in-memory copy of the zinc
+        model file, so repeated loads do not re-read it from disk.
+        :return: zinc status
+        '''
+        sir = self._region.createStreaminformationRegion()
+        sir.createStreamresourceMemoryBuffer(self._getZincModelFileContents())
+        if self._zincModelFile.lower().endswith('.fieldml'):
+            sir.setFileFormat(StreaminformationRegion.FILE_FORMAT_FIELDML)
+        return self._region.read(sir)
 
-        return node
+    def _createDataPoints(self, data_points):
+        '''
+        Create datapoints with data coordinates in bulk.
+        :param data_points: (N, 3) array-like of coordinates, which may be
+        memory-mapped, or a buffer of contiguous float64 x, y, z values.
+        '''
+        if isinstance(data_points, (bytes, bytearray, memoryview)):
+            data_points = numpy.frombuffer(data_points, dtype=numpy.float64)
+        coordinates = numpy.asarray(data_points)
+        if coordinates.dtype.kind != 'f':
+            coordinates = coordinates.astype(numpy.float64)
+        coordinates = coordinates.reshape(-1, 3)
+        fm = self._region.getFieldmodule()
+        datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+        startTime = time.perf_counter()
+        zincutils.createNodesWithFieldValues(datapoints, self._dataCoordinateField, coordinates)
+        seconds = time.perf_counter() - startTime
+        pointsPerSecond = (coordinates.shape[0]/seconds) if (seconds > 0.0) else 0.0
+        self._pointCloudLoadReport = dict(points=coordinates.shape[0], seconds=seconds, points_per_second=pointsPerSecond)
+        print('Loaded {:d} data points in {:.3g} s: {:.4g} points/s'.format(coordinates.shape[0], seconds, pointsPerSecond))
+
+    def _getSpatialIndex(self, mesh):
+        '''
+        Get spatial index for nearest location queries on mesh with model
+        coordinates, building it if none or model coordinates have changed.
+        :return: MeshSpatialIndex, or None if mesh is not supported
+        '''
+        if (self._spatialIndex is None) or (self._spatialIndexMesh != mesh):
+            self._spatialIndex = None
+            patches = zincutils.evaluateElementPatches(mesh, self._modelCoordinateField)
+            if patches is not None:
+                self._spatialIndex = MeshSpatialIndex(patches)
+                self._spatialIndexMesh = mesh
+        return self._spatialIndex
 
     def _getNodesetMinimumMaximum(self, nodeset, field):
         fm = field.getFieldmodule()
@@ -509,25 +1249,52 @@ class SmoothfitModel(object):
         scene.endChange()
 
     def clearDataProjections(self):
-        if self._storedMeshLocationField is None:
+        '''
+        Drop all data projections and fields using them, and make all
+        undecimated data points active. The stored mesh location field is
+        kept for the next projections, with stale locations undefined when
+        they are next synchronised, so no data point is visited here.
+        '''
+        if self._dataProjectionStore is None:
             return
         self._hideDataProjections()
         fm = self._region.getFieldmodule()
         fm.beginChange()
         datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
-        tmpTrue = fm.createFieldConstant([1])
         activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
-        activeDatapointsGroup.addNodesConditional(tmpTrue)
-        nodetemplate = datapoints.createNodetemplate()
-        nodetemplate.undefineField(self._storedMeshLocationField)
-        dataIter = datapoints.createNodeiterator()
-        datapoint = dataIter.next()
-        i = 0
-        while datapoint.isValid():
-            result = datapoint.merge(nodetemplate)
-            datapoint = dataIter.next()
-        self._storedMeshLocationField = None
+        # only restore active points if some were filtered
+        if (activeDatapointsGroup.getSize() + self.getNumberOfDecimatedDataPoints()) < datapoints.getSize():
+            tmpTrue = fm.createFieldConstant([1])
+            activeDatapointsGroup.addNodesConditional(tmpTrue)
+            if self._decimatedDataPointGroupField is not None:
+                activeDatapointsGroup.removeNodesConditional(self._decimatedDataPointGroupField)
+        self._dataProjectionStore = None
         self._findMeshLocationField = None
+        self._dataProjectionPatches = None
+        self._dataProjectionCoordinateField = None
+        self._dataProjectionDeltaCoordinateField = None
+        self._dataProjectionErrorField = None
+        self._dataProjectionMeanErrorField = None
+        self._dataProjectionMaximumErrorField = None
+        self._fitOptimisation = None
+        fm.endChange()
+
+    def _destroyStoredMeshLocationField(self):
+        '''
+        Undefine stored mesh locations at data points holding them, so the
+        field is destroyed when no longer referenced.
+        '''
+        if self._storedMeshLocationField is None:
+            return
+        fm = self._region.getFieldmodule()
+        fm.beginChange()
+        if self._dataProjectionZincIdentifiers is not None:
+            datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+            zincutils.undefineNodeField(datapoints, self._storedMeshLocationField, self._dataProjectionZincIdentifiers)
+        self._storedMeshLocationField = None
+        self._dataProjectionMesh = None
+        self._dataProjectionZincIdentifiers = None
+        self._dataProjectionCoordinateField = None
         fm.endChange()
 
     def calculateDataProjections(self):
@@ -535,6 +1302,159 @@ class SmoothfitModel(object):
         mesh = self._mesh
         if self._projectSurfaceElementGroup is not None:
             mesh = self._projectSurfaceElementGroup.getMeshGroup()
+        if (self._dataProjectionMesh is not None) and (self._dataProjectionMesh.getName() != mesh.getName()):
+            # stored mesh locations are only valid on the mesh they were found on
+            self._dataProjectionStore = None
+            self._destroyStoredMeshLocationField()
+        warmStart = self._projectionWarmStart and (self._dataProjectionStore is not None)
+        if self._storedMeshLocationField is None:
+            self._storedMeshLocationField = fm.createFieldStoredMeshLocation(mesh)
+            if not self._storedMeshLocationField.isValid():
+                self._storedMeshLocationField = None
+                raise ValueError('Failed to create stored mesh location field. Possibly because no mesh?')
+            self._dataProjectionMesh = mesh
+            self._dataProjectionCoordinateField = None
+        if self._dataProjectionStore is None:
+            self._dataProjectionStore = DataProjectionStore(mesh.getDimension())
+        activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+        fm.beginChange()
+        if self._dataProjectionCoordinateField is None:
+            # projection fields and fit objectives using them are reused until projections are cleared
+            self._fitOptimisation = None
+            self._dataProjectionCoordinateField = fm.createFieldEmbedded(self._modelCoordinateField, self._storedMeshLocationField)
+            self._dataProjectionDeltaCoordinateField = fm.createFieldSubtract(self._dataProjectionCoordinateField, self._dataCoordinateField)
+            self._dataProjectionErrorField = fm.createFieldMagnitude(self._dataProjectionDeltaCoordinateField)
+            self._dataProjectionMeanErrorField = fm.createFieldNodesetMean(self._dataProjectionErrorField, activeDatapointsGroup)
+            self._dataProjectionMaximumErrorField = fm.createFieldNodesetMaximum(self._dataProjectionErrorField, activeDatapointsGroup)
+        if not ((self._projectionMode == self.PROJECTION_MODE_BATCH) and self._calculateDataProjectionsBatch(mesh, warmStart)):
+            self._calculateDataProjectionsReference(mesh)
+        fm.endChange()
+        self._showDataProjections()
+
+    def _calculateDataProjectionsBatch(self, mesh, warmStart):
+        '''
+        Find nearest locations for all active datapoints with vectorised
+        search over a cubic Lagrange representation of the model.
+        :param warmStart: True to start from currently stored mesh locations
+        :return: True on success, False if mesh or fields are not supported
+        '''
+        spatialIndex = self._getSpatialIndex(mesh)
+        if (spatialIndex is None) or \
+                (spatialIndex.getPatches().getNumberOfComponents() != self._dataCoordinateField.getNumberOfComponents()):
+            print('Batch projection not supported for this model; using reference projection')
+            return False
+        patches = spatialIndex.getPatches()
+        activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+        identifiers, dataCoordinates = zincutils.getNodesetFieldValues(activeDatapointsGroup, self._dataCoordinateField)
+        skipped = numpy.zeros(identifiers.size, dtype=bool)
+        projectionPatches = patches
+        if warmStart:
+            storedElementIdentifiers, previousXi = self._dataProjectionStore.getProjections(identifiers)
+            previousElementIndexes = patches.getElementIndexes(storedElementIdentifiers)
+            if (self._projectionMovedTolerance is not None) and (self._dataProjectionPatches is not None):
+                displacements = patches.getElementDisplacements(self._dataProjectionPatches)
+                if displacements is not None:
+                    # only re-project points in moved elements, and only record those elements as moved
+                    moved = displacements > self._projectionMovedTolerance
+                    skipped = (previousElementIndexes >= 0) & ~moved[numpy.maximum(previousElementIndexes, 0)]
+                    projectionPatches = ElementPatches(patches.getElementIdentifiers(),
+                        numpy.where(moved[:, numpy.newaxis, numpy.newaxis], patches.getControlPoints(),
+                                    self._dataProjectionPatches.getControlPoints()), patches.getDimension())
+            project = ~skipped
+            previousDistances = self._getPreviousProjectionDistances(
+                dataCoordinates, storedElementIdentifiers, previousXi)
+            if previousDistances is not None:
+                previousDistances = previousDistances[project]
+            if self._projectionWorkerCount > 1:
+                result = self._getProjectionWorkerPool().findNearestLocations(
+                    spatialIndex, dataCoordinates[project], previousElementIndexes[project], previousXi[project],
+                    previousDistances, self._progressCallback, self.isCancelRequested)
+            else:
+                result = self._findNearestLocationsChunked(
+                    spatialIndex, dataCoordinates[project], previousElementIndexes[project], previousXi[project],
+                    previousDistances)
+        else:
+            project = ~skipped
+            if self._projectionWorkerCount > 1:
+                result = self._getProjectionWorkerPool().findNearestLocations(
+                    spatialIndex, dataCoordinates,
+                    progressCallback=self._progressCallback, cancelCallback=self.isCancelRequested)
+            else:
+                result = self._findNearestLocationsChunked(spatialIndex, dataCoordinates)
+        if result is None:
+            # cancelled: keep previous projections
+            self._dataProjectionReport = dict(mode=self.PROJECTION_MODE_BATCH, warm_start=warmStart,
+                projected=0, cancelled=True)
+            return True
+        elementIndexes, xi, distances, outsideCount = result
+        self._reportProgress('Projecting points', elementIndexes.size, elementIndexes.size)
+        elementIdentifiers = patches.getElementIdentifiers()[elementIndexes]
+        self._dataProjectionStore.setProjections(identifiers[project], elementIdentifiers, xi)
+        self._dataProjectionPatches = projectionPatches
+        self._dataProjectionReport = dict(mode=self.PROJECTION_MODE_BATCH, warm_start=warmStart,
+            projected=int(numpy.count_nonzero(project)), searched_outside_patch=int(outsideCount),
+            skipped=int(numpy.count_nonzero(skipped)), skipped_identifiers=identifiers[skipped])
+        return True
+
+    def _getPreviousProjectionDistances(self, dataCoordinates, elementIdentifiers, xi):
+        '''
+        Get distances of data points from their stored projections on the
+        patches they were projected onto.
+        :param dataCoordinates: (N, components) data point coordinates
+        :param elementIdentifiers: N stored element identifiers, -1 if none
+        :param xi: (N, dimension) stored xi
+        :return: N distances, infinite where not projected, or None if
+        projection patches are unknown
+        '''
+        if self._dataProjectionPatches is None:
+            return None
+        elementIndexes = self._dataProjectionPatches.getElementIndexes(elementIdentifiers)
+        distances = numpy.full(elementIndexes.size, numpy.inf)
+        valid = numpy.flatnonzero(elementIndexes >= 0)
+        if valid.size > 0:
+            coordinates = self._dataProjectionPatches.evaluate(elementIndexes[valid], xi[valid])[0]
+            distances[valid] = numpy.linalg.norm(coordinates - dataCoordinates[valid], axis=1)
+        return distances
+
+    def _findNearestLocationsChunked(self, spatialIndex, points, elementIndexes=None, xi=None,
+                                     previousDistances=None):
+        '''
+        Find nearest locations with the spatial index in chunks of points,
+        warm started if previous elementIndexes and xi are supplied, reporting
+        progress and checking for cancel between chunks.
+        :param previousDistances: optional distances of previous locations,
+        points getting further from their patch are searched more widely
+        :return: elementIndexes, xi, distances, number of points searched
+        outside their local patch (all points if not warm started), or None
+        if cancelled
+        '''
+        count = points.shape[0]
+        results = []
+        for start in range(0, count, self.PROGRESS_CHUNK_SIZE):
+            if self._cancelRequested:
+                return None
+            stop = min(start + self.PROGRESS_CHUNK_SIZE, count)
+            if elementIndexes is None:
+                results.append(spatialIndex.findNearestLocations(points[start:stop]) + (stop - start,))
+            else:
+                results.append(spatialIndex.findNearestLocationsLocal(
+                    points[start:stop], elementIndexes[start:stop], xi[start:stop],
+                    None if previousDistances is None else previousDistances[start:stop]))
+            self._reportProgress('Projecting points', stop, count)
+        if not results:
+            dimension = spatialIndex.getPatches().getDimension()
+            return numpy.empty(0, dtype=numpy.int32), numpy.empty((0, dimension)), numpy.empty(0), 0
+        return (numpy.concatenate([result[0] for result in results]),
+                numpy.concatenate([result[1] for result in results]),
+                numpy.concatenate([result[2] for result in results]),
+                sum(result[3] for result in results))
+
+    def _calculateDataProjectionsReference(self, mesh):
+        '''
+        Find nearest locations one datapoint at a time with zinc find mesh location field.
+        Slow, but kept for comparison with batch projections.
+        '''
+        fm = self._region.getFieldmodule()
         if self._findMeshLocationField is None:
             self._findMeshLocationField = fm.createFieldFindMeshLocation(self._dataCoordinateField, self._modelCoordinateField, mesh)
             if self._findMeshLocationField.isValid():
@@ -542,35 +1462,88 @@ class SmoothfitModel(object):
             else:
                 self._findMeshLocationField = None
                 raise ValueError('Failed to create find mesh location field. Possibly because no coordinate field or mesh?')
-        if self._storedMeshLocationField is None:
-            self._storedMeshLocationField = fm.createFieldStoredMeshLocation(mesh)
-            if not self._storedMeshLocationField.isValid():
-                self._storedMeshLocationField = None
-                raise ValueError('Failed to create stored mesh location field. Possibly because no mesh?')
-        datapoints =  fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
         activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+        self._dataProjectionPatches = None
+        self._dataProjectionReport = dict(mode=self.PROJECTION_MODE_REFERENCE, warm_start=False,
+            projected=activeDatapointsGroup.getSize())
+        if self._projectionWorkerCount > 1:
+            identifiers, dataCoordinates = zincutils.getNodesetFieldValues(activeDatapointsGroup, self._dataCoordinateField)
+            result = self._getProjectionWorkerPool().findMeshLocations(
+                self._region, self._modelCoordinateField, mesh, dataCoordinates,
+                self._progressCallback, self.isCancelRequested)
+            if result is None:
+                # cancelled: keep previous projections
+                self._dataProjectionReport.update(projected=0, cancelled=True)
+                return
+            elementIdentifiers, xi = result
+            found = elementIdentifiers >= 0
+            self._dataProjectionStore.setProjections(identifiers[found], elementIdentifiers[found], xi[found])
+            return
         dimension = mesh.getDimension()
-        fm.beginChange()
-        self._dataProjectionCoordinateField = fm.createFieldEmbedded(self._modelCoordinateField, self._storedMeshLocationField)
-        self._dataProjectionDeltaCoordinateField = fm.createFieldSubtract(self._dataProjectionCoordinateField, self._dataCoordinateField)
-        self._dataProjectionErrorField = fm.createFieldMagnitude(self._dataProjectionDeltaCoordinateField)
-        self._dataProjectionMeanErrorField = fm.createFieldNodesetMean(self._dataProjectionErrorField, activeDatapointsGroup)
-        self._dataProjectionMaximumErrorField = fm.createFieldNodesetMaximum(self._dataProjectionErrorField, activeDatapointsGroup)
-
-        nodetemplate = datapoints.createNodetemplate()
-        nodetemplate.defineField(self._storedMeshLocationField)
         cache = fm.createFieldcache()
+        count = activeDatapointsGroup.getSize()
+        done = 0
+        foundIdentifiers = []
+        foundElementIdentifiers = []
+        foundXi = []
         dataIter = activeDatapointsGroup.createNodeiterator()
         datapoint = dataIter.next()
         while datapoint.isValid():
             cache.setNode(datapoint)
             element, xi = self._findMeshLocationField.evaluateMeshLocation(cache, dimension)
             if element.isValid():
-                datapoint.merge(nodetemplate)
-                self._storedMeshLocationField.assignMeshLocation(cache, element, xi)
+                foundIdentifiers.append(datapoint.getIdentifier())
+                foundElementIdentifiers.append(element.getIdentifier())
+                foundXi.append(xi)
             datapoint = dataIter.next()
+            done += 1
+            if (done % 1000) == 0:
+                self._reportProgress('Projecting points', done, count)
+                if self._cancelRequested:
+                    # points not reached keep their previous projections
+                    self._dataProjectionReport.update(projected=done, cancelled=True)
+                    break
+        self._dataProjectionStore.setProjections(foundIdentifiers, foundElementIdentifiers, foundXi)
+
+    def _syncDataProjections(self):
+        '''
+        Assign stored mesh locations in zinc from projections changed in the
+        projection store since last synchronised, and undefine them at data
+        points left from before projections were last cleared, in a single
+        change. Call before evaluating or drawing fields using data projections.
+        '''
+        if self._dataProjectionStore is None:
+            return
+        # projections are only added to the store until it is cleared, so equal
+        # counts mean zinc holds the same projections
+        zincCount = 0 if (self._dataProjectionZincIdentifiers is None) else self._dataProjectionZincIdentifiers.size
+        if self._dataProjectionStore.isSynced() and (zincCount == self._dataProjectionStore.getNumberOfProjections()):
+            return
+        identifiers, elementIdentifiers, xi = self._dataProjectionStore.getUnsyncedProjections()
+        projectedIdentifiers = self._dataProjectionStore.getProjectedIdentifiers()
+        fm = self._region.getFieldmodule()
+        datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+        fm.beginChange()
+        if self._dataProjectionZincIdentifiers is not None:
+            stale = ~numpy.isin(self._dataProjectionZincIdentifiers, projectedIdentifiers, assume_unique=True)
+            if numpy.any(stale):
+                zincutils.undefineNodeField(datapoints, self._storedMeshLocationField,
+                                            self._dataProjectionZincIdentifiers[stale])
+        zincutils.assignStoredMeshLocations(datapoints, self._storedMeshLocationField, identifiers,
+                                            self._dataProjectionMesh, elementIdentifiers, xi)
         fm.endChange()
-        self._showDataProjections()
+        self._dataProjectionStore.setSynced()
+        self._dataProjectionZincIdentifiers = projectedIdentifiers
+
+    def getDataProjectionMemoryReport(self):
+        '''
+        :return: dict describing memory used by the data projection store:
+        data_points, projections, bytes and bytes_per_million_points, or
+        empty dict if there are no projections
+        '''
+        if self._dataProjectionStore is None:
+            return {}
+        return self._dataProjectionStore.getMemoryReport()
 
     def _hideDataProjections(self):
         scene = self._region.getScene()
@@ -595,6 +1568,7 @@ class SmoothfitModel(object):
         spectrum.autorange(scene, scenefilter)
 
     def _showDataProjections(self):
+        self._syncDataProjections()
         self._hideDataProjections()
         scene = self._region.getScene()
         scene.beginChange()
@@ -644,9 +1618,10 @@ class SmoothfitModel(object):
         scene.endChange()
 
     def filterTopError(self):
-        if self._storedMeshLocationField is None:
+        if self._dataProjectionStore is None:
             print("Can't filter until projections are done")
             return
+        self._syncDataProjections()
         fm = self._region.getFieldmodule()
         cache = fm.createFieldcache()
         result, maxError = self._dataProjectionMaximumErrorField.evaluateReal(cache, 1)
@@ -668,9 +1643,10 @@ class SmoothfitModel(object):
         self._autorangeSpectrum()
 
     def filterNonNormal(self):
-        if self._storedMeshLocationField is None:
+        if self._dataProjectionStore is None:
             print("Can't filter until projections are done")
             return
+        self._syncDataProjections()
         fm = self._region.getFieldmodule()
         cache = fm.createFieldcache()
         result, maxError = self._dataProjectionMaximumErrorField.evaluateReal(cache, 1)
@@ -711,6 +1687,75 @@ class SmoothfitModel(object):
 
         self._autorangeSpectrum()
 
+    def decimateDataPoints(self):
+        '''
+        Remove active data points to reduce density to the decimation spacing
+        by the current decimation method. Removed points are recorded in a
+        group so restoreDecimatedDataPoints can add them back.
+        '''
+        if self._decimationSpacing <= 0.0:
+            print("Can't decimate as decimation spacing is not positive")
+            return
+        if self._decimatedDataPointGroupField is None:
+            fm = self._region.getFieldmodule()
+            datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+            self._decimatedDataPointGroupField = fm.createFieldNodeGroup(datapoints)
+        self._decimateActiveDataPoints(self._decimatedDataPointGroupField, self._decimationSpacing)
+
+    def _decimateActiveDataPoints(self, decimatedGroupField, spacing):
+        '''
+        Remove active data points to reduce density to spacing by the current
+        decimation method, adding removed points to decimatedGroupField.
+        '''
+        fm = self._region.getFieldmodule()
+        activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+        identifiers, coordinates = zincutils.getNodesetFieldValues(activeDatapointsGroup, self._dataCoordinateField)
+        if self._decimationMethod == self.DECIMATION_METHOD_POISSON_DISK:
+            keep = decimation.poissonDiskDecimate(coordinates, spacing)
+        else:
+            keep = decimation.voxelGridDecimate(coordinates, spacing)
+        dropped = numpy.ones(identifiers.size, dtype=bool)
+        dropped[keep] = False
+        fm.beginChange()
+        zincutils.addNodesToGroup(decimatedGroupField.getNodesetGroup(), identifiers[dropped])
+        activeDatapointsGroup.removeNodesConditional(decimatedGroupField)
+        fm.endChange()
+        if self._dataProjectionStore is not None:
+            self._autorangeSpectrum()
+
+    def _restoreScheduleDecimatedDataPoints(self):
+        '''
+        Make data points removed for a coarse fit schedule stage active again.
+        '''
+        if self._scheduleDecimatedDataPointGroupField is None:
+            return
+        fm = self._region.getFieldmodule()
+        fm.beginChange()
+        activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+        activeDatapointsGroup.addNodesConditional(self._scheduleDecimatedDataPointGroupField)
+        self._scheduleDecimatedDataPointGroupField.getNodesetGroup().removeAllNodes()
+        fm.endChange()
+
+    def restoreDecimatedDataPoints(self):
+        '''
+        Make all data points removed by decimation active again.
+        '''
+        if self._decimatedDataPointGroupField is None:
+            return
+        fm = self._region.getFieldmodule()
+        fm.beginChange()
+        activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+        activeDatapointsGroup.addNodesConditional(self._decimatedDataPointGroupField)
+        self._decimatedDataPointGroupField.getNodesetGroup().removeAllNodes()
+        fm.endChange()
+        if self._dataProjectionStore is not None:
+            self._autorangeSpectrum()
+
+    def getNumberOfDecimatedDataPoints(self):
+        if self._decimatedDataPointGroupField is None:
+            return 0
+        return self._decimatedDataPointGroupField.getNodesetGroup().getSize()
+
     def _getDerivativePenaltyFields(self, mesh):
         fm = self._region.getFieldmodule()
         dimension = mesh.getDimension()
@@ -763,19 +1808,12 @@ class SmoothfitModel(object):
         points.setMaterial(materialmodule.findMaterialByName('silver'))
         scene.endChange()
 
-    def fit(self):
-        if self._storedMeshLocationField is None:
-            raise ValueError('Cannot fit before data point projections are found')
+    def _getFitMeshes(self):
+        '''
+        :return: mesh to fit and integrate strain and curvature penalties
+        over, line mesh to integrate edge discontinuity penalty over
+        '''
         fm = self._region.getFieldmodule()
-        datapoints =  fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
-        activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
-        optimisation = fm.createOptimisation()
-        optimisation.setMethod(Optimisation.METHOD_LEAST_SQUARES_QUASI_NEWTON)
-        surfaceFitObjectiveField = fm.createFieldNodesetSumSquares(self._dataProjectionDeltaCoordinateField, activeDatapointsGroup)
-        result = optimisation.addObjectiveField(surfaceFitObjectiveField)
-        if result != ZINC_OK:
-            raise ValueError('Could not set optimisation surface fit objective field')
-        numberOfGaussPoints = 3
         mesh = self._mesh
         lineMesh = fm.findMeshByDimension(1)
         if self._projectSurfaceElementGroup is not None:
@@ -783,56 +1821,452 @@ class SmoothfitModel(object):
             lineMeshGroup = self._projectSurfaceGroup.getFieldElementGroup(lineMesh).getMeshGroup()
             if lineMeshGroup.isValid():
                 lineMesh = lineMeshGroup
-        if (self.getFitStrainPenalty() > 0.0) or (self.getFitCurvaturePenalty() > 0.0):
-            displacementGradient1, displacementGradient2 = self._getDerivativePenaltyFields(mesh)
-            if (self.getFitStrainPenalty() > 0.0):
-                if displacementGradient1 is None:
-                    print('Not supported: Apply Strain Penalty' + self.getFitStrainPenalty())
-                else:
-                    #print('Apply Strain Penalty' + self.getFitStrainPenalty())
-                    weightField = fm.createFieldConstant(self.getFitStrainPenalty())
-                    weightedStrainField = displacementGradient1*weightField
-                    weightedStrainFieldIntegralField = fm.createFieldMeshIntegralSquares(weightedStrainField, self._modelReferenceCoordinateField, mesh)
-                    weightedStrainFieldIntegralField.setNumbersOfPoints(numberOfGaussPoints)
-                    result = optimisation.addObjectiveField(weightedStrainFieldIntegralField)
+        return mesh, lineMesh
+
+    def fit(self):
+        if self._dataProjectionStore is None:
+            raise ValueError('Cannot fit before data point projections are found')
+        self._syncDataProjections()
+        fm = self._region.getFieldmodule()
+        mesh, lineMesh = self._getFitMeshes()
+        startTime = time.perf_counter()
+        self._fitReport = dict(method=self.FIT_METHOD_LINEAR_DIRECT)
+        if self.isFitAdaptiveQuadrature():
+            quadratureReport = self._adaptPenaltyQuadrature(mesh, lineMesh)
+        if not ((self.getFitMethod() == self.FIT_METHOD_LINEAR_DIRECT) and self._fitLinearDirect(mesh)):
+            self._fitReport = dict(method=self.FIT_METHOD_QUASI_NEWTON, max_iterations=self.getFitMaxIterations())
+            self._fitQuasiNewton(mesh, lineMesh)
+        if self.isFitAdaptiveQuadrature():
+            self._fitReport.update(quadratureReport)
+        self._fitReport['seconds'] = time.perf_counter() - startTime
+        cache = fm.createFieldcache()
+        self._fitReport['mean_error'] = self._dataProjectionMeanErrorField.evaluateReal(cache, 1)[1]
+        self._fitReport['max_error'] = self._dataProjectionMaximumErrorField.evaluateReal(cache, 1)[1]
+        print('Fit by {} in {:.3g} s: mean error {:.6g}, max error {:.6g}'.format(self._fitReport['method'],
+            self._fitReport['seconds'], self._fitReport['mean_error'], self._fitReport['max_error']))
+        self._autorangeSpectrum()
+        #self._showStrains()
+
+    def fitIterate(self):
+        '''
+        Alternate warm-started data projection and fit until the RMS error or
+        the maximum node coordinate update is within tolerance, or the outer
+        iteration or time limit is reached. Records history of each iteration.
+        If a fit schedule is set, its coarse stages are run first, each on the
+        active data points decimated to the stage spacing with strain and
+        curvature penalties scaled by the stage penalty scale, moving to the
+        next stage early if the maximum update is within tolerance.
+        Stops early if cancel is requested.
+        :return: True if converged within tolerances, False if stopped by limits
+        '''
+        startTime = time.perf_counter()
+        self._fitHistory = []
+        schedule = self.getFitSchedule()
+        strainPenalty = self.getFitStrainPenalty()
+        curvaturePenalty = self.getFitCurvaturePenalty()
+        try:
+            for stageNumber, stage in enumerate(schedule, 1):
+                self._restoreScheduleDecimatedDataPoints()
+                if stage['decimation_spacing'] > 0.0:
+                    if self._scheduleDecimatedDataPointGroupField is None:
+                        fm = self._region.getFieldmodule()
+                        datapoints = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+                        self._scheduleDecimatedDataPointGroupField = fm.createFieldNodeGroup(datapoints)
+                    self._decimateActiveDataPoints(self._scheduleDecimatedDataPointGroupField, stage['decimation_spacing'])
+                self.setFitStrainPenalty(strainPenalty*stage['penalty_scale'])
+                self.setFitCurvaturePenalty(curvaturePenalty*stage['penalty_scale'])
+                self._fitIterations(stageNumber, stage['outer_iterations'], 0.0, self.getFitOuterMaxUpdateTolerance(), startTime)
+                if self._cancelRequested or self._isFitTimeLimitReached(startTime):
+                    return False
+        finally:
+            self.setFitStrainPenalty(strainPenalty)
+            self.setFitCurvaturePenalty(curvaturePenalty)
+            self._restoreScheduleDecimatedDataPoints()
+        return self._fitIterations(len(schedule) + 1, self.getFitOuterMaxIterations(),
+            self.getFitOuterRmsErrorTolerance(), self.getFitOuterMaxUpdateTolerance(), startTime)
+
+    def sweepFitPenalties(self, strainPenalties, curvaturePenalties, workerCount=1):
+        '''
+        Fit with every combination of the strain and curvature penalties, in
+        parallel worker processes, each starting from the current model and
+        data projections, without changing the model. Fits are linear direct,
+        which cannot include the edge discontinuity penalty, so sweeping is
+        refused while it is non-zero. Stops early if
+        cancel is requested. Choose penalties from getPenaltySweepLCurve and
+        set them with applyPenaltySweepResult.
+        :param strainPenalties: list of strain penalties
+        :param curvaturePenalties: list of curvature penalties
+        :param workerCount: number of worker processes
+        :return: list of result dicts, see penaltysweep.sweepPenalties
+        '''
+        if self._dataProjectionStore is None:
+            raise ValueError('Cannot sweep penalties before data point projections are found')
+        if self.getFitEdgeDiscontinuityPenalty() > 0.0:
+            raise ValueError('Cannot sweep penalties with non-zero edge discontinuity penalty')
+        mesh, lineMesh = self._getFitMeshes()
+        system = self._getLinearFitSystem(mesh)
+        if system is None:
+            raise ValueError('Penalty sweep not supported for this model')
+        parameterMaps = system['parameter_maps']
+        referencePatches = system['reference_patches']
+        strainRows = linearfit.assemblePenaltyRows(parameterMaps, referencePatches, 1.0, 0.0,
+                                                   self._getPenaltyQuadraturePoints('strain'))
+        curvatureRows = linearfit.assemblePenaltyRows(parameterMaps, referencePatches, 0.0, 1.0,
+                                                      self._getPenaltyQuadraturePoints('curvature'))
+        self._penaltySweepResults = penaltysweep.sweepPenalties(system['data_rows'], system['data_targets'],
+            strainRows, curvatureRows, system['reference_parameters'], system['parameters'], system['free'],
+            strainPenalties, curvaturePenalties, workerCount, self._progressCallback, self.isCancelRequested)
+        return self._penaltySweepResults
+
+    def _isFitTimeLimitReached(self, startTime):
+        return (self.getFitOuterTimeLimit() > 0.0) and ((time.perf_counter() - startTime) >= self.getFitOuterTimeLimit())
+
+    def _fitIterations(self, stage, maxIterations, rmsErrorTolerance, maxUpdateTolerance, startTime):
+        '''
+        Alternate data projection and fit, appending to fit history.
+        :param stage: fit schedule stage number recorded in history
+        :param startTime: perf_counter time fitIterate started, for time limit
+        :return: True if converged within tolerances, False if stopped by limits
+        '''
+        fm = self._region.getFieldmodule()
+        nodeValueLabel = zincutils.NODE_VALUE_LABELS[0]
+        cache = fm.createFieldcache()
+        errorField = None
+        meanSquaresField = None
+        for iteration in range(1, maxIterations + 1):
+            iterationStartTime = time.perf_counter()
+            self.calculateDataProjections()
+            if self._cancelRequested:
+                break
+            success, layout, parametersBefore = zincutils.getNodalParameters(self._modelCoordinateField)
+            self.fit()
+            success, layout, parametersAfter = zincutils.getNodalParameters(self._modelCoordinateField)
+            delta = (parametersAfter - parametersBefore)[layout[:, 1] == nodeValueLabel]
+            maxUpdate = float(numpy.sqrt(numpy.max(numpy.sum(delta*delta, axis=1)))) if delta.size else 0.0
+            activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+            if errorField is not self._dataProjectionErrorField:
+                # error field is only rebuilt when projections are cleared
+                errorField = self._dataProjectionErrorField
+                meanSquaresField = fm.createFieldNodesetMeanSquares(errorField, activeDatapointsGroup)
+            rmsError = float(numpy.sqrt(meanSquaresField.evaluateReal(cache, 1)[1]))
+            endTime = time.perf_counter()
+            self._fitHistory.append(dict(stage=stage, iteration=iteration, rms_error=rmsError, max_error=self._fitReport['max_error'],
+                max_update=maxUpdate, seconds=endTime - iterationStartTime, elapsed=endTime - startTime,
+                active=activeDatapointsGroup.getSize(), projected=self._dataProjectionReport['projected'],
+                skipped=self._dataProjectionReport.get('skipped', 0)))
+            print('Stage {:d} iteration {:d}: RMS error {:.6g}, max update {:.6g}, {:.3g} s'.format(
+                stage, iteration, rmsError, maxUpdate, endTime - iterationStartTime))
+            if ((rmsErrorTolerance > 0.0) and (rmsError <= rmsErrorTolerance)) or \
+                    ((maxUpdateTolerance > 0.0) and (maxUpdate <= maxUpdateTolerance)):
+                return True
+            if self._cancelRequested or self._isFitTimeLimitReached(startTime):
+                break
+        return False
+
+    def _checkFitFieldCache(self, mesh, lineMesh):
+        '''
+        Discard cached fit optimisation and penalty fields if the meshes or
+        model coordinate field they were built for have changed.
+        '''
+        key = (mesh.getName(), lineMesh.getName(), self._modelCoordinateField.getName())
+        if self._fitOptimisationKey != key:
+            self._fitOptimisation = None
+            self._fitPenaltyWeightFields = {}
+            self._fitPenaltyObjectiveFields = {}
+            self._adaptiveQuadraturePoints = {}
+            self._fitOptimisationKey = key
+
+    def _getPenaltyObjectiveField(self, penalty, weight, mesh, lineMesh):
+        '''
+        Get integral of squares of weighted penalty field, building it on first
+        use and updating its weight and number of quadrature points in place.
+        :param penalty: one of FIT_PENALTIES
+        :param weight: penalty weight
+        :return: objective field, or None if penalty not supported for mesh
+        '''
+        fm = self._region.getFieldmodule()
+        if penalty not in self._fitPenaltyObjectiveFields:
+            self._fitPenaltyWeightFields[penalty] = fm.createFieldConstant(weight)
+            self._fitPenaltyObjectiveFields[penalty] = self._createPenaltyObjectiveField(
+                penalty, self._fitPenaltyWeightFields[penalty], mesh, lineMesh)
+        else:
+            cache = fm.createFieldcache()
+            self._fitPenaltyWeightFields[penalty].assignReal(cache, weight)
+        objectiveField = self._fitPenaltyObjectiveFields[penalty]
+        if objectiveField is not None:
+            objectiveField.setNumbersOfPoints(self._getPenaltyQuadraturePoints(penalty))
+        return objectiveField
+
+    def _getFitOptimisation(self, mesh, lineMesh):
+        '''
+        Get optimisation of data and penalty objectives, building the objective
+        field graph once and reusing it while the meshes and data projection
+        fields are unchanged. Penalty weights are constant fields updated in
+        place; penalty objectives are only included while their weight is positive.
+        :param mesh: mesh to fit and integrate strain and curvature penalties over
+        :param lineMesh: mesh to integrate edge discontinuity penalty over
+        :return: Optimisation
+        '''
+        fm = self._region.getFieldmodule()
+        self._checkFitFieldCache(mesh, lineMesh)
+        if self._fitOptimisation is None:
+            activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+            optimisation = fm.createOptimisation()
+            optimisation.setMethod(Optimisation.METHOD_LEAST_SQUARES_QUASI_NEWTON)
+            surfaceFitObjectiveField = fm.createFieldNodesetSumSquares(self._dataProjectionDeltaCoordinateField, activeDatapointsGroup)
+            result = optimisation.addObjectiveField(surfaceFitObjectiveField)
+            if result != ZINC_OK:
+                raise ValueError('Could not set optimisation surface fit objective field')
+            result = optimisation.addIndependentField(self._modelCoordinateField)
+            if result != ZINC_OK:
+                raise ValueError('Could not set optimisation dependent field')
+            if self._projectSurfaceGroup is not None:
+                optimisation.setConditionalField(self._modelCoordinateField, self._projectSurfaceGroup)
+            self._fitOptimisation = optimisation
+            self._fitDataObjectiveField = surfaceFitObjectiveField
+            self._fitPenaltyObjectivesAdded = set()
+        optimisation = self._fitOptimisation
+        weights = [self.getFitStrainPenalty(), self.getFitCurvaturePenalty(), self.getFitEdgeDiscontinuityPenalty()]
+        for penalty, weight in zip(self.FIT_PENALTIES, weights):
+            if weight > 0.0:
+                objectiveField = self._getPenaltyObjectiveField(penalty, weight, mesh, lineMesh)
+                if objectiveField is None:
+                    print('Not supported: Apply ' + penalty + ' penalty ' + str(weight))
+                elif penalty not in self._fitPenaltyObjectivesAdded:
+                    result = optimisation.addObjectiveField(objectiveField)
                     if result != ZINC_OK:
-                        raise ValueError('Could not add optimisation strain penalty objective field')
-            if (self.getFitCurvaturePenalty() > 0.0):
-                if displacementGradient2 is None:
-                    print('Not supported: Apply Curvature Penalty' + self.getFitCurvaturePenalty())
-                else:
-                    #print('Apply Curvature Penalty' + self.getFitCurvaturePenalty())
-                    weightField = fm.createFieldConstant(self.getFitCurvaturePenalty())
-                    weightedCurvatureField = displacementGradient2*weightField
-                    weightedCurvatureFieldIntegralField = fm.createFieldMeshIntegralSquares(weightedCurvatureField, self._modelReferenceCoordinateField, mesh)
-                    weightedCurvatureFieldIntegralField.setNumbersOfPoints(numberOfGaussPoints)
-                    result = optimisation.addObjectiveField(weightedCurvatureFieldIntegralField)
+                        raise ValueError('Could not add optimisation ' + penalty + ' penalty objective field')
+                    self._fitPenaltyObjectivesAdded.add(penalty)
+            elif penalty in self._fitPenaltyObjectivesAdded:
+                optimisation.removeObjectiveField(self._fitPenaltyObjectiveFields[penalty])
+                self._fitPenaltyObjectivesAdded.discard(penalty)
+        return optimisation
+
+    def _adaptPenaltyQuadrature(self, mesh, lineMesh):
+        '''
+        For each penalty with positive weight, choose the fewest Gauss points
+        per xi direction whose penalty value differs from that with one more
+        point by no more than the adaptive quadrature tolerance, relative.
+        Penalties which are zero for the current model keep the set number.
+        :return: dict with quadrature report for each penalty giving chosen and
+        set numbers of points, and seconds to evaluate the penalty with each,
+        plus total quadrature_seconds_saved per objective evaluation.
+        '''
+        fm = self._region.getFieldmodule()
+        self._checkFitFieldCache(mesh, lineMesh)
+        tolerance = self.getFitAdaptiveQuadratureTolerance()
+        weights = [self.getFitStrainPenalty(), self.getFitCurvaturePenalty(), self.getFitEdgeDiscontinuityPenalty()]
+        report = {}
+        secondsSaved = 0.0
+        for penalty, weight in zip(self.FIT_PENALTIES, weights):
+            if weight <= 0.0:
+                continue
+            self._adaptiveQuadraturePoints.pop(penalty, None)
+            objectiveField = self._getPenaltyObjectiveField(penalty, weight, mesh, lineMesh)
+            if objectiveField is None:
+                continue
+            componentCount = objectiveField.getNumberOfComponents()
+            values = {}
+            seconds = {}
+            for numberOfPoints in range(1, self.MAXIMUM_QUADRATURE_POINTS + 1):
+                objectiveField.setNumbersOfPoints(numberOfPoints)
+                cache = fm.createFieldcache()
+                evaluateStartTime = time.perf_counter()
+                result, value = objectiveField.evaluateReal(cache, componentCount)
+                seconds[numberOfPoints] = time.perf_counter() - evaluateStartTime
+                values[numberOfPoints] = sum(value) if (componentCount > 1) else value
+            setNumberOfPoints = self.getFitQuadraturePoints(penalty)
+            chosenNumberOfPoints = setNumberOfPoints
+            if values[self.MAXIMUM_QUADRATURE_POINTS] > 0.0:
+                chosenNumberOfPoints = self.MAXIMUM_QUADRATURE_POINTS
+                for numberOfPoints in range(1, self.MAXIMUM_QUADRATURE_POINTS):
+                    if abs(values[numberOfPoints] - values[numberOfPoints + 1]) <= tolerance*abs(values[numberOfPoints + 1]):
+                        chosenNumberOfPoints = numberOfPoints
+                        break
+            self._adaptiveQuadraturePoints[penalty] = chosenNumberOfPoints
+            objectiveField.setNumbersOfPoints(chosenNumberOfPoints)
+            report[penalty + '_quadrature'] = dict(points=chosenNumberOfPoints, set_points=setNumberOfPoints,
+                seconds=seconds[chosenNumberOfPoints], set_seconds=seconds[setNumberOfPoints])
+            secondsSaved += seconds[setNumberOfPoints] - seconds[chosenNumberOfPoints]
+        report['quadrature_seconds_saved'] = secondsSaved
+        return report
+
+    def _createPenaltyObjectiveField(self, name, weightField, mesh, lineMesh):
+        '''
+        Create integral of squares of weighted penalty field over mesh.
+        :param name: 'strain', 'curvature' or 'edge_discontinuity'
+        :param weightField: constant field penalty is multiplied by
+        :return: objective field, or None if penalty not supported for mesh
+        '''
+        fm = self._region.getFieldmodule()
+        if name == 'edge_discontinuity':
+            penaltyField = fm.createFieldEdgeDiscontinuity(self._modelCoordinateField)
+            mesh = lineMesh
+        else:
+            displacementGradient1, displacementGradient2 = self._getDerivativePenaltyFields(mesh)
+            penaltyField = displacementGradient1 if (name == 'strain') else displacementGradient2
+            if penaltyField is None:
+                return None
+        return fm.createFieldMeshIntegralSquares(penaltyField*weightField, self._modelReferenceCoordinateField, mesh)
+
+    def _fitQuasiNewton(self, mesh, lineMesh):
+        '''
+        Fit by zinc least squares quasi-Newton optimisation of data and penalty objectives.
+        :param mesh: mesh to fit and integrate strain and curvature penalties over
+        :param lineMesh: mesh to integrate edge discontinuity penalty over
+        '''
+        fm = self._region.getFieldmodule()
+        setupStartTime = time.perf_counter()
+        fieldCountBefore = zincutils.getNumberOfFields(fm)
+        optimisation = self._getFitOptimisation(mesh, lineMesh)
+        self._fitReport.update(setup_seconds=time.perf_counter() - setupStartTime,
+            fields_before=fieldCountBefore, fields_after=zincutils.getNumberOfFields(fm))
+        #optimisation.setAttributeInteger(Optimisation.ATTRIBUTE_MAXIMUM_FUNCTION_EVALUATIONS, 100000)
+        if self._fitTelemetry:
+            self._fitReport['objectives_before'] = self._evaluateFitObjectives()
+        # Optimise in blocks of iterations to report progress and check for cancel between them.
+        # Each block restarts the optimiser, which gives the same result as one call for blocks of
+        # 5 or more iterations; with fewer, restarts stop it detecting convergence.
+        maxIterations = self.getFitMaxIterations()
+        iterationCount = 0
+        functionEvaluationCount = 0
+        self._reportProgress('Fitting', 0, maxIterations)
+        while iterationCount < maxIterations:
+            if self._cancelRequested:
+                self._fitReport['cancelled'] = True
+                break
+            blockIterations = min(self.FIT_PROGRESS_ITERATIONS, maxIterations - iterationCount)
+            result = optimisation.setAttributeInteger(Optimisation.ATTRIBUTE_MAXIMUM_ITERATIONS, blockIterations)
+            if result != ZINC_OK:
+                raise ValueError('Could not set optimisation maximum iterations')
+            result = optimisation.optimise()
+            if result != ZINC_OK:
+                raise ValueError('Optimisation failed with result ' + str(result))
+            iterations, functionEvaluations = zincutils.getOptimisationSolutionCounts(optimisation)
+            if iterations is None:
+                # can't tell if converged: finish in one call
+                print('Optimisation solution report has no iteration count; fit progress not reported')
+                if maxIterations > blockIterations:
+                    optimisation.setAttributeInteger(Optimisation.ATTRIBUTE_MAXIMUM_ITERATIONS, maxIterations - blockIterations)
+                    result = optimisation.optimise()
                     if result != ZINC_OK:
-                        raise ValueError('Could not add optimisation strain penalty objective field')
+                        raise ValueError('Optimisation failed with result ' + str(result))
+                iterationCount = functionEvaluationCount = None
+                break
+            iterationCount += iterations
+            if (functionEvaluations is None) or (functionEvaluationCount is None):
+                functionEvaluationCount = None
+            else:
+                functionEvaluationCount += functionEvaluations
+            self._reportProgress('Fitting', iterationCount, maxIterations)
+            if iterations < blockIterations:
+                break # converged
+        self._fitReport.update(iterations=iterationCount, function_evaluations=functionEvaluationCount)
+        if self._fitTelemetry:
+            self._fitReport['objectives'] = self._evaluateFitObjectives()
+
+    def _evaluateFitObjectives(self):
+        '''
+        Evaluate and time each objective term in the fit optimisation.
+        :return: dict mapping 'data' and names of included penalties to dicts
+        with value and seconds
+        '''
+        fm = self._region.getFieldmodule()
+        objectiveFields = [('data', self._fitDataObjectiveField)] + \
+            [(penalty, self._fitPenaltyObjectiveFields[penalty]) for penalty in self.FIT_PENALTIES
+             if penalty in self._fitPenaltyObjectivesAdded]
+        objectives = {}
+        for name, objectiveField in objectiveFields:
+            componentCount = objectiveField.getNumberOfComponents()
+            cache = fm.createFieldcache()
+            evaluateStartTime = time.perf_counter()
+            result, value = objectiveField.evaluateReal(cache, componentCount)
+            objectives[name] = dict(value=sum(value) if (componentCount > 1) else value,
+                seconds=time.perf_counter() - evaluateStartTime)
+        return objectives
+
+    def _fitLinearDirect(self, mesh):
+        '''
+        Fit by directly solving the linear least squares problem for data
+        projections held fixed, with strain and curvature penalties
+        integrated by the same Gauss quadrature as the quasi-Newton fit.
+        Only nodal parameters satisfying the projectsurface conditional are fitted.
+        :param mesh: mesh to fit and integrate penalties over
+        :return: True on success, False if not supported for this model
+        '''
         if self.getFitEdgeDiscontinuityPenalty() > 0.0:
-            #print('Apply Edge Discontinuity Penalty', self.getFitEdgeDiscontinuityPenalty())
-            edgeDiscontinuityField = fm.createFieldEdgeDiscontinuity(self._modelCoordinateField)
-            weightField = fm.createFieldConstant(self.getFitEdgeDiscontinuityPenalty())
-            weightedEdgeDiscontinuityField = edgeDiscontinuityField*weightField
-            weightedEdgeDiscontinuityIntegralField = fm.createFieldMeshIntegralSquares(weightedEdgeDiscontinuityField, self._modelReferenceCoordinateField, lineMesh)
-            weightedEdgeDiscontinuityIntegralField.setNumbersOfPoints(numberOfGaussPoints)
-            result = optimisation.addObjectiveField(weightedEdgeDiscontinuityIntegralField)
-            if result != ZINC_OK:
-                raise ValueError('Could not add optimisation edge discontinuity penalty objective field')
-        result = optimisation.addIndependentField(self._modelCoordinateField)
-        if result != ZINC_OK:
-            raise ValueError('Could not set optimisation dependent field')
+            print('Linear direct fit does not support edge discontinuity penalty; using quasi-Newton')
+            return False
+        system = self._getLinearFitSystem(mesh)
+        if system is None:
+            print('Linear direct fit not supported for this model; using quasi-Newton')
+            return False
+        parameterMaps = system['parameter_maps']
+        referencePatches = system['reference_patches']
+        referenceParameters = system['reference_parameters']
+        dataRows = system['data_rows']
+        strainRows = linearfit.assemblePenaltyRows(parameterMaps, referencePatches, self.getFitStrainPenalty(), 0.0,
+                                                   self._getPenaltyQuadraturePoints('strain'))
+        curvatureRows = linearfit.assemblePenaltyRows(parameterMaps, referencePatches, 0.0, self.getFitCurvaturePenalty(),
+                                                      self._getPenaltyQuadraturePoints('curvature'))
+        penaltyRows = scipy.sparse.vstack([strainRows, curvatureRows], format='csr')
+        solution, objectiveBefore, objectiveAfter = linearfit.solveLinearLeastSquares(
+            scipy.sparse.vstack([dataRows, penaltyRows], format='csr'),
+            numpy.concatenate([system['data_targets'], penaltyRows.dot(referenceParameters)]),
+            system['parameters'], system['free'])
+        zincutils.setNodalParameters(self._modelCoordinateField, system['layout'], solution)
+        self._fitReport.update(parameters=int(system['layout'].shape[0]), free_parameters=int(numpy.count_nonzero(system['free'])),
+            data_points=int(dataRows.shape[0]), objective_before=objectiveBefore, objective=objectiveAfter)
+        if self._fitTelemetry:
+            objectives = {}
+            displacement = solution - referenceParameters
+            terms = [('data', dataRows, solution, system['data_targets'])]
+            if self.getFitStrainPenalty() > 0.0:
+                terms.append(('strain', strainRows, displacement, 0.0))
+            if self.getFitCurvaturePenalty() > 0.0:
+                terms.append(('curvature', curvatureRows, displacement, 0.0))
+            for name, rows, values, targets in terms:
+                evaluateStartTime = time.perf_counter()
+                residual = rows.dot(values) - targets
+                objectives[name] = dict(value=float(numpy.sum(residual*residual)),
+                    seconds=time.perf_counter() - evaluateStartTime)
+            self._fitReport['objectives'] = objectives
+        self._reportProgress('Fitting', 1, 1)
+        return True
+
+    def _getLinearFitSystem(self, mesh):
+        '''
+        Get the parts of the linear least squares fit problem for the current
+        data projections which do not depend on penalty weights.
+        :param mesh: mesh to fit and integrate penalties over
+        :return: dict with layout, parameters and reference_parameters from
+        zincutils.getNodalParameters, parameter_maps, reference_patches,
+        data_rows interpolating the model at projected active data points,
+        data_targets with their coordinates, and free parameters; or None if
+        the model is not supported
+        '''
+        fm = self._region.getFieldmodule()
+        success, layout, parameters = zincutils.getNodalParameters(self._modelCoordinateField)
+        referenceSuccess, referenceLayout, referenceParameters = zincutils.getNodalParameters(self._modelReferenceCoordinateField)
+        parameterMaps = None
+        if success and referenceSuccess and numpy.array_equal(layout, referenceLayout):
+            parameterMaps = zincutils.evaluateElementParameterMaps(mesh, self._modelCoordinateField, layout)
+        if parameterMaps is None:
+            return None
+        referencePatches = parameterMaps.getPatches(referenceParameters)
+        activeDatapointsGroup = self._activeDataPointGroupField.getNodesetGroup()
+        identifiers, dataCoordinates = zincutils.getNodesetFieldValues(activeDatapointsGroup, self._dataCoordinateField)
+        elementIdentifiers, xi = self._dataProjectionStore.getProjections(identifiers)
+        elementIndexes = referencePatches.getElementIndexes(elementIdentifiers)
+        projected = elementIndexes >= 0
+        dataRows = linearfit.assembleDataRows(parameterMaps, elementIndexes[projected], xi[projected])
+        free = parameterMaps.getUsedParameters()
         if self._projectSurfaceGroup is not None:
-            optimisation.setConditionalField(self._modelCoordinateField, self._projectSurfaceGroup)
-        result = optimisation.setAttributeInteger(Optimisation.ATTRIBUTE_MAXIMUM_ITERATIONS, self.getFitMaxIterations())
-        if result != ZINC_OK:
-            raise ValueError('Could not set optimisation maximum iterations')
-        #optimisation.setAttributeInteger(Optimisation.ATTRIBUTE_MAXIMUM_FUNCTION_EVALUATIONS, 100000)
-        result = optimisation.optimise()
-        if result != ZINC_OK:
-            raise ValueError('Optimisation failed with result ' + str(result))
-        self._autorangeSpectrum()
-        #self._showStrains()
+            nodes = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+            free &= numpy.isin(layout[:, 0], zincutils.getConditionalNodeIdentifiers(nodes, self._projectSurfaceGroup))
+        return dict(layout=layout, parameters=parameters, reference_parameters=referenceParameters,
+            parameter_maps=parameterMaps, reference_patches=referencePatches, data_rows=dataRows,
+            data_targets=dataCoordinates[projected], free=free)
 
 
 def createFiniteElementField(region, field_name='coordinates'):
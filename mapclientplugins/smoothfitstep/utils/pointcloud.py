@@ -0,0 +1,61 @@
+'''
+Binary point cloud files, read by memory-mapping so coordinates are
+streamed into datapoints without building intermediate python lists.
+
+Two formats are supported:
+  .npy: numpy array file with shape (N, 3) and float32 or float64 dtype.
+  .ptcl: raw little-endian float32 or float64 x, y, z values following a
+    16 byte header: magic b'PTCL', dtype b'<f4 ' or b'<f8 ', then the
+    number of points as little-endian uint64.
+'''
+import struct
+import numpy
+
+PTCL_MAGIC = b'PTCL'
+_PTCL_HEADER = struct.Struct('<4s4sQ')
+_PTCL_DTYPES = { b'<f4 ' : numpy.dtype('<f4'), b'<f8 ' : numpy.dtype('<f8') }
+
+
+def isBinaryPointCloudFile(fileName):
+    '''
+    :return: True if fileName has a binary point cloud extension
+    '''
+    return str(fileName).lower().endswith(('.npy', '.ptcl'))
+
+
+def openBinaryPointCloud(fileName):
+    '''
+    Memory-map a binary point cloud file read-only.
+    :return: (N, 3) array backed by the file
+    '''
+    if str(fileName).lower().endswith('.npy'):
+        coordinates = numpy.load(fileName, mmap_mode='r')
+    else:
+        with open(fileName, 'rb') as f:
+            header = f.read(_PTCL_HEADER.size)
+        if len(header) != _PTCL_HEADER.size:
+            raise ValueError('Point cloud file ' + str(fileName) + ' is too short')
+        magic, dtypeCode, count = _PTCL_HEADER.unpack(header)
+        if (magic != PTCL_MAGIC) or (dtypeCode not in _PTCL_DTYPES):
+            raise ValueError('Point cloud file ' + str(fileName) + ' has an invalid header')
+        coordinates = numpy.memmap(fileName, dtype=_PTCL_DTYPES[dtypeCode], mode='r',
+                                   offset=_PTCL_HEADER.size, shape=(count, 3))
+    if (coordinates.ndim != 2) or (coordinates.shape[1] != 3) or (coordinates.dtype.kind != 'f'):
+        raise ValueError('Point cloud file ' + str(fileName) + ' must contain an (N, 3) array of reals')
+    return coordinates
+
+
+def writeBinaryPointCloud(fileName, coordinates, dtype=numpy.float64):
+    '''
+    Write coordinates to a .npy or .ptcl binary point cloud file.
+    :param coordinates: (N, 3) array-like of coordinates
+    :param dtype: numpy.float32 or numpy.float64
+    '''
+    coordinates = numpy.asarray(coordinates, dtype=numpy.dtype(dtype).newbyteorder('<')).reshape(-1, 3)
+    if str(fileName).lower().endswith('.npy'):
+        numpy.save(fileName, coordinates)
+        return
+    dtypeCode = b'<f4 ' if coordinates.dtype.itemsize == 4 else b'<f8 '
+    with open(fileName, 'wb') as f:
+        f.write(_PTCL_HEADER.pack(PTCL_MAGIC, dtypeCode, coordinates.shape[0]))
+        f.write(numpy.ascontiguousarray(coordinates).tobytes())
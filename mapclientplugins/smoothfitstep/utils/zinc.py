@@ -3,12 +3,122 @@ Created on Jul 23, 2015
 
 @author: Richard Christie
 '''
+import re
+import numpy
+from opencmiss.zinc.element import Element
 from opencmiss.zinc.node import Node
 from opencmiss.zinc.field import Field
 from opencmiss.zinc.status import OK as ZINC_OK
-from mapclientplugins.smoothfitstep.maths import vectorops
+from mapclientplugins.smoothfitstep.maths.elementpatches import ElementPatches, patchXi
+from mapclientplugins.smoothfitstep.maths.linearfit import ElementParameterMaps
 
 
+NODE_VALUE_LABELS = [
+    Node.VALUE_LABEL_VALUE, Node.VALUE_LABEL_D_DS1, Node.VALUE_LABEL_D_DS2, Node.VALUE_LABEL_D2_DS1DS2,
+    Node.VALUE_LABEL_D_DS3, Node.VALUE_LABEL_D2_DS1DS3, Node.VALUE_LABEL_D2_DS2DS3, Node.VALUE_LABEL_D3_DS1DS2DS3]
+
+def getNumberOfFields(fieldmodule):
+    '''
+    :return: number of fields in fieldmodule, including unmanaged fields still in use
+    '''
+    count = 0
+    fieldIter = fieldmodule.createFielditerator()
+    field = fieldIter.next()
+    while field.isValid():
+        count += 1
+        field = fieldIter.next()
+    return count
+
+def getOptimisationSolutionCounts(optimisation):
+    '''
+    Get counts from the solution report of the last optimise.
+    :return: number of iterations, number of function evaluations; either
+    None if not in the report
+    '''
+    report = optimisation.getSolutionReport()
+    counts = []
+    # OPT++ reports e.g. 'No. iterations taken      = 4'
+    for pattern in [r'(?:number of|no\.) iterations[^0-9\n]*(\d+)',
+                    r'(?:number of|no\.) function evaluations[^0-9\n]*(\d+)']:
+        match = re.search(pattern, report, re.IGNORECASE)
+        counts.append(int(match.group(1)) if match else None)
+    return counts[0], counts[1]
+
+def getNodalParameters(field, time = 0.0):
+    '''
+    Gather all nodal parameters of a finite element field into one array.
+    :param field: finite element field
+    :param optional time
+    :return: success, layout, values. Layout is an (D, 3) int array of node
+    identifier, value label and version for each row of (D, components) values.
+    '''
+    ncomp = field.getNumberOfComponents()
+    feField = field.castFiniteElement()
+    if not feField.isValid():
+        print('zinc.getNodalParameters: field is not finite element field type')
+        return False, numpy.empty((0, 3), dtype=numpy.int32), numpy.empty((0, ncomp))
+    success = True
+    layout = []
+    values = []
+    fm = feField.getFieldmodule()
+    fm.beginChange()
+    cache = fm.createFieldcache()
+    cache.setTime(time)
+    nodes = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+    nodetemplate = nodes.createNodetemplate()
+    nodeIter = nodes.createNodeiterator()
+    node = nodeIter.next()
+    while node.isValid():
+        if nodetemplate.defineFieldFromNode(feField, node) == ZINC_OK:
+            cache.setNode(node)
+            identifier = node.getIdentifier()
+            for derivative in NODE_VALUE_LABELS:
+                versions = nodetemplate.getValueNumberOfVersions(feField, -1, derivative)
+                for v in range(1, versions + 1):
+                    result, nodeValues = feField.getNodeParameters(cache, -1, derivative, v, ncomp)
+                    if result != ZINC_OK:
+                        success = False
+                    else:
+                        layout.append((identifier, derivative, v))
+                        values.append(nodeValues)
+        node = nodeIter.next()
+    fm.endChange()
+    if not success:
+        print('zinc.getNodalParameters: failed to get some values')
+    return success, numpy.array(layout, dtype=numpy.int32).reshape(-1, 3), numpy.array(values, dtype=numpy.float64).reshape(-1, ncomp)
+
+def setNodalParameters(field, layout, values, time = 0.0):
+    '''
+    Scatter nodal parameters gathered by getNodalParameters back to a field
+    defined identically on the same nodes, in a single change.
+    :param field: finite element field
+    :param layout: (D, 3) node identifier, value label, version for each row of values
+    :param values: (D, components) parameter values
+    :param optional time
+    :return: True on success, otherwise false
+    '''
+    feField = field.castFiniteElement()
+    if not feField.isValid():
+        print('zinc.setNodalParameters: field is not finite element field type')
+        return False
+    success = True
+    fm = feField.getFieldmodule()
+    fm.beginChange()
+    cache = fm.createFieldcache()
+    cache.setTime(time)
+    nodes = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+    lastIdentifier = None
+    for (identifier, derivative, v), nodeValues in zip(numpy.asarray(layout).tolist(), numpy.asarray(values, dtype=numpy.float64).tolist()):
+        if identifier != lastIdentifier:
+            cache.setNode(nodes.findNodeByIdentifier(identifier))
+            lastIdentifier = identifier
+        if feField.setNodeParameters(cache, -1, derivative, v, nodeValues) != ZINC_OK:
+            success = False
+    fm.endChange()
+    if not success:
+        print('zinc.setNodalParameters: failed to set some values')
+    return success
+
 def copyNodalParameters(sourceField, targetField, time = 0.0):
     '''
     Copy nodal parameters from sourceField to identically defined targetField.
@@ -27,31 +137,9 @@ def copyNodalParameters(sourceField, targetField, time = 0.0):
     if not (sourceFeField.isValid() and targetFeField.isValid()):
         print('zinc.copyNodalParameters: fields must be finite element type')
         return False
-    success = True
-    fm = sourceFeField.getFieldmodule()
-    fm.beginChange()
-    cache = fm.createFieldcache()
-    cache.setTime(time)
-    nodes = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
-    nodetemplate = nodes.createNodetemplate()
-    nodeIter = nodes.createNodeiterator()
-    node = nodeIter.next()
-    while node.isValid():
-        nodetemplate.defineFieldFromNode(sourceFeField, node)
-        cache.setNode(node)
-        for derivative in [Node.VALUE_LABEL_VALUE, Node.VALUE_LABEL_D_DS1, Node.VALUE_LABEL_D_DS2, Node.VALUE_LABEL_D2_DS1DS2,
-                           Node.VALUE_LABEL_D_DS3, Node.VALUE_LABEL_D2_DS1DS3, Node.VALUE_LABEL_D2_DS2DS3, Node.VALUE_LABEL_D3_DS1DS2DS3]:
-            versions = nodetemplate.getValueNumberOfVersions(sourceFeField, -1, derivative)
-            for v in range(1, versions + 1):
-                result, values = sourceFeField.getNodeParameters(cache, -1, derivative, v, ncomp)
-                if result != ZINC_OK:
-                    success = False
-                else:
-                    result = targetFeField.setNodeParameters(cache, -1, derivative, v, values)
-                    if result != ZINC_OK:
-                        success = False
-        node = nodeIter.next()
-    fm.endChange()
+    success, layout, values = getNodalParameters(sourceFeField, time)
+    if not setNodalParameters(targetFeField, layout, values, time):
+        success = False
     if not success:
         print('zinc.copyNodalParameters: failed to get/set some values')
     return success
@@ -83,34 +171,442 @@ def transformCoordinates(field, rotationScale, offset, time = 0.0):
     if not feField.isValid():
         print('zinc.transformCoordinates: field is not finite element field type')
         return False
-    success = True
+    success, layout, values = getNodalParameters(feField, time)
+    # derivatives transform by the matrix only, values also get the offset
+    values = values.dot(numpy.array(rotationScale, dtype=numpy.float64).T)
+    values[layout[:, 1] == Node.VALUE_LABEL_VALUE] += numpy.array(offset, dtype=numpy.float64)
+    if not setNodalParameters(feField, layout, values, time):
+        success = False
+    if not success:
+        print('zinc.transformCoordinates: failed to get/set some values')
+    return success
+
+
+def getNodesetFieldValues(nodeset, field, time = 0.0):
+    '''
+    Get field values at all nodes in nodeset where defined, in identifier order.
+    Uses a single field cache for all nodes.
+    :param nodeset: nodeset or nodeset group to evaluate over
+    :param field: the field to evaluate
+    :param optional time
+    :return: identifiers int32 array (N,), values float64 array (N, components)
+    '''
+    ncomp = field.getNumberOfComponents()
+    fm = field.getFieldmodule()
+    cache = fm.createFieldcache()
+    cache.setTime(time)
+    size = nodeset.getSize()
+    identifiers = numpy.empty(size, dtype=numpy.int32)
+    values = numpy.empty((size, ncomp))
+    count = 0
+    nodeIter = nodeset.createNodeiterator()
+    node = nodeIter.next()
+    while node.isValid():
+        cache.setNode(node)
+        result, nodeValues = field.evaluateReal(cache, ncomp)
+        if result == ZINC_OK:
+            identifiers[count] = node.getIdentifier()
+            values[count] = nodeValues
+            count += 1
+        node = nodeIter.next()
+    return identifiers[:count], values[:count]
+
+def getRandomNodeIdentifiers(nodesetGroup, count, seed = 0):
+    '''
+    Get up to count distinct identifiers of nodes in nodesetGroup chosen at
+    random, without visiting every node where possible. When the master
+    nodeset's identifiers run without gaps from its first node, identifiers
+    are drawn from that range and kept if in the group; otherwise, or if too
+    few draws hit the group, falls back to choosing from all identifiers.
+    :param nodesetGroup: nodeset group to sample
+    :param count: maximum number of identifiers to return
+    :param seed: seed for the random generator, so samples are repeatable
+    :return: sorted identifiers int32 array (min(count, group size),)
+    '''
+    size = nodesetGroup.getSize()
+    rng = numpy.random.default_rng(seed)
+    nodeset = nodesetGroup.getMasterNodeset()
+    masterSize = nodeset.getSize()
+    if size > count:
+        firstNode = nodeset.createNodeiterator().next()
+        first = firstNode.getIdentifier()
+        # ends match the size: assume no gaps in between
+        if firstNode.isValid() and nodeset.findNodeByIdentifier(first + masterSize - 1).isValid() and \
+                not nodeset.findNodeByIdentifier(first + masterSize).isValid():
+            chosen = set()
+            draws = 0
+            # give up once sampling costs more than iterating over the group
+            maxDraws = min(4*count*masterSize//size, size)
+            while (len(chosen) < count) and (draws < maxDraws):
+                for identifier in rng.integers(first, first + masterSize, count).tolist():
+                    if identifier not in chosen:
+                        node = nodeset.findNodeByIdentifier(identifier)
+                        if nodesetGroup.containsNode(node):
+                            chosen.add(identifier)
+                            if len(chosen) == count:
+                                break
+                draws += count
+            if len(chosen) == count:
+                return numpy.array(sorted(chosen), dtype=numpy.int32)
+    identifiers = numpy.empty(size, dtype=numpy.int32)
+    nodeIter = nodesetGroup.createNodeiterator()
+    node = nodeIter.next()
+    n = 0
+    while node.isValid():
+        identifiers[n] = node.getIdentifier()
+        n += 1
+        node = nodeIter.next()
+    identifiers = identifiers[:n]
+    if n > count:
+        identifiers = numpy.sort(rng.choice(identifiers, count, replace=False))
+    return identifiers
+
+def getNodeFieldValues(nodeset, field, identifiers, time = 0.0):
+    '''
+    Get field values at the nodes with the given identifiers where defined.
+    :param nodeset: nodeset containing the nodes
+    :param field: the field to evaluate
+    :param identifiers: array of node identifiers
+    :param optional time
+    :return: identifiers int32 array (N,), values float64 array (N, components)
+    '''
+    ncomp = field.getNumberOfComponents()
+    fm = field.getFieldmodule()
+    cache = fm.createFieldcache()
+    cache.setTime(time)
+    identifiers = numpy.asarray(identifiers, dtype=numpy.int32)
+    values = numpy.empty((identifiers.shape[0], ncomp))
+    defined = numpy.zeros(identifiers.shape[0], dtype=bool)
+    for i, identifier in enumerate(identifiers.tolist()):
+        cache.setNode(nodeset.findNodeByIdentifier(identifier))
+        result, nodeValues = field.evaluateReal(cache, ncomp)
+        if result == ZINC_OK:
+            values[i] = nodeValues
+            defined[i] = True
+    return identifiers[defined], values[defined]
+
+def createNodesWithFieldValues(nodeset, field, values):
+    '''
+    Create nodes with field defined and assigned from values in a single
+    change, reusing one node template and field cache.
+    :param nodeset: nodeset to create nodes in
+    :param field: finite element field to define and assign
+    :param values: (N, components) array of values, which may be memory-mapped
+    :return: number of nodes created
+    '''
+    ncomp = field.getNumberOfComponents()
+    values = numpy.asarray(values).reshape(-1, ncomp)
     fm = field.getFieldmodule()
     fm.beginChange()
+    nodetemplate = nodeset.createNodetemplate()
+    nodetemplate.defineField(field)
+    cache = fm.createFieldcache()
+    count = values.shape[0]
+    # convert in chunks to avoid a python list of the whole array
+    for start in range(0, count, 65536):
+        for nodeValues in numpy.asarray(values[start:start + 65536], dtype=numpy.float64).tolist():
+            node = nodeset.createNode(-1, nodetemplate)
+            cache.setNode(node)
+            field.assignReal(cache, nodeValues)
+    fm.endChange()
+    return count
+
+def addNodesToGroup(nodesetGroup, identifiers):
+    '''
+    Add nodes with the given identifiers to nodesetGroup in a single change.
+    :param nodesetGroup: nodeset group to add to
+    :param identifiers: array of node identifiers in the group's master nodeset
+    '''
+    nodeset = nodesetGroup.getMasterNodeset()
+    fm = nodeset.getFieldmodule()
+    fm.beginChange()
+    for identifier in numpy.asarray(identifiers).tolist():
+        nodesetGroup.addNode(nodeset.findNodeByIdentifier(identifier))
+    fm.endChange()
+
+def evaluateElementPatches(mesh, field, time = 0.0):
+    '''
+    Evaluate field on mesh as cubic Lagrange patches for vectorised use.
+    Only line, square and cube element shapes are supported.
+    :param mesh: mesh or mesh group
+    :param field: field to evaluate, normally coordinates
+    :param optional time
+    :return: ElementPatches, or None if mesh has unsupported element shapes
+    or field is not defined on all elements
+    '''
+    dimension = mesh.getDimension()
+    shapeType = { 1 : Element.SHAPE_TYPE_LINE, 2 : Element.SHAPE_TYPE_SQUARE, 3 : Element.SHAPE_TYPE_CUBE }[dimension]
+    ncomp = field.getNumberOfComponents()
+    xiList = patchXi(dimension).tolist()
+    fm = field.getFieldmodule()
+    cache = fm.createFieldcache()
+    cache.setTime(time)
+    size = mesh.getSize()
+    elementIdentifiers = numpy.empty(size, dtype=numpy.int32)
+    controlPoints = numpy.empty((size, len(xiList), ncomp))
+    elementIter = mesh.createElementiterator()
+    element = elementIter.next()
+    e = 0
+    while element.isValid():
+        if element.getShapeType() != shapeType:
+            return None
+        elementIdentifiers[e] = element.getIdentifier()
+        for k, xi in enumerate(xiList):
+            cache.setMeshLocation(element, xi)
+            result, values = field.evaluateReal(cache, ncomp)
+            if result != ZINC_OK:
+                return None
+            controlPoints[e, k] = values
+        e += 1
+        element = elementIter.next()
+    return ElementPatches(elementIdentifiers[:e], controlPoints[:e], dimension)
+
+def getConditionalNodeIdentifiers(nodeset, conditionalField, time = 0.0):
+    '''
+    :return: sorted array of identifiers of nodes where conditionalField
+    evaluates to a non-zero value
+    '''
+    fm = conditionalField.getFieldmodule()
     cache = fm.createFieldcache()
     cache.setTime(time)
+    identifiers = []
+    nodeIter = nodeset.createNodeiterator()
+    node = nodeIter.next()
+    while node.isValid():
+        cache.setNode(node)
+        result, value = conditionalField.evaluateReal(cache, 1)
+        if (result == ZINC_OK) and (value != 0.0):
+            identifiers.append(node.getIdentifier())
+        node = nodeIter.next()
+    return numpy.array(identifiers, dtype=numpy.int32)
+
+def createFiniteElementFieldCopy(field, mesh):
+    '''
+    Create an unmanaged finite element field defined like field at all its
+    nodes and on the elements of mesh, sharing element field templates. Its
+    parameters can be changed without notifying any change to field. Call
+    undefineFiniteElementField on the copy when finished so it is destroyed.
+    :param field: finite element field to copy the definition of
+    :param mesh: mesh or mesh group to define the copy on
+    :return: copy field
+    '''
+    ncomp = field.getNumberOfComponents()
+    feField = field.castFiniteElement()
+    fm = feField.getFieldmodule()
+    fm.beginChange()
+    copyField = fm.createFieldFiniteElement(ncomp)
     nodes = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
     nodetemplate = nodes.createNodetemplate()
+    copyNodetemplate = nodes.createNodetemplate()
+    copyNodetemplate.defineField(copyField)
     nodeIter = nodes.createNodeiterator()
     node = nodeIter.next()
     while node.isValid():
-        nodetemplate.defineFieldFromNode(feField, node)
-        cache.setNode(node)
-        for derivative in [Node.VALUE_LABEL_VALUE, Node.VALUE_LABEL_D_DS1, Node.VALUE_LABEL_D_DS2, Node.VALUE_LABEL_D2_DS1DS2,
-                           Node.VALUE_LABEL_D_DS3, Node.VALUE_LABEL_D2_DS1DS3, Node.VALUE_LABEL_D2_DS2DS3, Node.VALUE_LABEL_D3_DS1DS2DS3]:
-            versions = nodetemplate.getValueNumberOfVersions(feField, -1, derivative)
-            for v in range(1, versions + 1):
-                result, values = feField.getNodeParameters(cache, -1, derivative, v, ncomp)
-                if result != ZINC_OK:
-                    success = False
-                else:
-                    newValues = vectorops.matrixvectormult(rotationScale, values)
-                    if derivative == Node.VALUE_LABEL_VALUE:
-                        newValues = vectorops.add(newValues, offset)
-                    result = feField.setNodeParameters(cache, -1, derivative, v, newValues)
+        if nodetemplate.defineFieldFromNode(feField, node) == ZINC_OK:
+            for derivative in NODE_VALUE_LABELS:
+                copyNodetemplate.setValueNumberOfVersions(copyField, -1, derivative,
+                    nodetemplate.getValueNumberOfVersions(feField, -1, derivative))
+            node.merge(copyNodetemplate)
+        node = nodeIter.next()
+    elementtemplate = mesh.createElementtemplate()
+    elementIter = mesh.createElementiterator()
+    element = elementIter.next()
+    while element.isValid():
+        eft = element.getElementfieldtemplate(feField, -1)
+        if eft.isValid():
+            elementtemplate.defineField(copyField, -1, eft)
+            element.merge(elementtemplate)
+        element = elementIter.next()
+    fm.endChange()
+    return copyField
+
+def undefineFiniteElementField(field, mesh):
+    '''
+    Undefine finite element field on the elements of mesh and at all nodes in
+    a single change.
+    :param field: finite element field to undefine
+    :param mesh: mesh or mesh group the field is defined on
+    '''
+    fm = field.getFieldmodule()
+    fm.beginChange()
+    elementtemplate = mesh.createElementtemplate()
+    elementtemplate.undefineField(field)
+    elementIter = mesh.createElementiterator()
+    element = elementIter.next()
+    while element.isValid():
+        element.merge(elementtemplate)
+        element = elementIter.next()
+    nodes = fm.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+    nodetemplate = nodes.createNodetemplate()
+    nodetemplate.undefineField(field)
+    nodeIter = nodes.createNodeiterator()
+    node = nodeIter.next()
+    while node.isValid():
+        node.merge(nodetemplate)
+        node = nodeIter.next()
+    fm.endChange()
+
+def evaluateElementParameterMaps(mesh, field, layout, time = 0.0):
+    '''
+    Find the linear map from nodal parameters to cubic Lagrange patch control
+    points of each element by probing. Nodes are coloured so no two nodes of
+    a colour share an element; then for each colour, unit values are set in
+    up to one parameter per component at every node of the colour and the
+    elements around them are evaluated. Probes a temporary copy of the field
+    so field itself is not changed and no change to it is notified.
+    Assumes all components use the same element field template and the
+    field has only nodal parameters.
+    :param mesh: mesh or mesh group
+    :param field: finite element field defined on mesh
+    :param layout: nodal parameter layout from getNodalParameters
+    :param optional time
+    :return: ElementParameterMaps, or None if mesh has unsupported element
+    shapes or field components have different templates
+    '''
+    dimension = mesh.getDimension()
+    shapeType = { 1 : Element.SHAPE_TYPE_LINE, 2 : Element.SHAPE_TYPE_SQUARE, 3 : Element.SHAPE_TYPE_CUBE }[dimension]
+    ncomp = field.getNumberOfComponents()
+    feField = field.castFiniteElement()
+    layout = numpy.asarray(layout)
+    parameterCount = layout.shape[0]
+    # layout rows are grouped by node; slot is the row's position within its node
+    nodeIdentifiers, nodeFirstRows, nodeParameterCounts = numpy.unique(layout[:, 0], return_index=True, return_counts=True)
+    elements = []
+    elementNodes = []
+    elementIter = mesh.createElementiterator()
+    element = elementIter.next()
+    while element.isValid():
+        if element.getShapeType() != shapeType:
+            return None
+        eft = element.getElementfieldtemplate(feField, -1)
+        if not eft.isValid():
+            return None
+        nodeIndexes = []
+        for localNodeIndex in range(1, eft.getNumberOfLocalNodes() + 1):
+            nodeIndex = int(numpy.searchsorted(nodeIdentifiers, element.getNode(eft, localNodeIndex).getIdentifier()))
+            if nodeIndex not in nodeIndexes:
+                nodeIndexes.append(nodeIndex)
+        elements.append(element)
+        elementNodes.append(nodeIndexes)
+        element = elementIter.next()
+    elementCount = len(elements)
+    # greedy colouring of nodes sharing elements
+    nodeElements = [[] for n in range(nodeIdentifiers.size)]
+    for e, nodeIndexes in enumerate(elementNodes):
+        for nodeIndex in nodeIndexes:
+            nodeElements[nodeIndex].append(e)
+    colours = numpy.full(nodeIdentifiers.size, -1, dtype=numpy.int32)
+    for nodeIndex in range(nodeIdentifiers.size):
+        usedColours = set(colours[n] for e in nodeElements[nodeIndex] for n in elementNodes[e])
+        colour = 0
+        while colour in usedColours:
+            colour += 1
+        colours[nodeIndex] = colour
+    # element parameters are the parameters of its nodes in local node order
+    elementParameterOffsets = []
+    maxParameterCount = 0
+    for nodeIndexes in elementNodes:
+        offsets = {}
+        count = 0
+        for nodeIndex in nodeIndexes:
+            offsets[nodeIndex] = count
+            count += int(nodeParameterCounts[nodeIndex])
+        elementParameterOffsets.append(offsets)
+        maxParameterCount = max(maxParameterCount, count)
+    parameterIndexes = numpy.full((elementCount, maxParameterCount), -1, dtype=numpy.int64)
+    for e, nodeIndexes in enumerate(elementNodes):
+        for nodeIndex in nodeIndexes:
+            offset = elementParameterOffsets[e][nodeIndex]
+            first = nodeFirstRows[nodeIndex]
+            parameterIndexes[e, offset:offset + nodeParameterCounts[nodeIndex]] = numpy.arange(first, first + nodeParameterCounts[nodeIndex])
+    xiList = patchXi(dimension).tolist()
+    maps = numpy.zeros((elementCount, len(xiList), maxParameterCount))
+    rowNodeIndexes = numpy.searchsorted(nodeIdentifiers, layout[:, 0])
+    rowSlots = numpy.arange(parameterCount) - nodeFirstRows[rowNodeIndexes]
+    success = True
+    fm = feField.getFieldmodule()
+    fm.beginChange()
+    probeField = createFiniteElementFieldCopy(field, mesh)
+    setNodalParameters(probeField, layout, numpy.zeros((parameterCount, ncomp)), time)
+    for colour in range(int(colours.max()) + 1 if colours.size else 0):
+        colourNodes = numpy.flatnonzero(colours == colour)
+        colourElements = sorted(set(e for nodeIndex in colourNodes.tolist() for e in nodeElements[nodeIndex]))
+        colourRows = numpy.flatnonzero(colours[rowNodeIndexes] == colour)
+        maxSlots = int(nodeParameterCounts[colourNodes].max())
+        for firstSlot in range(0, maxSlots, ncomp):
+            probeRows = colourRows[(rowSlots[colourRows] >= firstSlot) & (rowSlots[colourRows] < firstSlot + ncomp)]
+            probeValues = numpy.zeros((probeRows.size, ncomp))
+            probeValues[numpy.arange(probeRows.size), rowSlots[probeRows] - firstSlot] = 1.0
+            setNodalParameters(probeField, layout[probeRows], probeValues, time)
+            cache = fm.createFieldcache()
+            cache.setTime(time)
+            for e in colourElements:
+                nodeIndex = next(n for n in elementNodes[e] if colours[n] == colour)
+                offset = elementParameterOffsets[e][nodeIndex] + firstSlot
+                componentCount = min(ncomp, int(nodeParameterCounts[nodeIndex]) - firstSlot)
+                if componentCount <= 0:
+                    continue
+                for k, xi in enumerate(xiList):
+                    cache.setMeshLocation(elements[e], xi)
+                    result, probe = probeField.evaluateReal(cache, ncomp)
                     if result != ZINC_OK:
                         success = False
-        node = nodeIter.next()
+                    maps[e, k, offset:offset + componentCount] = probe[:componentCount]
+            setNodalParameters(probeField, layout[probeRows], numpy.zeros((probeRows.size, ncomp)), time)
+    undefineFiniteElementField(probeField, mesh)
     fm.endChange()
     if not success:
-        print('zinc.transformCoordinates: failed to get/set some values')
+        print('zinc.evaluateElementParameterMaps: failed to evaluate field on some elements')
+        return None
+    elementIdentifiers = numpy.array([element.getIdentifier() for element in elements], dtype=numpy.int32)
+    return ElementParameterMaps(elementIdentifiers, parameterIndexes, maps, dimension, parameterCount)
+
+def assignStoredMeshLocations(nodeset, storedMeshLocationField, nodeIdentifiers, mesh, elementIdentifiers, xi):
+    '''
+    Define and assign stored mesh locations at many nodes in a single change.
+    :param nodeset: nodeset containing the nodes
+    :param storedMeshLocationField: stored mesh location field to assign
+    :param nodeIdentifiers: N node identifiers
+    :param mesh: mesh the stored mesh location field is defined on
+    :param elementIdentifiers: N element identifiers
+    :param xi: (N, dimension) element xi
+    :return: True on success, otherwise false
+    '''
+    success = True
+    fm = storedMeshLocationField.getFieldmodule()
+    fm.beginChange()
+    cache = fm.createFieldcache()
+    nodetemplate = nodeset.createNodetemplate()
+    nodetemplate.defineField(storedMeshLocationField)
+    elements = {}
+    for nodeIdentifier, elementIdentifier, elementXi in zip(nodeIdentifiers.tolist(), elementIdentifiers.tolist(), xi.tolist()):
+        element = elements.get(elementIdentifier)
+        if element is None:
+            element = elements[elementIdentifier] = mesh.findElementByIdentifier(elementIdentifier)
+        node = nodeset.findNodeByIdentifier(nodeIdentifier)
+        node.merge(nodetemplate)
+        cache.setNode(node)
+        if storedMeshLocationField.assignMeshLocation(cache, element, elementXi) != ZINC_OK:
+            success = False
+    fm.endChange()
+    if not success:
+        print('zinc.assignStoredMeshLocations: failed to assign some mesh locations')
     return success
+
+def undefineNodeField(nodeset, field, nodeIdentifiers):
+    '''
+    Undefine field at nodes with the given identifiers in a single change,
+    without visiting other nodes.
+    :param nodeset: nodeset containing the nodes
+    :param field: finite element or stored mesh location field to undefine
+    :param nodeIdentifiers: array of node identifiers
+    '''
+    fm = field.getFieldmodule()
+    fm.beginChange()
+    nodetemplate = nodeset.createNodetemplate()
+    nodetemplate.undefineField(field)
+    for nodeIdentifier in numpy.asarray(nodeIdentifiers).tolist():
+        node = nodeset.findNodeByIdentifier(nodeIdentifier)
+        if node.isValid():
+            node.merge(nodetemplate)
+    fm.endChange()
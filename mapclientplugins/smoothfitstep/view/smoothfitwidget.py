@@ -3,11 +3,39 @@ Created on July 15, 2015
 
 @author: Richard Christie
 '''
+import traceback
+
 from PySide2 import QtCore, QtWidgets
 
 from mapclientplugins.smoothfitstep.view.ui_smoothfitwidget import Ui_SmoothfitWidget
 from opencmiss.zinc.scene import Scene
 
+class ModelOperationThread(QtCore.QThread):
+    '''
+    Runs a long model operation off the GUI thread, forwarding its progress.
+    While it runs, all zinc calls must be made from this thread: zinc is not
+    thread safe, so the GUI thread must not use zinc until it finishes.
+    '''
+
+    progress = QtCore.Signal(str, int, int)
+
+    def __init__(self, operation, parent=None):
+        super(ModelOperationThread, self).__init__(parent)
+        self._operation = operation
+        self._errorMessage = None
+
+    def run(self):
+        try:
+            self._operation()
+        except Exception:
+            self._errorMessage = traceback.format_exc()
+
+    def getErrorMessage(self):
+        '''
+        :return: traceback of exception raised by operation, or None
+        '''
+        return self._errorMessage
+
 class SmoothfitWidget(QtWidgets.QWidget):
     '''
     classdocs
@@ -25,10 +53,19 @@ class SmoothfitWidget(QtWidgets.QWidget):
         self._ui.sceneviewerWidget.setModel(model)
         self._model = model
         self._model.setAlignSettingsChangeCallback(self._alignSettingsDisplay)
+        # limit model transformation and display updates while dragging to about 30 per second
+        self._alignUpdateTimer = QtCore.QTimer(self)
+        self._alignUpdateTimer.setSingleShot(True)
+        self._alignUpdateTimer.timeout.connect(self._model.flushAlignChanges)
+        self._model.setAlignChangeDeferredCallback(self._alignChangeDeferred)
+        self._model.setAlignUpdateInterval(0.033)
         self._model.setFitSettingsChangeCallback(self._fitSettingsDisplay)
         self._ui.sceneviewerWidget.graphicsInitialized.connect(self._graphicsInitialized)
         self._scene = None
         self._callback = None
+        self._operationThread = None
+        self._operationFinishedCallback = None
+        self._sceneviewerSizeLimits = None
         self._makeConnections()
 
     def _graphicsInitialized(self):
@@ -54,19 +91,29 @@ class SmoothfitWidget(QtWidgets.QWidget):
         self._ui.alignMirrorCheckBox.clicked.connect(self._alignMirrorClicked)
         self._ui.alignResetButton.clicked.connect(self._alignResetButtonClicked)
         self._ui.alignAutoCentreButton.clicked.connect(self._alignAutoCentreButtonClicked)
+        self._ui.alignAutoRegisterButton.clicked.connect(self._alignAutoRegisterButtonClicked)
+        self._ui.alignSearchButton.clicked.connect(self._alignSearchButtonClicked)
         self._ui.projectClearButton.clicked.connect(self._projectClearButtonClicked)
         self._ui.projectPointsButton.clicked.connect(self._projectPointsButtonClicked)
         self._ui.filterTopErrorPushButton.clicked.connect(self._filterTopErrorClicked)
         self._ui.filterTopErrorProportionLineEdit.editingFinished.connect(self._filterTopErrorProportionEntered)
         self._ui.filterNonNormalPushButton.clicked.connect(self._filterNonNormalClicked)
         self._ui.filterNonNormalProjectionLimitLineEdit.editingFinished.connect(self._filterNonNormalProjectionLimitEntered)
+        self._ui.filterDecimatePushButton.clicked.connect(self._filterDecimateClicked)
+        self._ui.filterDecimateRestorePushButton.clicked.connect(self._filterDecimateRestoreClicked)
+        self._ui.filterDecimateSpacingLineEdit.editingFinished.connect(self._filterDecimateSpacingEntered)
+        self._ui.filterDecimateMethodComboBox.currentIndexChanged.connect(self._filterDecimateMethodChanged)
         self._ui.fitLoadButton.clicked.connect(self._fitLoadButtonClicked)
         self._ui.fitSaveButton.clicked.connect(self._fitSaveButtonClicked)
         self._ui.fitStrainPenaltyLineEdit.editingFinished.connect(self._fitStrainPenaltyEntered)
         self._ui.fitCurvaturePenaltyLineEdit.editingFinished.connect(self._fitCurvaturePenaltyEntered)
         self._ui.fitEdgeDiscontinuityPenaltyLineEdit.editingFinished.connect(self._fitEdgeDiscontinuityPenaltyEntered)
         self._ui.fitMaxIterationsSpinBox.valueChanged.connect(self._fitMaxIterationsValueChanged)
+        self._ui.fitMethodComboBox.currentIndexChanged.connect(self._fitMethodChanged)
+        self._ui.fitOuterMaxIterationsSpinBox.valueChanged.connect(self._fitOuterMaxIterationsValueChanged)
+        self._ui.fitIterateButton.clicked.connect(self._fitIterateButtonClicked)
         self._ui.fitPerformButton.clicked.connect(self._fitPerformButtonClicked)
+        self._ui.cancelButton.clicked.connect(self._cancelButtonClicked)
 
     def clear(self):
         self._scene = None
@@ -148,14 +195,112 @@ class SmoothfitWidget(QtWidgets.QWidget):
         self._displayVector(self._ui.alignOffsetLineEdit, self._model.getAlignOffset())
         self._ui.alignMirrorCheckBox.setCheckState(
             QtCore.Qt.Checked if self._model.isAlignMirror() else QtCore.Qt.Unchecked)
+        self._alignErrorPreviewDisplay()
+
+    def _alignChangeDeferred(self, seconds):
+        if self._operationThread is not None:
+            # flushed when the operation finishes
+            return
+        if not self._alignUpdateTimer.isActive():
+            self._alignUpdateTimer.start(int(seconds*1000.0) + 1)
+
+    def _alignErrorPreviewDisplay(self):
+        preview = self._model.getAlignErrorPreview()
+        if preview is None:
+            self._ui.alignErrorPreviewLabel.setText('RMS error: -')
+        else:
+            self._ui.alignErrorPreviewLabel.setText('RMS error: {:.4g}  Max error: {:.4g}'.format(
+                preview['rms_error'], preview['max_error']))
 
     def _fitSettingsDisplay(self):
         self._displayReal(self._ui.filterTopErrorProportionLineEdit, self._model.getFilterTopErrorProportion())
         self._displayReal(self._ui.filterNonNormalProjectionLimitLineEdit, self._model.getFilterNonNormalProjectionLimit())
+        self._displayReal(self._ui.filterDecimateSpacingLineEdit, self._model.getDecimationSpacing())
+        self._ui.filterDecimateMethodComboBox.blockSignals(True)
+        self._ui.filterDecimateMethodComboBox.setCurrentIndex(
+            1 if self._model.getDecimationMethod() == self._model.DECIMATION_METHOD_POISSON_DISK else 0)
+        self._ui.filterDecimateMethodComboBox.blockSignals(False)
         self._displayReal(self._ui.fitStrainPenaltyLineEdit, self._model.getFitStrainPenalty())
         self._displayReal(self._ui.fitCurvaturePenaltyLineEdit, self._model.getFitCurvaturePenalty())
         self._displayReal(self._ui.fitEdgeDiscontinuityPenaltyLineEdit, self._model.getFitEdgeDiscontinuityPenalty())
         self._ui.fitMaxIterationsSpinBox.setValue(self._model.getFitMaxIterations())
+        self._ui.fitOuterMaxIterationsSpinBox.setValue(self._model.getFitOuterMaxIterations())
+        self._ui.fitMethodComboBox.blockSignals(True)
+        self._ui.fitMethodComboBox.setCurrentIndex(
+            1 if self._model.getFitMethod() == self._model.FIT_METHOD_LINEAR_DIRECT else 0)
+        self._ui.fitMethodComboBox.blockSignals(False)
+
+    def _runModelOperation(self, description, operation, finishedCallback=None):
+        '''
+        Run a long model operation on a worker thread with progress and cancel.
+        Zinc is not thread safe, so all zinc calls while it runs are made on
+        the worker thread. Everything which calls zinc from the GUI thread is
+        stopped first: the controls and scene viewer are disabled, scene viewer
+        repaints and resizes are suspended, and pending align changes are
+        applied and the align update timer stopped. Scene changes are cached so
+        graphics are only updated on the GUI thread when the operation completes.
+        :param description: text shown until progress is reported
+        :param operation: function taking no arguments
+        :param finishedCallback: optional function taking no arguments, called
+        on the GUI thread after the operation completes without error
+        '''
+        if self._operationThread is not None:
+            return
+        self._alignUpdateTimer.stop()
+        self._model.flushAlignChanges()
+        self._model.clearCancelRequest()
+        self._setOperationRunning(True)
+        self._ui.progressBar.setRange(0, 0)
+        self._ui.progressBar.setFormat(description)
+        self._model.getRegion().getScene().beginChange()
+        self._operationFinishedCallback = finishedCallback
+        self._operationThread = ModelOperationThread(operation, self)
+        self._operationThread.progress.connect(self._operationProgress)
+        self._operationThread.finished.connect(self._operationFinished)
+        self._model.setProgressCallback(self._operationThread.progress.emit)
+        self._operationThread.start()
+
+    def _setOperationRunning(self, running):
+        self._ui.toolBox.setEnabled(not running)
+        self._ui.frame.setEnabled(not running)
+        sceneviewerWidget = self._ui.sceneviewerWidget
+        sceneviewerWidget.setEnabled(not running)
+        sceneviewerWidget.setUpdatesEnabled(not running)
+        # resizing sets the zinc scene viewer viewport size, so fix the size while running
+        if running:
+            self._sceneviewerSizeLimits = (sceneviewerWidget.minimumSize(), sceneviewerWidget.maximumSize())
+            sceneviewerWidget.setFixedSize(sceneviewerWidget.size())
+        elif self._sceneviewerSizeLimits is not None:
+            sceneviewerWidget.setMinimumSize(self._sceneviewerSizeLimits[0])
+            sceneviewerWidget.setMaximumSize(self._sceneviewerSizeLimits[1])
+            self._sceneviewerSizeLimits = None
+        self._ui.cancelButton.setEnabled(running)
+
+    def _operationProgress(self, description, done, total):
+        self._ui.progressBar.setRange(0, total)
+        self._ui.progressBar.setValue(done)
+        self._ui.progressBar.setFormat(description + ' %v / %m')
+
+    def _operationFinished(self):
+        errorMessage = self._operationThread.getErrorMessage()
+        self._operationThread = None
+        self._model.setProgressCallback(None)
+        self._model.getRegion().getScene().endChange()
+        self._setOperationRunning(False)
+        self._ui.progressBar.setRange(0, 1)
+        self._ui.progressBar.setValue(0)
+        self._ui.progressBar.setFormat('Cancelled' if self._model.isCancelRequested() else 'Idle')
+        if errorMessage is not None:
+            print(errorMessage)
+        elif self._operationFinishedCallback is not None:
+            self._operationFinishedCallback()
+        self._operationFinishedCallback = None
+        self._model.flushAlignChanges()
+        self._ui.sceneviewerWidget.update()
+
+    def _cancelButtonClicked(self):
+        self._model.requestCancel()
+        self._ui.progressBar.setFormat('Cancelling')
 
     def registerDoneExecution(self, callback):
         self._callback = callback
@@ -163,6 +308,7 @@ class SmoothfitWidget(QtWidgets.QWidget):
     def _doneButtonClicked(self):
         self._model.setStatePostAlign() # ensure model is transformed; does nothing if not in align tab
         self._model.writeOutputModel()
+        self._model.shutdownProjectionWorkers()
         #sceneviewer = self._ui.sceneviewerWidget.getSceneviewer()
         #sceneviewer.setScene(Scene())
         self._ui.dockWidget.setFloating(False)
@@ -177,6 +323,7 @@ class SmoothfitWidget(QtWidgets.QWidget):
             self._model.setStateAlign()
         else:
             self._model.setStatePostAlign()
+        self._alignErrorPreviewDisplay()
 
     def _alignLoadButtonClicked(self):
         self._model.loadAlignSettings()
@@ -213,24 +360,49 @@ class SmoothfitWidget(QtWidgets.QWidget):
     def _alignAutoCentreButtonClicked(self):
         self._model.autoCentreModelOnData()
 
+    def _alignAutoRegisterButtonClicked(self):
+        self._model.autoRegisterModelToData()
+
+    def _alignSearchButtonClicked(self):
+        self._runModelOperation('Searching alignments',
+            lambda: self._model.searchAlignments(workerCount=self._model.getProjectionWorkerCount(), applyBest=False),
+            self._alignSearchFinished)
+
+    def _alignSearchFinished(self):
+        if self._model.getAlignSearchResults():
+            self._model.applyAlignSearchResult(0)
+
     def _projectClearButtonClicked(self):
         self._model.clearDataProjections()
 
     def _projectPointsButtonClicked(self):
-        self._model.calculateDataProjections()
+        self._runModelOperation('Projecting points', self._model.calculateDataProjections)
 
     def _filterTopErrorClicked(self):
-        self._model.filterTopError()
+        self._runModelOperation('Filtering', self._model.filterTopError)
 
     def _filterTopErrorProportionEntered(self):
         self._model.setFilterTopErrorProportion(self._parseRealZeroToOne(self._ui.filterTopErrorProportionLineEdit, self._model.getFilterTopErrorProportion()))
 
     def _filterNonNormalClicked(self):
-        self._model.filterNonNormal()
+        self._runModelOperation('Filtering', self._model.filterNonNormal)
 
     def _filterNonNormalProjectionLimitEntered(self):
         self._model.setFilterNonNormalProjectionLimit(self._parseRealZeroToOne(self._ui.filterNonNormalProjectionLimitLineEdit, self._model.getFilterNonNormalProjectionLimit()))
 
+    def _filterDecimateClicked(self):
+        self._model.decimateDataPoints()
+
+    def _filterDecimateRestoreClicked(self):
+        self._model.restoreDecimatedDataPoints()
+
+    def _filterDecimateSpacingEntered(self):
+        self._model.setDecimationSpacing(self._parseRealNonNegative(self._ui.filterDecimateSpacingLineEdit, self._model.getDecimationSpacing()))
+
+    def _filterDecimateMethodChanged(self, index):
+        self._model.setDecimationMethod(
+            self._model.DECIMATION_METHOD_POISSON_DISK if index == 1 else self._model.DECIMATION_METHOD_VOXEL_GRID)
+
     def _fitLoadButtonClicked(self):
         self._model.loadFitSettings()
 
@@ -249,5 +421,15 @@ class SmoothfitWidget(QtWidgets.QWidget):
     def _fitMaxIterationsValueChanged(self, value):
         self._model.setFitMaxIterations(value)
 
+    def _fitMethodChanged(self, index):
+        self._model.setFitMethod(
+            self._model.FIT_METHOD_LINEAR_DIRECT if index == 1 else self._model.FIT_METHOD_QUASI_NEWTON)
+
     def _fitPerformButtonClicked(self):
-        self._model.fit()
+        self._runModelOperation('Fitting', self._model.fit)
+
+    def _fitOuterMaxIterationsValueChanged(self, value):
+        self._model.setFitOuterMaxIterations(value)
+
+    def _fitIterateButtonClicked(self):
+        self._runModelOperation('Projecting and fitting', self._model.fitIterate)
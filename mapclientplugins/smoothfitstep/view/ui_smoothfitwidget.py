@@ -183,6 +183,21 @@ class Ui_SmoothfitWidget(object):
 
         self.verticalLayout_5.addWidget(self.alignAutoCentreButton)
 
+        self.alignAutoRegisterButton = QPushButton(self.alignPage)
+        self.alignAutoRegisterButton.setObjectName(u"alignAutoRegisterButton")
+
+        self.verticalLayout_5.addWidget(self.alignAutoRegisterButton)
+
+        self.alignSearchButton = QPushButton(self.alignPage)
+        self.alignSearchButton.setObjectName(u"alignSearchButton")
+
+        self.verticalLayout_5.addWidget(self.alignSearchButton)
+
+        self.alignErrorPreviewLabel = QLabel(self.alignPage)
+        self.alignErrorPreviewLabel.setObjectName(u"alignErrorPreviewLabel")
+
+        self.verticalLayout_5.addWidget(self.alignErrorPreviewLabel)
+
         self.verticalSpacer_2 = QSpacerItem(20, 40, QSizePolicy.Minimum, QSizePolicy.Expanding)
 
         self.verticalLayout_5.addItem(self.verticalSpacer_2)
@@ -251,6 +266,38 @@ class Ui_SmoothfitWidget(object):
 
         self.gridLayout_3.addWidget(self.filterTopErrorProportionLabel, 0, 1, 1, 1)
 
+        self.filterDecimatePushButton = QPushButton(self.filterDataGroupBox)
+        self.filterDecimatePushButton.setObjectName(u"filterDecimatePushButton")
+
+        self.gridLayout_3.addWidget(self.filterDecimatePushButton, 3, 0, 1, 1)
+
+        self.filterDecimateSpacingLabel = QLabel(self.filterDataGroupBox)
+        self.filterDecimateSpacingLabel.setObjectName(u"filterDecimateSpacingLabel")
+
+        self.gridLayout_3.addWidget(self.filterDecimateSpacingLabel, 3, 1, 1, 1)
+
+        self.filterDecimateSpacingLineEdit = QLineEdit(self.filterDataGroupBox)
+        self.filterDecimateSpacingLineEdit.setObjectName(u"filterDecimateSpacingLineEdit")
+
+        self.gridLayout_3.addWidget(self.filterDecimateSpacingLineEdit, 3, 2, 1, 1)
+
+        self.filterDecimateRestorePushButton = QPushButton(self.filterDataGroupBox)
+        self.filterDecimateRestorePushButton.setObjectName(u"filterDecimateRestorePushButton")
+
+        self.gridLayout_3.addWidget(self.filterDecimateRestorePushButton, 4, 0, 1, 1)
+
+        self.filterDecimateMethodLabel = QLabel(self.filterDataGroupBox)
+        self.filterDecimateMethodLabel.setObjectName(u"filterDecimateMethodLabel")
+
+        self.gridLayout_3.addWidget(self.filterDecimateMethodLabel, 4, 1, 1, 1)
+
+        self.filterDecimateMethodComboBox = QComboBox(self.filterDataGroupBox)
+        self.filterDecimateMethodComboBox.addItem("")
+        self.filterDecimateMethodComboBox.addItem("")
+        self.filterDecimateMethodComboBox.setObjectName(u"filterDecimateMethodComboBox")
+
+        self.gridLayout_3.addWidget(self.filterDecimateMethodComboBox, 4, 2, 1, 1)
+
 
         self.verticalLayout_4.addWidget(self.filterDataGroupBox)
 
@@ -341,6 +388,36 @@ class Ui_SmoothfitWidget(object):
 
         self.formLayout_2.setWidget(1, QFormLayout.LabelRole, self.fitCurvaturePenaltyLabel)
 
+        self.fitMethodLabel = QLabel(self.fitSettingsWidget)
+        self.fitMethodLabel.setObjectName(u"fitMethodLabel")
+
+        self.formLayout_2.setWidget(4, QFormLayout.LabelRole, self.fitMethodLabel)
+
+        self.fitMethodComboBox = QComboBox(self.fitSettingsWidget)
+        self.fitMethodComboBox.addItem("")
+        self.fitMethodComboBox.addItem("")
+        self.fitMethodComboBox.setObjectName(u"fitMethodComboBox")
+
+        self.formLayout_2.setWidget(4, QFormLayout.FieldRole, self.fitMethodComboBox)
+
+        self.fitOuterMaxIterationsLabel = QLabel(self.fitSettingsWidget)
+        self.fitOuterMaxIterationsLabel.setObjectName(u"fitOuterMaxIterationsLabel")
+
+        self.formLayout_2.setWidget(5, QFormLayout.LabelRole, self.fitOuterMaxIterationsLabel)
+
+        self.fitOuterMaxIterationsSpinBox = QSpinBox(self.fitSettingsWidget)
+        self.fitOuterMaxIterationsSpinBox.setObjectName(u"fitOuterMaxIterationsSpinBox")
+        self.fitOuterMaxIterationsSpinBox.setMinimum(1)
+        self.fitOuterMaxIterationsSpinBox.setMaximum(1000)
+        self.fitOuterMaxIterationsSpinBox.setValue(10)
+
+        self.formLayout_2.setWidget(5, QFormLayout.FieldRole, self.fitOuterMaxIterationsSpinBox)
+
+        self.fitIterateButton = QPushButton(self.fitSettingsWidget)
+        self.fitIterateButton.setObjectName(u"fitIterateButton")
+
+        self.formLayout_2.setWidget(7, QFormLayout.SpanningRole, self.fitIterateButton)
+
 
         self.verticalLayout_6.addWidget(self.fitSettingsWidget)
 
@@ -355,6 +432,28 @@ class Ui_SmoothfitWidget(object):
 
         self.verticalLayout_3.addWidget(self.toolBox)
 
+        self.progressFrame = QFrame(self.scrollAreaWidgetContents)
+        self.progressFrame.setObjectName(u"progressFrame")
+        self.progressFrame.setFrameShape(QFrame.StyledPanel)
+        self.progressFrame.setFrameShadow(QFrame.Raised)
+        self.horizontalLayout_3 = QHBoxLayout(self.progressFrame)
+        self.horizontalLayout_3.setObjectName(u"horizontalLayout_3")
+        self.horizontalLayout_3.setContentsMargins(3, 3, 3, 3)
+        self.progressBar = QProgressBar(self.progressFrame)
+        self.progressBar.setObjectName(u"progressBar")
+        self.progressBar.setValue(0)
+
+        self.horizontalLayout_3.addWidget(self.progressBar)
+
+        self.cancelButton = QPushButton(self.progressFrame)
+        self.cancelButton.setObjectName(u"cancelButton")
+        self.cancelButton.setEnabled(False)
+
+        self.horizontalLayout_3.addWidget(self.cancelButton)
+
+
+        self.verticalLayout_3.addWidget(self.progressFrame)
+
         self.frame = QFrame(self.scrollAreaWidgetContents)
         self.frame.setObjectName(u"frame")
         self.frame.setFrameShape(QFrame.StyledPanel)
@@ -441,6 +540,18 @@ class Ui_SmoothfitWidget(object):
         self.alignAutoCentreButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Offset the model to the centre of the data points. May need to click View All afterwards.", None))
 #endif // QT_CONFIG(tooltip)
         self.alignAutoCentreButton.setText(QCoreApplication.translate("SmoothfitWidget", u"Auto Centre", None))
+#if QT_CONFIG(tooltip)
+        self.alignAutoRegisterButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Rotate, scale and offset the model to best match the data points. Start from a rough alignment for partial scans.", None))
+#endif // QT_CONFIG(tooltip)
+        self.alignAutoRegisterButton.setText(QCoreApplication.translate("SmoothfitWidget", u"Auto Register", None))
+#if QT_CONFIG(tooltip)
+        self.alignSearchButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Register the model with the data points from many initial rotations and apply the best. Use where Auto Register finds the wrong orientation.", None))
+#endif // QT_CONFIG(tooltip)
+        self.alignSearchButton.setText(QCoreApplication.translate("SmoothfitWidget", u"Search Alignments", None))
+#if QT_CONFIG(tooltip)
+        self.alignErrorPreviewLabel.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Estimated distances from a sample of data points to the aligned model surface", None))
+#endif // QT_CONFIG(tooltip)
+        self.alignErrorPreviewLabel.setText(QCoreApplication.translate("SmoothfitWidget", u"RMS error: -", None))
         self.toolBox.setItemText(self.toolBox.indexOf(self.alignPage), QCoreApplication.translate("SmoothfitWidget", u"Align", None))
         self.groupBoxProjectData.setTitle(QCoreApplication.translate("SmoothfitWidget", u"1. Projections", None))
 #if QT_CONFIG(tooltip)
@@ -468,6 +579,25 @@ class Ui_SmoothfitWidget(object):
 #endif // QT_CONFIG(tooltip)
         self.filterTopErrorPushButton.setText(QCoreApplication.translate("SmoothfitWidget", u"Remove top error", None))
         self.filterTopErrorProportionLabel.setText(QCoreApplication.translate("SmoothfitWidget", u"Proportion:", None))
+#if QT_CONFIG(tooltip)
+        self.filterDecimatePushButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Remove data points so remaining points are approximately the given spacing apart", None))
+#endif // QT_CONFIG(tooltip)
+        self.filterDecimatePushButton.setText(QCoreApplication.translate("SmoothfitWidget", u"Decimate", None))
+        self.filterDecimateSpacingLabel.setText(QCoreApplication.translate("SmoothfitWidget", u"Spacing:", None))
+#if QT_CONFIG(tooltip)
+        self.filterDecimateSpacingLineEdit.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Voxel size or minimum distance between data points kept by decimation", None))
+#endif // QT_CONFIG(tooltip)
+#if QT_CONFIG(tooltip)
+        self.filterDecimateRestorePushButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Restore all data points removed by decimation", None))
+#endif // QT_CONFIG(tooltip)
+        self.filterDecimateRestorePushButton.setText(QCoreApplication.translate("SmoothfitWidget", u"Restore decimated", None))
+        self.filterDecimateMethodLabel.setText(QCoreApplication.translate("SmoothfitWidget", u"Method:", None))
+        self.filterDecimateMethodComboBox.setItemText(0, QCoreApplication.translate("SmoothfitWidget", u"Voxel grid", None))
+        self.filterDecimateMethodComboBox.setItemText(1, QCoreApplication.translate("SmoothfitWidget", u"Poisson disk", None))
+
+#if QT_CONFIG(tooltip)
+        self.filterDecimateMethodComboBox.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Voxel grid keeps the point nearest the mean in each voxel; Poisson disk keeps random points no closer than the spacing", None))
+#endif // QT_CONFIG(tooltip)
         self.fitSettingsGroupBox.setTitle(QCoreApplication.translate("SmoothfitWidget", u"3. Fit", None))
 #if QT_CONFIG(tooltip)
         self.fitLoadButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Load pre-saved fitting settings", None))
@@ -494,7 +624,30 @@ class Ui_SmoothfitWidget(object):
         self.fitMaxIterationsSpinBox.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Maximum number of iterations to limit fit time if convergence is slow", None))
 #endif // QT_CONFIG(tooltip)
         self.fitCurvaturePenaltyLabel.setText(QCoreApplication.translate("SmoothfitWidget", u"Curvature Penalty:", None))
+        self.fitMethodLabel.setText(QCoreApplication.translate("SmoothfitWidget", u"Method:", None))
+        self.fitMethodComboBox.setItemText(0, QCoreApplication.translate("SmoothfitWidget", u"Quasi-Newton", None))
+        self.fitMethodComboBox.setItemText(1, QCoreApplication.translate("SmoothfitWidget", u"Linear direct", None))
+
+#if QT_CONFIG(tooltip)
+        self.fitMethodComboBox.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Quasi-Newton optimises iteratively; Linear direct solves for the fixed projections in one step, without edge discontinuity penalty", None))
+#endif // QT_CONFIG(tooltip)
+        self.fitOuterMaxIterationsLabel.setText(QCoreApplication.translate("SmoothfitWidget", u"Project+Fit Iterations:", None))
+#if QT_CONFIG(tooltip)
+        self.fitOuterMaxIterationsSpinBox.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Maximum number of alternating project and fit iterations", None))
+#endif // QT_CONFIG(tooltip)
+#if QT_CONFIG(tooltip)
+        self.fitIterateButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Alternate projecting points and fitting until converged or the iteration or time limit is reached", None))
+#endif // QT_CONFIG(tooltip)
+        self.fitIterateButton.setText(QCoreApplication.translate("SmoothfitWidget", u"Project and Fit", None))
         self.toolBox.setItemText(self.toolBox.indexOf(self.fitPage), QCoreApplication.translate("SmoothfitWidget", u"Fit", None))
+#if QT_CONFIG(tooltip)
+        self.progressBar.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Progress of the running projection, filter or fit", None))
+#endif // QT_CONFIG(tooltip)
+        self.progressBar.setFormat(QCoreApplication.translate("SmoothfitWidget", u"Idle", None))
+#if QT_CONFIG(tooltip)
+        self.cancelButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Stop the running operation at the next safe point", None))
+#endif // QT_CONFIG(tooltip)
+        self.cancelButton.setText(QCoreApplication.translate("SmoothfitWidget", u"Cancel", None))
 #if QT_CONFIG(tooltip)
         self.viewAllButton.setToolTip(QCoreApplication.translate("SmoothfitWidget", u"Adjust the view to see the whole model", None))
 #endif // QT_CONFIG(tooltip)
@@ -17,7 +17,9 @@ readme = readfile("README.rst", split=True)[3:]  # skip title
 requires = [
     # minimal requirements listing
     "opencmiss.zinc >= 3.3",  # not yet on pypi - need manual install from opencmiss.org
-    "opencmiss.zincwidgets >= 2.0.3"
+    "opencmiss.zincwidgets >= 2.0.3",
+    "numpy",
+    "scipy"
 ]
 license = readfile("LICENSE")
 
@@ -0,0 +1,69 @@
+'''
+Tests of point cloud decimation spacing and coverage.
+'''
+import numpy
+import pytest
+from scipy.spatial import cKDTree
+
+from mapclientplugins.smoothfitstep.maths.decimation import poissonDiskDecimate, voxelGridDecimate
+
+
+def createPoints(count=20000, seed=0):
+    '''
+    :return: (count, 3) points on a noisy curved sheet
+    '''
+    rng = numpy.random.default_rng(seed)
+    x = rng.uniform(0.0, 4.0, count)
+    y = rng.uniform(0.0, 3.0, count)
+    return numpy.stack([x, y, 0.3*numpy.sin(x)*numpy.cos(y) + rng.normal(0.0, 0.02, count)], axis=1)
+
+
+def test_poisson_disk_spacing_and_coverage():
+    points = createPoints()
+    spacing = 0.1
+    kept = poissonDiskDecimate(points, spacing)
+    assert numpy.all(numpy.diff(kept) > 0)
+    keptPoints = points[kept]
+    # no two kept points closer than spacing
+    assert not cKDTree(keptPoints).query_pairs(spacing*(1.0 - 1.0E-12))
+    # every point within spacing of a kept point
+    assert numpy.max(cKDTree(keptPoints).query(points)[0]) < spacing
+    assert 0 < kept.size < points.shape[0]
+
+
+def test_poisson_disk_is_repeatable():
+    points = createPoints(5000, seed=1)
+    numpy.testing.assert_array_equal(poissonDiskDecimate(points, 0.2, seed=3), poissonDiskDecimate(points, 0.2, seed=3))
+    assert not numpy.array_equal(poissonDiskDecimate(points, 0.2, seed=3), poissonDiskDecimate(points, 0.2, seed=4))
+
+
+def test_poisson_disk_2d():
+    points = numpy.random.default_rng(2).random((5000, 2))
+    spacing = 0.05
+    keptPoints = points[poissonDiskDecimate(points, spacing)]
+    assert not cKDTree(keptPoints).query_pairs(spacing*(1.0 - 1.0E-12))
+    assert numpy.max(cKDTree(keptPoints).query(points)[0]) < spacing
+
+
+def test_voxel_grid_one_point_per_voxel():
+    points = createPoints()
+    spacing = 0.25
+    kept = voxelGridDecimate(points, spacing)
+    assert numpy.all(numpy.diff(kept) > 0)
+    voxels = numpy.floor((points - points.min(axis=0))/spacing).astype(numpy.int64)
+    occupiedVoxels = numpy.unique(voxels, axis=0)
+    keptVoxels = voxels[kept]
+    assert kept.size == occupiedVoxels.shape[0]
+    assert numpy.unique(keptVoxels, axis=0).shape[0] == kept.size
+    # kept point is the closest to the mean of its voxel
+    for voxel, index in zip(keptVoxels[:50], kept[:50]):
+        inVoxel = numpy.flatnonzero(numpy.all(voxels == voxel, axis=1))
+        mean = points[inVoxel].mean(axis=0)
+        distances = numpy.linalg.norm(points[inVoxel] - mean, axis=1)
+        assert numpy.linalg.norm(points[index] - mean) == pytest.approx(distances.min(), rel=1.0E-12)
+
+
+def test_decimate_empty():
+    points = numpy.empty((0, 3))
+    assert poissonDiskDecimate(points, 1.0).size == 0
+    assert voxelGridDecimate(points, 1.0).size == 0
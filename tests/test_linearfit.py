@@ -0,0 +1,148 @@
+'''
+Tests of linear fit penalty rows against numerical integrals of the strain
+and curvature penalties, for displacements of elements with affine reference
+coordinates whose derivatives are known exactly.
+'''
+import itertools
+
+import numpy
+import scipy.sparse
+
+from mapclientplugins.smoothfitstep.maths.elementpatches import ElementPatches, patchXi
+from mapclientplugins.smoothfitstep.maths.linearfit import ElementParameterMaps, assembleDataRows, \
+    assemblePenaltyRows, solveLinearLeastSquares
+
+
+# cubic displacement components as lists of (coefficient, xi exponents)
+DISPLACEMENT_TERMS = [
+    [(1.0, (3, 0, 0)), (-2.0, (1, 2, 0)), (0.5, (0, 1, 1))],
+    [(1.0, (0, 3, 0)), (1.0, (2, 1, 0)), (-0.7, (1, 0, 2))],
+    [(1.0, (1, 1, 1)), (0.5, (2, 0, 0)), (0.3, (0, 0, 3))]]
+
+
+def evaluateDisplacement(xi):
+    '''
+    :return: displacement (N, 3), derivatives w.r.t. xi (N, 3, dimension),
+    second derivatives (N, 3, dimension, dimension)
+    '''
+    n, dimension = xi.shape
+    values = numpy.zeros((n, 3))
+    first = numpy.zeros((n, 3, dimension))
+    second = numpy.zeros((n, 3, dimension, dimension))
+
+    def monomial(exponents, derivative):
+        result = numpy.ones(n)
+        for d in range(dimension):
+            order = derivative.count(d)
+            power = exponents[d] - order
+            if power < 0:
+                return numpy.zeros(n)
+            result = result*numpy.prod(numpy.arange(power + 1, exponents[d] + 1))*xi[:, d]**power
+        return result
+
+    for c, terms in enumerate(DISPLACEMENT_TERMS):
+        for coefficient, exponents in terms:
+            if any(exponents[d] for d in range(dimension, 3)):
+                continue
+            values[:, c] += coefficient*monomial(exponents, ())
+            for i in range(dimension):
+                first[:, c, i] += coefficient*monomial(exponents, (i,))
+                for j in range(dimension):
+                    second[:, c, i, j] += coefficient*monomial(exponents, (i, j))
+    return values, first, second
+
+
+def createElement(referenceMatrix):
+    '''
+    :param referenceMatrix: (3, dimension) dX/dxi of the affine reference element
+    :return: ElementParameterMaps with one parameter per control point,
+    reference ElementPatches and displacement parameters (K, 3)
+    '''
+    dimension = referenceMatrix.shape[1]
+    xi = patchXi(dimension)
+    controlPointCount = xi.shape[0]
+    parameterMaps = ElementParameterMaps([1], numpy.arange(controlPointCount)[numpy.newaxis],
+                                         numpy.identity(controlPointCount)[numpy.newaxis], dimension, controlPointCount)
+    referencePatches = ElementPatches([1], numpy.matmul(xi, referenceMatrix.T)[numpy.newaxis] + 0.25, dimension)
+    return parameterMaps, referencePatches, evaluateDisplacement(xi)[0]
+
+
+def midpointXi(dimension, pointsPerDirection):
+    t = (numpy.arange(pointsPerDirection) + 0.5)/pointsPerDirection
+    return numpy.array(list(itertools.product(t, repeat=dimension)))
+
+
+def penaltySum(rows, displacement):
+    residuals = rows.dot(displacement)
+    return float(numpy.sum(residuals*residuals))
+
+
+def test_penalty_rows_integrate_2d_arc_length_derivatives():
+    # flat rectangle, so arc lengths along xi are scaled by its side lengths
+    sides = numpy.array([2.0, 0.5])
+    referenceMatrix = numpy.array([[sides[0], 0.0], [0.0, sides[1]], [0.0, 0.0]])
+    parameterMaps, referencePatches, displacement = createElement(referenceMatrix)
+    xi = midpointXi(2, 400)
+    first, second = evaluateDisplacement(xi)[1:]
+    area = sides[0]*sides[1]
+    strainIntegral = area*numpy.mean(numpy.sum((first/sides)**2, axis=(1, 2)))
+    curvatureIntegral = area*numpy.mean(numpy.sum((second/numpy.outer(sides, sides))**2, axis=(1, 2, 3)))
+    strainRows = assemblePenaltyRows(parameterMaps, referencePatches, 1.0, 0.0, pointsPerDirection=4)
+    curvatureRows = assemblePenaltyRows(parameterMaps, referencePatches, 0.0, 1.0, pointsPerDirection=4)
+    numpy.testing.assert_allclose(penaltySum(strainRows, displacement), strainIntegral, rtol=1.0E-4)
+    numpy.testing.assert_allclose(penaltySum(curvatureRows, displacement), curvatureIntegral, rtol=1.0E-4)
+    bothRows = assemblePenaltyRows(parameterMaps, referencePatches, 1.0, 1.0, pointsPerDirection=4)
+    numpy.testing.assert_allclose(penaltySum(bothRows, displacement), strainIntegral + curvatureIntegral, rtol=1.0E-4)
+
+
+def test_penalty_rows_integrate_3d_coordinate_derivatives():
+    referenceMatrix = numpy.array([[1.5, 0.2, 0.0], [0.1, 0.8, 0.3], [0.0, -0.2, 1.2]])
+    parameterMaps, referencePatches, displacement = createElement(referenceMatrix)
+    xi = midpointXi(3, 60)
+    first, second = evaluateDisplacement(xi)[1:]
+    dxi_dX = numpy.linalg.inv(referenceMatrix)
+    volume = abs(numpy.linalg.det(referenceMatrix))
+    strain = numpy.matmul(first, dxi_dX)
+    curvature = numpy.matmul(numpy.matmul(dxi_dX.T, second), dxi_dX)
+    strainIntegral = volume*numpy.mean(numpy.sum(strain**2, axis=(1, 2)))
+    curvatureIntegral = volume*numpy.mean(numpy.sum(curvature**2, axis=(1, 2, 3)))
+    strainRows = assemblePenaltyRows(parameterMaps, referencePatches, 1.0, 0.0, pointsPerDirection=4)
+    curvatureRows = assemblePenaltyRows(parameterMaps, referencePatches, 0.0, 1.0, pointsPerDirection=4)
+    numpy.testing.assert_allclose(penaltySum(strainRows, displacement), strainIntegral, rtol=1.0E-3)
+    numpy.testing.assert_allclose(penaltySum(curvatureRows, displacement), curvatureIntegral, rtol=1.0E-3)
+
+
+def test_penalty_rows_zero_for_rigid_translation():
+    referenceMatrix = numpy.array([[1.0, 0.0], [0.0, 1.0], [0.0, 0.0]])
+    parameterMaps, referencePatches, displacement = createElement(referenceMatrix)
+    rows = assemblePenaltyRows(parameterMaps, referencePatches, 1.0, 1.0)
+    translation = numpy.tile([0.3, -1.0, 2.0], (displacement.shape[0], 1))
+    assert penaltySum(rows, translation) < 1.0E-24
+
+
+def test_no_penalty_rows_without_penalties():
+    parameterMaps, referencePatches, displacement = createElement(numpy.array([[1.0, 0.0], [0.0, 1.0], [0.0, 0.0]]))
+    rows = assemblePenaltyRows(parameterMaps, referencePatches, 0.0, 0.0)
+    assert rows.shape == (0, parameterMaps.getNumberOfParameters())
+
+
+def test_data_rows_interpolate_patches():
+    parameterMaps, referencePatches, displacement = createElement(numpy.array([[1.0, 0.0], [0.0, 1.0], [0.0, 0.0]]))
+    xi = numpy.random.default_rng(0).random((20, 2))
+    elementIndexes = numpy.zeros(20, dtype=numpy.int32)
+    rows = assembleDataRows(parameterMaps, elementIndexes, xi)
+    numpy.testing.assert_allclose(rows.dot(displacement), evaluateDisplacement(xi)[0], atol=1.0E-12)
+    numpy.testing.assert_allclose(rows.dot(displacement),
+                                  parameterMaps.getPatches(displacement).evaluate(elementIndexes, xi)[0], atol=1.0E-12)
+
+
+def test_solve_keeps_fixed_parameters():
+    matrix = scipy.sparse.identity(4, format='csr')
+    targets = numpy.arange(8.0).reshape(4, 2)
+    parameters = -numpy.ones((4, 2))
+    free = numpy.array([True, False, True, False])
+    solution, objectiveBefore, objectiveAfter = solveLinearLeastSquares(matrix, targets, parameters, free)
+    numpy.testing.assert_allclose(solution[free], targets[free], atol=1.0E-8)
+    numpy.testing.assert_array_equal(solution[~free], parameters[~free])
+    numpy.testing.assert_allclose(objectiveAfter, numpy.sum((targets - parameters)[~free]**2), rtol=1.0E-8)
+    assert objectiveBefore > objectiveAfter
@@ -0,0 +1,69 @@
+'''
+Tests of the data projection store's synchronisation state and clearing.
+'''
+import numpy
+
+from mapclientplugins.smoothfitstep.model.projectionstore import DataProjectionStore
+
+
+def test_set_and_get_projections():
+    store = DataProjectionStore(2)
+    identifiers = numpy.array([7, 3, 12, 5], dtype=numpy.int32)
+    xi = numpy.array([[0.1, 0.2], [0.3, 0.4], [0.5, 0.6], [0.7, 0.8]])
+    store.setProjections(identifiers, [1, 2, 3, 4], xi)
+    assert store.getNumberOfDataPoints() == 4
+    assert store.getNumberOfProjections() == 4
+    elementIdentifiers, resultXi = store.getProjections([12, 3, 99])
+    numpy.testing.assert_array_equal(elementIdentifiers, [3, 2, -1])
+    numpy.testing.assert_array_equal(resultXi, [[0.5, 0.6], [0.3, 0.4], [0.0, 0.0]])
+    numpy.testing.assert_array_equal(store.getProjectedIdentifiers(), [3, 5, 7, 12])
+
+
+def test_sync():
+    store = DataProjectionStore(2)
+    assert store.isSynced()
+    store.setProjections([1, 2, 3], [10, 20, 30], numpy.zeros((3, 2)))
+    assert not store.isSynced()
+    identifiers, elementIdentifiers, xi = store.getUnsyncedProjections()
+    numpy.testing.assert_array_equal(identifiers, [1, 2, 3])
+    numpy.testing.assert_array_equal(elementIdentifiers, [10, 20, 30])
+    store.setSynced()
+    assert store.isSynced()
+    assert store.getUnsyncedProjections()[0].size == 0
+    # only changed projections are unsynced, including new identifiers
+    store.setProjections([4, 2], [40, 21], [[0.4, 0.4], [0.2, 0.2]])
+    identifiers, elementIdentifiers, xi = store.getUnsyncedProjections()
+    numpy.testing.assert_array_equal(identifiers, [2, 4])
+    numpy.testing.assert_array_equal(elementIdentifiers, [21, 40])
+    numpy.testing.assert_array_equal(xi, [[0.2, 0.2], [0.4, 0.4]])
+    # earlier projections kept when identifiers are added
+    numpy.testing.assert_array_equal(store.getProjections([1, 2, 3, 4])[0], [10, 21, 30, 40])
+    store.setSynced()
+    assert store.isSynced()
+
+
+def test_clear():
+    store = DataProjectionStore(3)
+    store.setProjections(numpy.arange(1, 21), numpy.arange(101, 121), numpy.full((20, 3), 0.5))
+    store.clear()
+    assert store.getNumberOfDataPoints() == 20
+    assert store.getNumberOfProjections() == 0
+    assert store.getProjectedIdentifiers().size == 0
+    assert store.isSynced()
+    assert store.getUnsyncedProjections()[0].size == 0
+    numpy.testing.assert_array_equal(store.getProjections([1, 20])[0], [-1, -1])
+    # reusable after clearing, with only new projections present
+    store.setProjections([5], [105], [[0.1, 0.2, 0.3]])
+    assert store.getNumberOfProjections() == 1
+    numpy.testing.assert_array_equal(store.getProjections([4, 5])[0], [-1, 105])
+    numpy.testing.assert_array_equal(store.getUnsyncedProjections()[0], [5])
+
+
+def test_memory_report():
+    store = DataProjectionStore(2)
+    store.setProjections(numpy.arange(1000), numpy.zeros(1000), numpy.zeros((1000, 2)))
+    report = store.getMemoryReport()
+    assert report['data_points'] == 1000
+    assert report['projections'] == 1000
+    # int32 identifier and element, 2 float64 xi, 2 bits
+    assert report['bytes'] == 1000*(4 + 4 + 16) + 2*125
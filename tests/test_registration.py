@@ -0,0 +1,85 @@
+'''
+Tests of automatic registration recovering known similarity transforms.
+'''
+import numpy
+import pytest
+
+from mapclientplugins.smoothfitstep.maths import vectorops
+from mapclientplugins.smoothfitstep.maths.registration import MIRROR_MATRIX, registerPoints, similarityTransform
+
+
+def createSurfacePoints(u, v):
+    '''
+    :return: (N, 3) points on a curved sheet with distinct principal axes
+    and no mirror symmetry
+    '''
+    return numpy.stack([u, v, 0.3*u*u + 0.5*numpy.sin(2.0*v) + 0.2*u*v], axis=1)
+
+
+def createModelPoints():
+    '''
+    :return: points on a regular grid over the sheet, as sampled from model elements
+    '''
+    u, v = numpy.meshgrid(numpy.linspace(0.0, 3.0, 121), numpy.linspace(0.0, 2.0, 81))
+    return createSurfacePoints(u.ravel(), v.ravel())
+
+
+def createDataPoints(count, seed=0):
+    '''
+    :return: (count, 3) points at random over the sheet
+    '''
+    rng = numpy.random.default_rng(seed)
+    return createSurfacePoints(rng.uniform(0.0, 3.0, count), rng.uniform(0.0, 2.0, count))
+
+
+def transform(points, scale, rotation, mirror, translation):
+    matrix = numpy.matmul(MIRROR_MATRIX, rotation) if mirror else rotation
+    return scale*numpy.matmul(points, matrix.T) + translation
+
+
+@pytest.mark.parametrize('mirror', [False, True])
+def test_register_recovers_similarity_transform(mirror):
+    modelPoints = createModelPoints()
+    scale = 1.7
+    rotation = numpy.array(vectorops.eulerToRotationMatrix3([0.8, -0.4, 2.1]))
+    translation = numpy.array([10.0, -3.0, 5.0])
+    dataPoints = transform(createDataPoints(2000), scale, rotation, mirror, translation)
+    result = registerPoints(modelPoints, dataPoints, mirrors=(False, True))
+    assert result['mirror'] == mirror
+    numpy.testing.assert_allclose(result['scale'], scale, rtol=0.01)
+    numpy.testing.assert_allclose(result['rotation'], rotation, atol=0.01)
+    assert numpy.linalg.det(result['rotation']) == pytest.approx(1.0)
+    numpy.testing.assert_allclose(result['translation'], translation, atol=0.05)
+
+
+@pytest.mark.parametrize('mirror', [False, True])
+def test_register_exact_correspondences(mirror):
+    modelPoints = createDataPoints(1000, seed=1)
+    rotation = numpy.array(vectorops.eulerToRotationMatrix3([-2.5, 0.3, 0.9]))
+    translation = numpy.array([0.5, 1.0, -2.0])
+    dataPoints = transform(modelPoints, 0.6, rotation, mirror, translation)
+    result = registerPoints(modelPoints, dataPoints, mirrors=(mirror,))
+    assert result['mirror'] == mirror
+    assert result['rms_error'] < 1.0E-8
+    numpy.testing.assert_allclose(result['scale'], 0.6, rtol=1.0E-8)
+    numpy.testing.assert_allclose(result['rotation'], rotation, atol=1.0E-8)
+    numpy.testing.assert_allclose(result['translation'], translation, atol=1.0E-8)
+
+
+def test_register_fixed_scale():
+    modelPoints = createDataPoints(1000, seed=1)
+    rotation = numpy.array(vectorops.eulerToRotationMatrix3([0.2, 0.1, -0.3]))
+    dataPoints = transform(modelPoints, 2.0, rotation, False, numpy.zeros(3))
+    result = registerPoints(modelPoints, dataPoints, estimateScale=False, scale=2.0)
+    assert result['scale'] == 2.0
+    numpy.testing.assert_allclose(result['rotation'], rotation, atol=1.0E-8)
+
+
+def test_similarity_transform_reflection():
+    source = createDataPoints(100, seed=2)
+    matrix = numpy.matmul(MIRROR_MATRIX, vectorops.eulerToRotationMatrix3([0.4, 0.5, 0.6]))
+    target = 3.0*numpy.matmul(source, matrix.T) + 1.0
+    scale, resultMatrix, translation = similarityTransform(source, target, reflection=True)
+    numpy.testing.assert_allclose(scale, 3.0, rtol=1.0E-10)
+    numpy.testing.assert_allclose(resultMatrix, matrix, atol=1.0E-10)
+    numpy.testing.assert_allclose(translation, numpy.ones(3), atol=1.0E-10)
@@ -0,0 +1,102 @@
+'''
+Tests of nearest location queries against a brute force search of every element.
+'''
+import numpy
+
+from mapclientplugins.smoothfitstep.maths.elementpatches import ElementPatches, patchXi
+from mapclientplugins.smoothfitstep.maths.spatialindex import MeshSpatialIndex
+
+
+def createPatches(elementsPerSide, phase=0.0):
+    '''
+    :return: ElementPatches for a bumpy square surface of side elementsPerSide
+    '''
+    xi = patchXi(2)
+    controlPoints = []
+    for j in range(elementsPerSide):
+        for i in range(elementsPerSide):
+            x = i + xi[:, 0]
+            y = j + xi[:, 1]
+            z = 0.5*numpy.sin(0.7*x + phase)*numpy.cos(0.5*y) + 0.1*x
+            controlPoints.append(numpy.stack([x, y, z], axis=1))
+    return ElementPatches(numpy.arange(1, elementsPerSide*elementsPerSide + 1), numpy.array(controlPoints), 2)
+
+
+def createPoints(count, elementsPerSide, seed=0):
+    '''
+    :return: (count, 3) points scattered about the surface, some well away from it
+    '''
+    rng = numpy.random.default_rng(seed)
+    points = createPatches(elementsPerSide).evaluate(rng.integers(0, elementsPerSide**2, count),
+                                                     rng.random((count, 2)))[0]
+    points[:, 2] += rng.normal(0.0, 0.1, count)
+    points[:count//10] += rng.normal(0.0, 1.0, (count//10, 3))
+    return points
+
+
+def bruteForceNearestLocations(patches, points, samplesPerDirection=21):
+    '''
+    Project every point onto every element from the closest of a dense grid
+    of samples in that element, keeping the nearest.
+    :return: distances (N,)
+    '''
+    elementCount = patches.getNumberOfElements()
+    sampleElementIndexes, sampleXi, sampleCoordinates = patches.sample(samplesPerDirection)
+    samplesPerElement = samplesPerDirection**patches.getDimension()
+    best = numpy.full(points.shape[0], numpy.inf)
+    for e in range(elementCount):
+        samples = slice(e*samplesPerElement, (e + 1)*samplesPerElement)
+        delta = points[:, numpy.newaxis, :] - sampleCoordinates[numpy.newaxis, samples]
+        seeds = numpy.argmin(numpy.sum(delta*delta, axis=2), axis=1)
+        distances = patches.projectLocal(points, numpy.full(points.shape[0], e), sampleXi[samples][seeds])[1]
+        best = numpy.minimum(best, distances)
+    return best
+
+
+def test_findNearestLocations_matches_brute_force():
+    patches = createPatches(4)
+    points = createPoints(300, 4)
+    elementIndexes, xi, distances = MeshSpatialIndex(patches).findNearestLocations(points)
+    assert numpy.all(elementIndexes >= 0)
+    assert numpy.all((xi >= 0.0) & (xi <= 1.0))
+    coordinates = patches.evaluate(elementIndexes, xi)[0]
+    numpy.testing.assert_allclose(numpy.linalg.norm(coordinates - points, axis=1), distances, atol=1.0E-12)
+    numpy.testing.assert_allclose(distances, bruteForceNearestLocations(patches, points), atol=1.0E-8)
+
+
+def test_findNearestLocations_in_chunks():
+    patches = createPatches(3)
+    points = createPoints(100, 3, seed=1)
+    index = MeshSpatialIndex(patches)
+    elementIndexes, xi, distances = index.findNearestLocations(points)
+    chunkElementIndexes, chunkXi, chunkDistances = index.findNearestLocations(points, chunkSize=7)
+    numpy.testing.assert_array_equal(chunkElementIndexes, elementIndexes)
+    numpy.testing.assert_allclose(chunkXi, xi, atol=1.0E-8)
+    numpy.testing.assert_allclose(chunkDistances, distances, atol=1.0E-12)
+
+
+def test_findNearestLocationsLocal_after_move():
+    points = createPoints(300, 4, seed=2)
+    elementIndexes, xi, distances = MeshSpatialIndex(createPatches(4)).findNearestLocations(points)
+    movedPatches = createPatches(4, phase=0.05)
+    movedIndex = MeshSpatialIndex(movedPatches)
+    localElementIndexes, localXi, localDistances, outsideCount = movedIndex.findNearestLocationsLocal(
+        points, elementIndexes, xi, distances)
+    coordinates = movedPatches.evaluate(localElementIndexes, localXi)[0]
+    numpy.testing.assert_allclose(numpy.linalg.norm(coordinates - points, axis=1), localDistances, atol=1.0E-12)
+    # local results may only be worse than the global minimum in rare local minima
+    bruteDistances = bruteForceNearestLocations(movedPatches, points)
+    assert numpy.all(localDistances >= bruteDistances - 1.0E-8)
+    assert numpy.count_nonzero(localDistances > bruteDistances + 1.0E-8) <= 3
+    assert 0 <= outsideCount < points.shape[0]
+
+
+def test_findNearestLocationsLocal_unseeded_points_searched_globally():
+    patches = createPatches(3)
+    points = createPoints(50, 3, seed=3)
+    index = MeshSpatialIndex(patches)
+    elementIndexes, xi, distances = index.findNearestLocations(points)
+    localElementIndexes, localXi, localDistances, outsideCount = index.findNearestLocationsLocal(
+        points, numpy.full(points.shape[0], -1, dtype=numpy.int32), numpy.zeros((points.shape[0], 2)))
+    assert outsideCount == points.shape[0]
+    numpy.testing.assert_allclose(localDistances, distances, atol=1.0E-12)
@@ -0,0 +1,85 @@
+'''
+Tests of batched vector operations against the scalar functions they batch.
+'''
+import math
+
+import numpy
+
+from mapclientplugins.smoothfitstep.maths import vectorops
+
+
+def createEulerAngles(count=200, seed=0):
+    '''
+    :return: (N, 3) random euler angles plus those giving singular and
+    axis-aligned rotation matrices
+    '''
+    rng = numpy.random.default_rng(seed)
+    angles = rng.uniform(-math.pi, math.pi, (count, 3))
+    angles[:, 1] = rng.uniform(-0.5*math.pi, 0.5*math.pi, count)
+    special = []
+    for azimuth in [0.0, 0.5*math.pi, math.pi, -0.5*math.pi, 0.3]:
+        for elevation in [0.0, 0.5*math.pi, -0.5*math.pi, 0.7]:
+            for roll in [0.0, 0.5*math.pi, -2.0]:
+                special.append([azimuth, elevation, roll])
+    return numpy.concatenate([angles, special])
+
+
+def test_euler_to_rotation_matrices():
+    angles = createEulerAngles()
+    matrices = vectorops.eulerToRotationMatrices3(angles)
+    expected = numpy.array([vectorops.eulerToRotationMatrix3(angle) for angle in angles.tolist()])
+    numpy.testing.assert_allclose(matrices, expected, atol=1.0E-15)
+
+
+def test_rotation_matrices_to_euler():
+    matrices = vectorops.eulerToRotationMatrices3(createEulerAngles())
+    # exactly singular matrices, as from snapped alignments
+    singular = numpy.array([[[0.0, 0.0, -1.0], [0.0, 1.0, 0.0], [1.0, 0.0, 0.0]],
+                            [[0.0, 0.0, 1.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
+                            [[0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [1.0, 0.0, 0.0]],
+                            [[1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, -1.0, 0.0]]])
+    matrices = numpy.concatenate([matrices, singular])
+    angles = vectorops.rotationMatrices3ToEuler(matrices)
+    expected = numpy.array([vectorops.rotationMatrix3ToEuler(matrix) for matrix in matrices.tolist()])
+    numpy.testing.assert_allclose(angles, expected, atol=1.0E-12)
+    # angles reproduce the matrices
+    numpy.testing.assert_allclose(vectorops.eulerToRotationMatrices3(angles), matrices, atol=1.0E-12)
+
+
+def test_quaternions_to_rotation_matrices():
+    quaternions = numpy.random.default_rng(1).normal(0.0, 1.0, (50, 4))
+    matrices = vectorops.quaternionsToRotationMatrices3(quaternions)
+    expected = numpy.array([vectorops.rotmx(quaternion) for quaternion in quaternions.tolist()])
+    numpy.testing.assert_allclose(matrices, expected, atol=1.0E-15)
+
+
+def test_magnitudes_and_normalize():
+    vectors = numpy.random.default_rng(2).normal(0.0, 1.0, (50, 3))
+    numpy.testing.assert_allclose(vectorops.magnitudes(vectors),
+                                  [vectorops.magnitude(vector) for vector in vectors.tolist()], rtol=1.0E-15)
+    numpy.testing.assert_allclose(vectorops.normalizeVectors(vectors),
+                                  [vectorops.normalize(vector) for vector in vectors.tolist()], rtol=1.0E-15)
+
+
+def test_transform_points():
+    rng = numpy.random.default_rng(3)
+    points = rng.normal(0.0, 1.0, (40, 3))
+    matrix = numpy.array(vectorops.eulerToRotationMatrix3([0.1, 0.2, 0.3]))*2.5
+    offset = numpy.array([1.0, -2.0, 0.5])
+    transformed = vectorops.transformPoints(points, matrix, offset)
+    expected = [vectorops.add(vectorops.matrixvectormult(matrix.tolist(), point), offset.tolist())
+                for point in points.tolist()]
+    numpy.testing.assert_allclose(transformed, expected, atol=1.0E-14)
+    numpy.testing.assert_allclose(vectorops.inverseTransformPoints(transformed, matrix, offset), points, atol=1.0E-14)
+
+
+def test_transform_points_per_point_matrices():
+    rng = numpy.random.default_rng(4)
+    points = rng.normal(0.0, 1.0, (30, 3))
+    matrices = vectorops.eulerToRotationMatrices3(createEulerAngles(30, seed=5)[:30])
+    offsets = rng.normal(0.0, 1.0, (30, 3))
+    transformed = vectorops.transformPoints(points, matrices, offsets)
+    expected = [numpy.dot(matrix, point) + offset for matrix, point, offset in zip(matrices, points, offsets)]
+    numpy.testing.assert_allclose(transformed, expected, atol=1.0E-14)
+    numpy.testing.assert_allclose(vectorops.inverseTransformPoints(transformed, matrices, offsets), points,
+                                  atol=1.0E-14)